@@ -1,16 +1,34 @@
 import streamlit as st
-import anthropic
 import os
+import sys
 import json
 import base64
-import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
-from PIL import Image
 import io
 import re
+import time
+import itertools
+import functools
+import uuid
+import hashlib
+import threading
+import queue
+import tempfile
 from datetime import datetime
-import seaborn as sns
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from response_scanner import ResponseScanner, scan_response
+from storage import create_store
+from search_index import SearchIndex
+from blob_store import BlobStore, BlobStoreFull, private_directory
+from extraction import Extractor, needs_extraction
+from response_cache import ResponseCache, cached_message, request_key, tenant_key
+from request_scheduler import RequestScheduler
+from memory_budget import SessionHandle, SessionRegistry, SpilledFrame, frame_shape, load_frame, spill_frame
+# The API client and the data and charting stack are imported on first use
+# (see timed_import), so a new process can serve its first page without them
+from metrics import IMPORT_TIMES, LAZY_MODULES, Metrics, RerunTimer, approx_size, timed_import
+from pipeline import (build_user_message, decode_text, estimate_request_tokens, estimate_tokens, is_text_type,
+                      request_params, response_text, trim_history, usage_summary)
 
 # Set page configuration
 st.set_page_config(
@@ -20,6 +38,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Wall time of this run, split by page section
+rerun_timer = RerunTimer()
+
 # Styles - updated for fixed chat input and scrollable message pane
 st.markdown("""
 <style>
@@ -42,6 +63,23 @@ st.markdown("""
         overflow-y: auto;
     }
     
+    /* The transcript, with one keyed element per message */
+    .st-key-transcript {
+        gap: 0;
+        padding: 10px;
+        background-color: rgba(40, 40, 40, 0.2);
+        border-radius: 8px;
+        margin-bottom: 15px;
+        min-height: 400px;
+        max-height: 70vh;
+        overflow-y: auto;
+    }
+    
+    .chat-row {
+        display: flex;
+        flex-direction: column;
+    }
+    
     /* Message styling */
     .user-message {
         align-self: flex-end;
@@ -99,233 +137,1045 @@ st.markdown("""
 </script>
 """, unsafe_allow_html=True)
 
+# Minimum seconds between redraws of a streaming response
+STREAM_RENDER_INTERVAL = 0.05
+
+# Number of recent turns shown in the transcript, and how many more each "Show earlier" adds
+TRANSCRIPT_PAGE_TURNS = 20
+
+# Context window defaults (token estimates and prompt caching limits are in pipeline.py)
+DEFAULT_CONTEXT_BUDGET = 100000
+CONTEXT_POLICIES = ["Drop oldest", "Pin first N"]
+
+# USD per million tokens (input, output) used for cost estimates
+MODEL_PRICING = {
+    "claude-3-opus-20240229": (15.00, 75.00),
+    "claude-3-sonnet-20240229": (3.00, 15.00),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-sonnet-20240620": (3.00, 15.00),
+    "claude-3-7-sonnet-20250219": (3.00, 15.00),
+}
+
+# Chart rendering: figure size in inches, thumbnail and full-resolution DPI,
+# and how many rendered PNGs the process-wide cache keeps
+CHART_SIZE = (10, 6)
+CHART_THUMBNAIL_DPI = 50
+CHART_FULL_DPI = 300
+CHART_CACHE_ENTRIES = 64
+
+# CSV import: rows per parsed chunk, rows sampled for dtype inference, when a
+# text column becomes a category, and how many parsed files a session keeps
+CSV_CHUNK_ROWS = 200000
+CSV_SAMPLE_ROWS = 10000
+CSV_CATEGORY_MAX_UNIQUE = 1000
+CSV_CATEGORY_MAX_RATIO = 0.5
+CSV_CACHE_ENTRIES = 3
+
+# Scratchpad items shown per page in each section
+SCRATCHPAD_PAGE_SIZE = 20
+SEARCH_RESULT_LIMIT = 20
+# Search filter label -> index kinds
+SEARCH_FILTERS = {
+    "Everything": None,
+    "Messages": {"message"},
+    "Code": {"code"},
+    "Tables": {"table"},
+    "Notes": {"text"},
+    "Charts": {"chart"},
+}
+
+# Session persistence: "memory" keeps sessions in RAM only, "sqlite" saves
+# them to CLAUDE_UI_SQLITE_PATH so they can be resumed by id
+STORAGE_BACKEND = os.environ.get("CLAUDE_UI_STORAGE", "memory")
+SQLITE_PATH = os.environ.get("CLAUDE_UI_SQLITE_PATH", "claude_ui.db")
+
+# Chart images and uploaded files live on disk, shared by all sessions in the
+# process; session state only holds their hashes. Without CLAUDE_UI_BLOB_DIR
+# they go next to the SQLite database when sessions are saved, so they are on
+# the same volume, and otherwise to a private temporary directory for this process.
+BLOB_DIR = os.environ.get("CLAUDE_UI_BLOB_DIR") or (f"{SQLITE_PATH}-blobs" if STORAGE_BACKEND == "sqlite" else None)
+BLOB_QUOTA_BYTES = int(float(os.environ.get("CLAUDE_UI_BLOB_QUOTA_MB", "2048")) * 1024 * 1024)
+SESSION_BLOB_QUOTA_BYTES = int(float(os.environ.get("CLAUDE_UI_SESSION_BLOB_QUOTA_MB", "256")) * 1024 * 1024)
+
+# Opt-in cache of replies to temperature 0 requests, shared by all sessions.
+# Entries expire after the TTL and the least recently used go over the size cap.
+RESPONSE_CACHE_DIR = os.environ.get("CLAUDE_UI_RESPONSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "claude_ui_responses"))
+RESPONSE_CACHE_MAX_BYTES = int(float(os.environ.get("CLAUDE_UI_RESPONSE_CACHE_MB", "256")) * 1024 * 1024)
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("CLAUDE_UI_RESPONSE_CACHE_TTL_HOURS", "168")) * 3600
+
+# Metrics: CLAUDE_UI_METRICS_PORT serves them in the Prometheus text format at
+# /metrics, and CLAUDE_UI_METRICS_JSONL appends every turn and rerun to a file
+METRICS_HOST = os.environ.get("CLAUDE_UI_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.environ.get("CLAUDE_UI_METRICS_PORT")
+METRICS_JSONL_PATH = os.environ.get("CLAUDE_UI_METRICS_JSONL")
+# Walking a large session's state takes a while, so its size is measured at
+# most this often and reused in between
+SESSION_MEMORY_SAMPLE_SECONDS = 30
+
+# Memory budgets. A session over its budget first moves chart data to the blob
+# store, then drops caches it can rebuild; while all sessions together are over
+# the global budget, sessions idle for a while are evicted, largest first.
+SESSION_MEMORY_BUDGET_BYTES = int(float(os.environ.get("CLAUDE_UI_SESSION_MEMORY_MB", "512")) * 1024 * 1024)
+GLOBAL_MEMORY_BUDGET_BYTES = int(float(os.environ.get("CLAUDE_UI_GLOBAL_MEMORY_MB", "4096")) * 1024 * 1024)
+SESSION_IDLE_EVICT_SECONDS = float(os.environ.get("CLAUDE_UI_SESSION_IDLE_MINUTES", "15")) * 60
+# How often an open page checks whether its session was asked to free memory
+MEMORY_CHECK_SECONDS = 60
+# Session state entries that are rebuilt on demand when missing
+DERIVED_CACHE_KEYS = ["csv_cache", "message_html_cache", "token_count_cache"]
+
+# Attachment extraction and image resizing: worker threads shared by all
+# sessions, cached results, and how often the attachment list refreshes while
+# work is in progress
+EXTRACTION_WORKERS = int(os.environ.get("CLAUDE_UI_EXTRACTION_WORKERS", "4"))
+EXTRACTION_CACHE_ENTRIES = 64
+EXTRACTION_POLL_SECONDS = 1.0
+
+# Shared Anthropic client pool settings (override with environment variables)
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL") or None
+CLIENT_MAX_CONNECTIONS = int(os.environ.get("CLAUDE_UI_MAX_CONNECTIONS", "100"))
+CLIENT_MAX_KEEPALIVE = int(os.environ.get("CLAUDE_UI_MAX_KEEPALIVE", "20"))
+CLIENT_KEEPALIVE_EXPIRY = float(os.environ.get("CLAUDE_UI_KEEPALIVE_EXPIRY", "60"))
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get("CLAUDE_UI_CONNECT_TIMEOUT", "10"))
+CLIENT_READ_TIMEOUT = float(os.environ.get("CLAUDE_UI_READ_TIMEOUT", "600"))
+# Clients unused for this many seconds are closed and dropped from the pool
+CLIENT_IDLE_EVICTION = float(os.environ.get("CLAUDE_UI_CLIENT_IDLE_EVICTION", "1800"))
+
+# Rate limits shared by every session in the process, which usually share one
+# organisation's key. 0 turns a limit off; failed requests are retried with
+# backoff either way.
+API_REQUESTS_PER_MINUTE = int(os.environ.get("CLAUDE_UI_REQUESTS_PER_MINUTE", "0"))
+API_INPUT_TOKENS_PER_MINUTE = int(os.environ.get("CLAUDE_UI_INPUT_TOKENS_PER_MINUTE", "0"))
+API_MAX_RETRIES = int(os.environ.get("CLAUDE_UI_API_MAX_RETRIES", "4"))
+API_RETRY_BASE_SECONDS = 1.0
+API_RETRY_MAX_SECONDS = 60.0
+
+# Uploaded files for a session. Each distinct payload is kept once in the blob
+# store, keyed by its SHA-256, and derived forms (base64, decoded text) are built when needed.
+# Files still in the uploader are pinned, so they are there when the next message is sent.
+class UploadStore:
+    def __init__(self, blobs, session_id, store=None):
+        self.blobs = blobs
+        self.session_id = session_id
+        self.store = store
+        # Metadata only; the bytes are in the blob store under the content hash
+        self.files = {}
+        # Streamlit uploader file id -> content hash, so reruns skip re-hashing
+        self.uploads = {}
+
+    def add(self, uploaded_file):
+        upload_id = getattr(uploaded_file, "file_id", None)
+        content_hash = self.uploads.get(upload_id) if upload_id else None
+        if content_hash in self.files and self.blobs.pin(content_hash, self.session_id):
+            return content_hash
+
+        file_bytes = uploaded_file.getvalue()
+        content_hash = self.blobs.put(file_bytes, self.session_id, pin=True)
+        if upload_id:
+            self.uploads[upload_id] = content_hash
+        self.files[content_hash] = {
+            "name": uploaded_file.name,
+            "type": uploaded_file.type,
+            "size": len(file_bytes)
+        }
+        if self.store is not None:
+            self.store.save_upload(self.session_id, content_hash, self.files[content_hash])
+        return content_hash
+
+    # Files saved in storage for this session whose bytes the blob store still has
+    def restore(self):
+        for file_id, info in self.store.load_uploads(self.session_id).items():
+            if self.blobs.touch(file_id, self.session_id):
+                self.files[file_id] = info
+
+    def __contains__(self, file_id):
+        return file_id in self.files
+
+    def __getitem__(self, file_id):
+        return self.files[file_id]
+
+    # Encoded when a message is sent, not kept; None if the blob was evicted
+    def base64(self, file_id):
+        return self.blobs.read_base64(file_id)
+
+    def text(self, file_id):
+        file_type = self.files[file_id]["type"]
+        if not is_text_type(file_type):
+            return None
+        return decode_text(file_type, self.blobs.read(file_id))
+
+    def display_bytes(self, file_id):
+        return self.blobs.read(file_id) if self.files[file_id]["type"].startswith('image/') else None
+
+    # Drop files that are neither in the uploader nor attached to a chat message,
+    # and unpin sent files that have left the uploader
+    def evict_unreferenced(self, pending_ids, sent_ids):
+        pending_ids = set(pending_ids)
+        referenced_ids = pending_ids | set(sent_ids)
+        unreferenced = [k for k in self.files if k not in referenced_ids]
+        for file_id in unreferenced:
+            del self.files[file_id]
+        self.blobs.release(self.session_id, unreferenced)
+        if self.store is not None:
+            self.store.delete_uploads(self.session_id, unreferenced)
+        self.blobs.unpin(self.session_id, [k for k in self.files if k not in pending_ids])
+        self.uploads = {k: v for k, v in self.uploads.items() if v in self.files}
+
+# One scratchpad entry. __slots__ keeps per-item overhead small for large scratchpads.
+# Items restored from storage may carry a loader instead of their content, which
+# is then fetched the first time it is read.
+class ScratchpadItem:
+    __slots__ = ("id", "name", "type", "_content", "created", "loader")
+
+    def __init__(self, item_id, name, item_type, content, created, loader=None):
+        self.id = item_id
+        self.name = name
+        self.type = item_type
+        self._content = content
+        self.created = created
+        self.loader = loader
+
+    @property
+    def content(self):
+        if self.loader is not None:
+            self._content = self.loader()
+            self.loader = None
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.loader = None
+
+# Text and language that an item contributes to the search index
+def scratchpad_search_fields(item_type, content):
+    if item_type == "code" and isinstance(content, dict):
+        return content.get("code", ""), content.get("language")
+    if item_type == "chart" and isinstance(content, dict):
+        return f"{content.get('type', '')} {content.get('description', '')}", None
+    return str(content), None
+
+# Scratchpad with per-type indexes kept up to date on every change, monotonic
+# ids, and O(1) amortized unique naming. Every change is also written to the
+# session's storage backend and search index.
+class Scratchpad:
+    GROUPS = ("chart", "code", "table", "text")
+
+    def __init__(self, store=None, session_id=None, search_index=None):
+        self.items = {}
+        self.by_type = {group: {} for group in self.GROUPS}
+        self.next_id = 1
+        # Next suffix to try for each base name that has collided
+        self.name_suffixes = {}
+        self.store = store
+        self.session_id = session_id
+        self.search_index = search_index
+        # Items restored without their content, by id, indexed on the first search
+        self.unindexed = {}
+
+    # Anything that is not code, a table or a chart is shown as a note
+    @staticmethod
+    def group_of(item_type):
+        return item_type if item_type in ("chart", "code", "table") else "text"
+
+    def unique_name(self, name):
+        if name not in self.items:
+            return name
+        suffix = self.name_suffixes.get(name, 1)
+        while f"{name}_{suffix}" in self.items:
+            suffix += 1
+        self.name_suffixes[name] = suffix + 1
+        return f"{name}_{suffix}"
+
+    def _index(self, item, content):
+        self.items[item.name] = item
+        self.by_type[self.group_of(item.type)][item.name] = item
+        self._index_text(item, content)
+
+    def _index_text(self, item, content):
+        self.unindexed.pop(item.id, None)
+        if self.search_index is not None:
+            text, language = scratchpad_search_fields(item.type, content)
+            self.search_index.add(("pad", item.id), self.group_of(item.type), text, item.name, language)
+
+    def add(self, name, item_type, content, created):
+        item = ScratchpadItem(self.next_id, self.unique_name(name), item_type, content, created)
+        self.next_id += 1
+        self._index(item, content)
+        if self.store is not None:
+            self.store.save_scratchpad_item(self.session_id, item)
+        return item
+
+    # Add an item loaded from storage without writing it back. One whose
+    # content is left in storage is not read until it is shown or searched.
+    def restore(self, item):
+        if item.loader is not None:
+            self.items[item.name] = item
+            self.by_type[self.group_of(item.type)][item.name] = item
+            self.unindexed[item.id] = item
+        else:
+            self._index(item, item.content)
+        self.next_id = max(self.next_id, item.id + 1)
+
+    # Read and index items restored without their content, without keeping
+    # the content in memory
+    def index_unloaded(self):
+        for item in list(self.unindexed.values()):
+            loader = item.loader
+            self._index_text(item, item.content if loader is None else loader())
+
+    def update(self, name, content):
+        item = self.items[name]
+        item.content = content
+        self._index_text(item, content)
+        if self.store is not None:
+            self.store.save_scratchpad_item(self.session_id, item)
+
+    def delete(self, name):
+        item = self.items.pop(name, None)
+        if item is not None:
+            del self.by_type[self.group_of(item.type)][name]
+            self.unindexed.pop(item.id, None)
+            if self.search_index is not None:
+                self.search_index.remove(("pad", item.id))
+            if self.store is not None:
+                self.store.delete_scratchpad_item(self.session_id, item.id)
+        return item
+
+    def clear(self):
+        self.items.clear()
+        self.unindexed.clear()
+        for group in self.by_type.values():
+            group.clear()
+        if self.search_index is not None:
+            self.search_index.clear(self.GROUPS)
+        if self.store is not None:
+            self.store.clear_scratchpad(self.session_id)
+
+    def of_type(self, group):
+        return self.by_type[group]
+
+    # Items of one group for a page, newest first
+    def page(self, group, page, page_size):
+        start = page * page_size
+        return list(itertools.islice(reversed(self.by_type[group].values()), start, start + page_size))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, name):
+        return name in self.items
+
+    def __getitem__(self, name):
+        return self.items[name]
+
+# Storage backend shared by every session in the process
+@st.cache_resource
+def get_storage():
+    return create_store(STORAGE_BACKEND, SQLITE_PATH)
+
+# Blob store shared by every session in the process
+@st.cache_resource
+def get_blob_store():
+    return BlobStore(BLOB_DIR or private_directory("claude_ui_blobs_"), BLOB_QUOTA_BYTES, SESSION_BLOB_QUOTA_BYTES)
+
+# Response cache shared by every session in the process
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS)
+
+# Metrics shared by every session in the process
+@st.cache_resource
+def get_metrics():
+    metrics = Metrics(METRICS_JSONL_PATH)
+    if METRICS_PORT:
+        try:
+            metrics.serve(METRICS_HOST, int(METRICS_PORT))
+        except OSError as e:
+            metrics.event("metrics_server_error", host=METRICS_HOST, port=METRICS_PORT, error=str(e))
+    return metrics
+
+# Sizes and activity of every session, for the global memory budget. A
+# session's blob references go with it.
+@st.cache_resource
+def get_session_registry():
+    return SessionRegistry(on_end=get_blob_store().release_session)
+
+# Ids of the resources every session shares, left out of session memory
+def shared_resource_ids():
+    return {id(get_storage()), id(get_blob_store()), id(get_extractor()), id(get_response_cache()), id(get_metrics())}
+
+# Approximate memory held by this session's state, leaving out the resources
+# every session shares
+def session_memory_bytes(refresh=False):
+    sample = st.session_state.get("memory_sample")
+    if not refresh and sample is not None and time.time() - sample[0] < SESSION_MEMORY_SAMPLE_SECONDS:
+        return sample[1]
+    memory_bytes = approx_size({key: st.session_state[key] for key in st.session_state.keys()}, shared_resource_ids())
+    st.session_state.memory_sample = (time.time(), memory_bytes)
+    return memory_bytes
+
+# Move this session's DataFrames to the blob store, pinned there until they are
+# replaced. Frames the store has no room for stay in memory. Returns the bytes moved.
+def spill_session_frames():
+    blobs = get_blob_store()
+    session_id = st.session_state.session_id
+    spilled_bytes = 0
+    data = st.session_state.chart_data
+    try:
+        if data is not None and not isinstance(data, SpilledFrame):
+            st.session_state.chart_data = spill_frame(blobs, session_id, data, st.session_state.chart_data_memory)
+            spilled_bytes += st.session_state.chart_data_memory
+            # The CSV cache holds the same frame
+            csv_cache = st.session_state.csv_cache
+            for key in [key for key, (cached, _) in csv_cache.items() if cached is data]:
+                del csv_cache[key]
+        chart_sources = st.session_state.chart_sources
+        for fingerprint, plot_data in list(chart_sources.items()):
+            if not isinstance(plot_data, SpilledFrame):
+                chart_sources[fingerprint] = spill_frame(blobs, session_id, plot_data)
+                spilled_bytes += chart_sources[fingerprint].memory_bytes
+    except BlobStoreFull:
+        pass
+    return spilled_bytes
+
+# Empty the caches this session rebuilds on demand. Returns whether any held anything.
+def drop_derived_caches():
+    dropped = False
+    for key in DERIVED_CACHE_KEYS:
+        if st.session_state[key]:
+            st.session_state[key] = {}
+            dropped = True
+    return dropped
+
+# Free this session's memory for the global budget once it has been idle for
+# a while. With persistent storage its history is dropped too and reloaded
+# when it is next used.
+def evict_session():
+    spill_session_frames()
+    drop_derived_caches()
+    # Its charts and sent files go first under blob store pressure; files
+    # waiting in the uploader stay pinned
+    get_blob_store().release_session(st.session_state.session_id, keep_pinned=True)
+    if get_storage().persistent and not st.session_state.get("evicted"):
+        for key in ["messages", "search_index", "scratchpad"]:
+            del st.session_state[key]
+        st.session_state.evicted = True
+    return session_memory_bytes(refresh=True)
+
+# Keep this session within its memory budget and the process within the
+# global one. Returns the session's memory afterwards and what was done.
+def enforce_memory_budget(memory_bytes):
+    actions = []
+    if memory_bytes > SESSION_MEMORY_BUDGET_BYTES:
+        spilled_bytes = spill_session_frames()
+        if spilled_bytes:
+            actions.append(f"moved {format_bytes(spilled_bytes)} of chart data to disk")
+            memory_bytes = session_memory_bytes(refresh=True)
+    if memory_bytes > SESSION_MEMORY_BUDGET_BYTES and drop_derived_caches():
+        actions.append("cleared cached data")
+        memory_bytes = session_memory_bytes(refresh=True)
+    registry = get_session_registry()
+    registry.end_run(st.session_state.session_id, memory_bytes)
+    if registry.total_bytes() > GLOBAL_MEMORY_BUDGET_BYTES:
+        evicted = registry.evict_idle(GLOBAL_MEMORY_BUDGET_BYTES, SESSION_IDLE_EVICT_SECONDS,
+                                      exclude=st.session_state.session_id)
+        if evicted:
+            get_metrics().event("evict", session=st.session_state.session_id, evicted=evicted)
+    return memory_bytes, actions
+
+# Runs on its own every MEMORY_CHECK_SECONDS while the page is open, so an idle
+# session that was asked to give up memory frees it from its own script thread
+@st.fragment(run_every=MEMORY_CHECK_SECONDS)
+def memory_check():
+    handle = st.session_state.memory_handle
+    if handle.evict_requested:
+        handle.evict_requested = False
+        get_session_registry().report_freed(st.session_state.session_id, evict_session())
+
+# Record a finished Claude request and keep it for the diagnostics panel
+def record_turn(model, mode, latency, response, ttft=None, error=None):
+    cache_hit = getattr(response, "cached", False)
+    if response is None and error is None:
+        error = "request failed"
+    st.session_state.last_turn = get_metrics().record_turn(
+        st.session_state.session_id,
+        model,
+        mode,
+        latency,
+        ttft,
+        usage_summary(response) if response is not None and not cache_hit else None,
+        cache_hit,
+        error
+    )
+
+# Attachment extraction workers shared by every session in the process
+@st.cache_resource
+def get_extractor():
+    return Extractor(EXTRACTION_WORKERS, EXTRACTION_CACHE_ENTRIES)
+
+# Scratchpad for a session, with large contents left in storage until they are
+# first shown or searched
+def load_scratchpad(store, session_id, search_index):
+    scratchpad = Scratchpad(store, session_id, search_index)
+    for row in store.load_scratchpad_items(session_id):
+        loader = None
+        if row["content"] is None:
+            loader = functools.partial(store.load_scratchpad_content, session_id, row["id"])
+        scratchpad.restore(ScratchpadItem(row["id"], row["name"], row["type"], row["content"], row["created"], loader))
+    return scratchpad
+
+# Search index entry for a chat message
+def index_message(search_index, message):
+    title = f"{message['role'].capitalize()} message #{message['id'] + 1}"
+    search_index.add(("msg", message["id"]), "message", message["content"], title)
+
+# Chart data and chart sources saved for a session, pinned again in the blob
+# store. Records whose blob has been removed since are dropped.
+def restore_frames(store, session_id):
+    blobs = get_blob_store()
+    st.session_state.chart_data = None
+    st.session_state.chart_data_memory = 0
+    st.session_state.chart_data_source = None
+    st.session_state.chart_sources = {}
+    for name, row in store.load_frames(session_id).items():
+        if not blobs.pin(row["blob_hash"], session_id):
+            store.delete_frame(session_id, name)
+            continue
+        frame = SpilledFrame(row["blob_hash"], row["rows"], row["columns"], row["memory_bytes"])
+        if name == "chart_data":
+            st.session_state.chart_data = frame
+            st.session_state.chart_data_memory = frame.memory_bytes
+            # Stored as JSON, so the CSV load comes back as lists
+            if row["source"]:
+                content_hash, columns, categorize = row["source"]
+                st.session_state.chart_data_source = (content_hash, tuple(columns), categorize)
+        else:
+            st.session_state.chart_sources[name.removeprefix("source:")] = frame
+
+# Switch this browser session to a stored session id, loading its history
+def load_session(session_id):
+    store = get_storage()
+    previous_session_id = st.session_state.get("session_id")
+    st.session_state.session_id = session_id
+    st.session_state.messages = store.load_messages(session_id)
+    st.session_state.next_message_id = max((msg["id"] for msg in st.session_state.messages), default=-1) + 1
+    st.session_state.message_html_cache = {}
+    st.session_state.search_index = SearchIndex()
+    for message in st.session_state.messages:
+        index_message(st.session_state.search_index, message)
+    st.session_state.scratchpad = load_scratchpad(store, session_id, st.session_state.search_index)
+    st.session_state.file_buffer = UploadStore(get_blob_store(), session_id, store)
+    st.session_state.file_buffer.restore()
+    for item in st.session_state.scratchpad.of_type("chart").values():
+        if "image_blob" in item.content:
+            get_blob_store().touch(item.content["image_blob"], session_id)
+    # An idle session reloading its own history still holds its chart data
+    if session_id != previous_session_id:
+        restore_frames(store, session_id)
+    st.session_state.current_scratchpad_item = None
+    st.session_state["edit_mode"] = False
+    st.query_params["session"] = session_id
+
+# Resume the session named in the URL, or start a new one
+if 'session_id' not in st.session_state:
+    requested_session = st.query_params.get("session")
+    if requested_session and get_storage().session_exists(requested_session):
+        load_session(requested_session)
+    else:
+        st.session_state.session_id = uuid.uuid4().hex
+        if get_storage().persistent:
+            st.query_params["session"] = st.session_state.session_id
+
+# A session evicted while idle to free memory reloads its history from storage
+def reload_evicted_session():
+    if st.session_state.get("evicted"):
+        del st.session_state["evicted"]
+        load_session(st.session_state.session_id)
+        st.toast("This session was idle and unloaded to free memory; its history has been reloaded.")
+
+reload_evicted_session()
+
 # Initialize session state
 if 'messages' not in st.session_state:
     st.session_state.messages = []
+if 'search_index' not in st.session_state:
+    st.session_state.search_index = SearchIndex()
 if 'scratchpad' not in st.session_state:
-    st.session_state.scratchpad = {}
+    st.session_state.scratchpad = Scratchpad(get_storage(), st.session_state.session_id, st.session_state.search_index)
 if 'current_scratchpad_item' not in st.session_state:
     st.session_state.current_scratchpad_item = None
 if 'file_buffer' not in st.session_state:
-    st.session_state.file_buffer = {}
+    st.session_state.file_buffer = UploadStore(get_blob_store(), st.session_state.session_id, get_storage())
 if 'api_key' not in st.session_state:
     st.session_state.api_key = ""
 if 'scratchpad_visible' not in st.session_state:
     st.session_state.scratchpad_visible = True
 if 'chart_data' not in st.session_state:
     st.session_state.chart_data = None
+if 'chart_data_memory' not in st.session_state:
+    st.session_state.chart_data_memory = 0
+if 'chart_data_source' not in st.session_state:
+    st.session_state.chart_data_source = None
+if 'csv_cache' not in st.session_state:
+    st.session_state.csv_cache = {}
+if 'csv_uploads' not in st.session_state:
+    st.session_state.csv_uploads = {}
+if 'chart_sources' not in st.session_state:
+    st.session_state.chart_sources = {}
+if 'full_res_charts' not in st.session_state:
+    st.session_state.full_res_charts = set()
+if 'last_ttft' not in st.session_state:
+    st.session_state.last_ttft = None
+if 'last_usage' not in st.session_state:
+    st.session_state.last_usage = None
+if 'last_cache_hit' not in st.session_state:
+    st.session_state.last_cache_hit = False
+if 'last_turn' not in st.session_state:
+    st.session_state.last_turn = None
+if 'last_rerun' not in st.session_state:
+    st.session_state.last_rerun = None
+if 'last_comparison' not in st.session_state:
+    st.session_state.last_comparison = None
+if 'message_html_cache' not in st.session_state:
+    st.session_state.message_html_cache = {}
+if 'next_message_id' not in st.session_state:
+    st.session_state.next_message_id = len(st.session_state.messages)
+    # Give messages from before ids existed a stable id
+    for i, msg in enumerate(st.session_state.messages):
+        msg.setdefault("id", i)
+if 'transcript_turns' not in st.session_state:
+    st.session_state.transcript_turns = TRANSCRIPT_PAGE_TURNS
+if 'token_count_cache' not in st.session_state:
+    st.session_state.token_count_cache = {}
+if 'memory_handle' not in st.session_state:
+    st.session_state.memory_handle = SessionHandle()
 
-# Function to create and save charts based on data
-def create_chart(data, chart_type):
-    try:
-        plt.figure(figsize=(10, 6))
+# Mark this session as active before anything slow happens in the run
+get_session_registry().begin_run(st.session_state.session_id, st.session_state.memory_handle)
+
+# Stable fingerprint of a dataframe's contents, used to key the chart render cache
+def dataframe_fingerprint(data):
+    digest = hashlib.sha256()
+    digest.update(repr(list(zip(data.columns, data.dtypes.astype(str)))).encode('utf-8'))
+    pd = timed_import("pandas")
+    digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return digest.hexdigest()
+
+# Draw one chart type onto the given axes
+def draw_chart(fig, ax, data, chart_type):
+    if chart_type == "Line Chart":
+        for column in data.select_dtypes(include=['number']).columns:
+            if column != 'date':
+                ax.plot(data['date'] if 'date' in data.columns else range(len(data)), 
+                        data[column], label=column)
+        ax.legend()
+        ax.set_title("Line Chart")
+        ax.set_xlabel("Date" if 'date' in data.columns else "Index")
+        ax.set_ylabel("Value")
+        ax.grid(True, linestyle='--', alpha=0.7)
+        fig.tight_layout()
         
-        if chart_type == "Line Chart":
-            plt.figure(figsize=(10, 6))
-            for column in data.select_dtypes(include=['int64', 'float64']).columns:
-                if column != 'date':
-                    plt.plot(data['date'] if 'date' in data.columns else range(len(data)), 
-                             data[column], label=column)
-            plt.legend()
-            plt.title("Line Chart")
-            plt.xlabel("Date" if 'date' in data.columns else "Index")
-            plt.ylabel("Value")
-            plt.grid(True, linestyle='--', alpha=0.7)
-            plt.tight_layout()
+    elif chart_type == "Bar Chart":
+        # Use the first categorical column for grouping if available
+        categorical_cols = data.select_dtypes(include=['object', 'category']).columns
+        if len(categorical_cols) > 0:
+            category_col = categorical_cols[0]
+            numeric_cols = data.select_dtypes(include=['number']).columns
+            if len(numeric_cols) > 0:
+                value_col = numeric_cols[0]
+                grouped_data = data.groupby(category_col, observed=True)[value_col].mean().reset_index()
+                ax.bar(grouped_data[category_col], grouped_data[value_col])
+                ax.set_title(f"Average {value_col} by {category_col}")
+                ax.set_xlabel(category_col)
+                ax.set_ylabel(f"Average {value_col}")
+        else:
+            # If no categorical column, use the first numeric column
+            numeric_cols = data.select_dtypes(include=['number']).columns
+            if len(numeric_cols) > 0:
+                ax.bar(range(len(data)), data[numeric_cols[0]])
+                ax.set_title(f"Bar Chart of {numeric_cols[0]}")
+                ax.set_xlabel("Index")
+                ax.set_ylabel(numeric_cols[0])
+        
+    elif chart_type == "Scatter Plot":
+        numeric_cols = data.select_dtypes(include=['number']).columns
+        if len(numeric_cols) >= 2:
+            x_col, y_col = numeric_cols[0], numeric_cols[1]
+            categorical_cols = data.select_dtypes(include=['object', 'category']).columns
             
-        elif chart_type == "Bar Chart":
-            # Use the first categorical column for grouping if available
-            categorical_cols = data.select_dtypes(include=['object']).columns
             if len(categorical_cols) > 0:
+                # Color by category if available
                 category_col = categorical_cols[0]
-                numeric_cols = data.select_dtypes(include=['int64', 'float64']).columns
-                if len(numeric_cols) > 0:
-                    value_col = numeric_cols[0]
-                    grouped_data = data.groupby(category_col)[value_col].mean().reset_index()
-                    plt.bar(grouped_data[category_col], grouped_data[value_col])
-                    plt.title(f"Average {value_col} by {category_col}")
-                    plt.xlabel(category_col)
-                    plt.ylabel(f"Average {value_col}")
+                categories = data[category_col].unique()
+                for category in categories:
+                    subset = data[data[category_col] == category]
+                    ax.scatter(subset[x_col], subset[y_col], label=category, alpha=0.7)
+                ax.legend()
             else:
-                # If no categorical column, use the first numeric column
-                numeric_cols = data.select_dtypes(include=['int64', 'float64']).columns
-                if len(numeric_cols) > 0:
-                    plt.bar(range(len(data)), data[numeric_cols[0]])
-                    plt.title(f"Bar Chart of {numeric_cols[0]}")
-                    plt.xlabel("Index")
-                    plt.ylabel(numeric_cols[0])
+                ax.scatter(data[x_col], data[y_col], alpha=0.7)
             
-        elif chart_type == "Scatter Plot":
-            numeric_cols = data.select_dtypes(include=['int64', 'float64']).columns
-            if len(numeric_cols) >= 2:
-                x_col, y_col = numeric_cols[0], numeric_cols[1]
-                categorical_cols = data.select_dtypes(include=['object']).columns
-                
-                if len(categorical_cols) > 0:
-                    # Color by category if available
-                    category_col = categorical_cols[0]
-                    categories = data[category_col].unique()
-                    for category in categories:
-                        subset = data[data[category_col] == category]
-                        plt.scatter(subset[x_col], subset[y_col], label=category, alpha=0.7)
-                    plt.legend()
-                else:
-                    plt.scatter(data[x_col], data[y_col], alpha=0.7)
-                
-                plt.title(f"Scatter Plot: {y_col} vs {x_col}")
-                plt.xlabel(x_col)
-                plt.ylabel(y_col)
-                plt.grid(True, linestyle='--', alpha=0.3)
-            
-        elif chart_type == "Pie Chart":
-            categorical_cols = data.select_dtypes(include=['object']).columns
-            if len(categorical_cols) > 0:
-                category_col = categorical_cols[0]
+            ax.set_title(f"Scatter Plot: {y_col} vs {x_col}")
+            ax.set_xlabel(x_col)
+            ax.set_ylabel(y_col)
+            ax.grid(True, linestyle='--', alpha=0.3)
+        
+    elif chart_type == "Pie Chart":
+        categorical_cols = data.select_dtypes(include=['object', 'category']).columns
+        if len(categorical_cols) > 0:
+            category_col = categorical_cols[0]
+            # Pre-aggregated frames from downsample_for_chart already hold the counts
+            count_column = data.attrs.get("count_column")
+            if count_column:
+                count_data = data.set_index(category_col)[count_column]
+            else:
                 count_data = data[category_col].value_counts()
-                plt.pie(count_data, labels=count_data.index, autopct='%1.1f%%', 
-                        shadow=True, startangle=90)
-                plt.axis('equal')
-                plt.title(f"Distribution of {category_col}")
-            
-        elif chart_type == "Heatmap":
-            numeric_data = data.select_dtypes(include=['int64', 'float64'])
-            if not numeric_data.empty:
-                corr = numeric_data.corr()
-                sns.heatmap(corr, annot=True, cmap='coolwarm', linewidths=0.5)
-                plt.title("Correlation Heatmap")
-                plt.tight_layout()
+                count_data = count_data[count_data > 0]
+            ax.pie(count_data, labels=count_data.index, autopct='%1.1f%%', 
+                   shadow=True, startangle=90)
+            ax.axis('equal')
+            ax.set_title(f"Distribution of {category_col}")
         
-        # Save the figure to a BytesIO object
+    elif chart_type == "Heatmap":
+        numeric_data = data.select_dtypes(include=['number'])
+        if not numeric_data.empty:
+            corr = numeric_data.corr()
+            sns = timed_import("seaborn")
+            sns.heatmap(corr, annot=True, cmap='coolwarm', linewidths=0.5, ax=ax)
+            ax.set_title("Correlation Heatmap")
+            fig.tight_layout()
+
+# Render a chart to PNG bytes. Results are cached across reruns and sessions by
+# (data fingerprint, chart type, size, dpi); the dataframe itself is not hashed.
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def render_chart_png(_data, fingerprint, chart_type, size, dpi):
+    timed_import("matplotlib").use("Agg")
+    # A bare Figure on the Agg canvas stays out of pyplot's global registry
+    fig = timed_import("matplotlib.figure").Figure(figsize=size)
+    timed_import("matplotlib.backends.backend_agg").FigureCanvasAgg(fig)
+    try:
+        ax = fig.add_subplot()
+        draw_chart(fig, ax, _data, chart_type)
         buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-        buf.seek(0)
+        fig.savefig(buf, format='png', dpi=dpi, bbox_inches='tight')
+        return buf.getvalue()
+    finally:
+        fig.clear()
+
+# Full-resolution PNG for a chart saved in the scratchpad, rendered on demand
+def render_full_chart(chart_content):
+    data = load_frame(get_blob_store(), st.session_state.chart_sources.get(chart_content.get("fingerprint")))
+    if data is None:
+        return None
+    return render_chart_png(data, chart_content["fingerprint"], chart_content["type"],
+                            tuple(chart_content["size"]), CHART_FULL_DPI)
+
+# Drop chart source data that no scratchpad chart refers to any more
+def prune_chart_sources():
+    referenced = {item.content.get("fingerprint") for item in st.session_state.scratchpad.of_type("chart").values()}
+    for fingerprint in [k for k in st.session_state.chart_sources if k not in referenced]:
+        release_spilled_frame(st.session_state.chart_sources.pop(fingerprint))
+        get_storage().delete_frame(st.session_state.session_id, f"source:{fingerprint}")
+
+# Unpin the blob behind a frame that was moved to disk, once neither the chart
+# data nor a chart source still uses it. Identical frames share a blob.
+def release_spilled_frame(frame):
+    if not isinstance(frame, SpilledFrame):
+        return
+    holders = [st.session_state.chart_data, *st.session_state.chart_sources.values()]
+    if not any(isinstance(held, SpilledFrame) and held.blob_hash == frame.blob_hash for held in holders):
+        get_blob_store().release(st.session_state.session_id, [frame.blob_hash])
+
+# Original vs rendered row counts for a chart
+def describe_downsampling(info):
+    if info["method"] == "none":
+        return f"{info['rendered_rows']:,} rows plotted"
+    return f"{info['rendered_rows']:,} of {info['original_rows']:,} rows plotted ({info['method']})"
+
+# Function to create and save charts based on data
+def create_chart(data, chart_type):
+    try:
+        # Reduce large frames to what the chart can show before drawing anything
+        plot_data, downsample_info = timed_import("downsampling").downsample_for_chart(data, chart_type)
+        fingerprint = dataframe_fingerprint(plot_data)
+        
+        # Only a small thumbnail is stored; the full render is made when asked for
+        thumbnail = render_chart_png(plot_data, fingerprint, chart_type, CHART_SIZE, CHART_THUMBNAIL_DPI)
+        st.session_state.chart_sources[fingerprint] = persist_frame(f"source:{fingerprint}", plot_data)
+        point_summary = describe_downsampling(downsample_info)
         
         # Add to scratchpad
         chart_name = f"chart_{datetime.now().strftime('%Y%m%d%H%M%S')}"
         
-        # Convert to base64 for storage
-        img_str = base64.b64encode(buf.read()).decode('utf-8')
+        # The PNG goes to the blob store; the item keeps its hash
+        image_blob = get_blob_store().put(thumbnail, st.session_state.session_id)
         
         add_to_scratchpad(chart_name, "chart", {
             "type": chart_type,
-            "image_data": img_str,
-            "description": f"{chart_type} created on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            "image_blob": image_blob,
+            "fingerprint": fingerprint,
+            "size": CHART_SIZE,
+            "downsampling": downsample_info,
+            "description": f"{chart_type} created on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} · {point_summary}"
         })
         
-        st.success(f"Chart '{chart_name}' added to scratchpad")
+        st.success(f"Chart '{chart_name}' added to scratchpad ({point_summary})")
         return True
         
     except Exception as e:
         st.error(f"Error creating chart: {str(e)}")
         return False
 
+# Release chart images that no remaining chart uses
+def release_chart_images(removed_items):
+    remaining = {item.content.get("image_blob") for item in st.session_state.scratchpad.of_type("chart").values()}
+    released = [item.content.get("image_blob") for item in removed_items]
+    get_blob_store().release(st.session_state.session_id,
+                             [blob_hash for blob_hash in released if blob_hash and blob_hash not in remaining])
+
+# Human-readable byte count
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} {unit}"
+        size /= 1024
+
+# With persistent storage, a chart frame goes to the blob store as soon as it is
+# set and is saved under name, so it survives a restart. Returns what session
+# state keeps: the spilled frame, or the data itself when storage is not
+# persistent or the blob store has no room.
+def persist_frame(name, data, memory_bytes=None, source=None):
+    store = get_storage()
+    if not store.persistent:
+        return data
+    try:
+        frame = spill_frame(get_blob_store(), st.session_state.session_id, data, memory_bytes)
+    except BlobStoreFull:
+        store.delete_frame(st.session_state.session_id, name)
+        return data
+    store.save_frame(st.session_state.session_id, name, {
+        "blob_hash": frame.blob_hash,
+        "rows": frame.rows,
+        "columns": frame.columns,
+        "memory_bytes": frame.memory_bytes,
+        "source": source
+    })
+    return frame
+
+# Replace the data used by the visualization tools, recording its memory
+# footprint and, for CSV imports, the load it came from
+def set_chart_data(data, memory_bytes=None, source=None):
+    if memory_bytes is None:
+        memory_bytes = int(data.memory_usage(deep=True).sum())
+    previous = st.session_state.chart_data
+    st.session_state.chart_data = persist_frame("chart_data", data, memory_bytes, source)
+    release_spilled_frame(previous)
+    st.session_state.chart_data_memory = memory_bytes
+    st.session_state.chart_data_source = source
+    # Measure the session again on the next rerun
+    st.session_state.pop("memory_sample", None)
+
+# The data for the visualization tools, read back from disk if it was moved
+# there to stay within the memory budget
+def get_chart_data():
+    data = load_frame(get_blob_store(), st.session_state.chart_data)
+    if data is None and st.session_state.chart_data is not None:
+        st.warning("The chart data moved to disk is no longer available. Please load it again.")
+        st.session_state.chart_data = None
+        st.session_state.chart_data_source = None
+        get_storage().delete_frame(st.session_state.session_id, "chart_data")
+    return data
+
+# Content hash and column names of an uploaded CSV, computed once per upload
+# rather than on every rerun
+def csv_upload_info(uploaded_csv):
+    upload_id = getattr(uploaded_csv, "file_id", None) or uploaded_csv.name
+    if upload_id not in st.session_state.csv_uploads:
+        uploaded_csv.seek(0)
+        st.session_state.csv_uploads = {upload_id: {
+            "hash": hashlib.sha256(uploaded_csv.getvalue()).hexdigest(),
+            "columns": list(timed_import("pandas").read_csv(uploaded_csv, nrows=0).columns)
+        }}
+    info = st.session_state.csv_uploads[upload_id]
+    return info["hash"], info["columns"]
+
+# Text columns whose sample has few distinct values are stored as categories
+def infer_category_columns(sample):
+    columns = []
+    for column in sample.select_dtypes(include=['object']).columns:
+        unique = sample[column].nunique()
+        if unique <= CSV_CATEGORY_MAX_UNIQUE and unique <= CSV_CATEGORY_MAX_RATIO * max(len(sample), 1):
+            columns.append(column)
+    return columns
+
+# Narrow a parsed chunk's numbers: integers to the smallest type that holds
+# them, floats to float32 only when every value round-trips exactly. This runs
+# after parsing because the parser wraps integers that overflow a narrow type
+# and rounds or overflows floats without an error.
+def narrow_chunk(chunk):
+    pd = timed_import("pandas")
+    for column in chunk.select_dtypes(include=['integer']).columns:
+        chunk[column] = pd.to_numeric(chunk[column], downcast='integer')
+    for column in chunk.select_dtypes(include=['float64']).columns:
+        values = chunk[column]
+        with np.errstate(over='ignore'):
+            narrowed = values.astype('float32')
+        finite = values.isna() | np.isfinite(narrowed)
+        if finite.all() and narrowed.astype('float64').equals(values):
+            chunk[column] = narrowed
+    return chunk
+
+# dtype= map for parsing a CSV: categories where the sample allows. Numbers are
+# narrowed per chunk instead, see narrow_chunk.
+def infer_csv_dtypes(sample, categorize=True):
+    if not categorize:
+        return {}
+    return {column: 'category' for column in infer_category_columns(sample)}
+
+# Parse an uploaded CSV chunk by chunk with the given dtypes. Chunks whose
+# numbers narrow differently are combined at the wider type.
+def read_csv_chunks(uploaded_csv, columns, dtypes, progress):
+    pd = timed_import("pandas")
+    uploaded_csv.seek(0)
+    total_size = max(uploaded_csv.size, 1)
+    chunks = []
+    for chunk in pd.read_csv(uploaded_csv, usecols=columns, dtype=dtypes, chunksize=CSV_CHUNK_ROWS):
+        chunks.append(narrow_chunk(chunk))
+        progress.progress(min(uploaded_csv.tell() / total_size, 1.0), text=f"Parsing {uploaded_csv.name}...")
+    return chunks
+
+# Parse an uploaded CSV in chunks, cached by content hash and load options.
+# Returns the frame and its memory footprint in bytes.
+def load_csv(uploaded_csv, content_hash, columns, categorize=True):
+    cache = st.session_state.csv_cache
+    key = (content_hash, tuple(columns), categorize)
+    if key in cache:
+        # Move to the end so the least recently used file is evicted first
+        cache[key] = cache.pop(key)
+        return cache[key]
+
+    pd = timed_import("pandas")
+    uploaded_csv.seek(0)
+    sample = pd.read_csv(uploaded_csv, usecols=columns, nrows=CSV_SAMPLE_ROWS)
+    dtypes = infer_csv_dtypes(sample, categorize)
+    category_columns = list(dtypes)
+
+    progress = st.progress(0.0, text=f"Parsing {uploaded_csv.name}...")
+    chunks = read_csv_chunks(uploaded_csv, columns, dtypes, progress)
+    progress.empty()
+
+    if not chunks:
+        data = sample
+    else:
+        # Combine category columns with union_categoricals; a plain concat of
+        # categoricals with different categories would fall back to object
+        categories = {column: pd.api.types.union_categoricals([chunk[column] for chunk in chunks], ignore_order=True)
+                      for column in category_columns}
+        data = pd.concat([chunk.drop(columns=category_columns) for chunk in chunks], ignore_index=True)
+        for column in category_columns:
+            data[column] = categories[column]
+        data = data[list(sample.columns)]
+
+    result = (data, int(data.memory_usage(deep=True).sum()))
+    cache[key] = result
+    for old_key in list(cache)[:-CSV_CACHE_ENTRIES]:
+        del cache[old_key]
+    return result
+
 # Function to handle file uploads and encode them
 def handle_uploaded_file(uploaded_file):
     if uploaded_file is None:
         return None
     
-    # Save file to session state buffer
-    file_id = f"{uploaded_file.name}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    
-    # Read the file
-    file_bytes = uploaded_file.getvalue()
-    
-    # Handle different file types
-    file_type = uploaded_file.type
-    file_data = {
-        "name": uploaded_file.name,
-        "type": file_type,
-        "size": len(file_bytes),
-        "data": base64.b64encode(file_bytes).decode('utf-8'),
-        "display_data": None
-    }
-    
-    # For images, create display data
-    if file_type.startswith('image/'):
-        file_data["display_data"] = file_bytes
-    
-    # For text files, decode the content
-    if file_type == 'text/plain' or file_type == 'text/csv' or 'json' in file_type:
-        try:
-            file_data["text_content"] = file_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            file_data["text_content"] = None
-    
-    # Store in session state
-    st.session_state.file_buffer[file_id] = file_data
+    try:
+        file_id = st.session_state.file_buffer.add(uploaded_file)
+    except BlobStoreFull as e:
+        st.error(f"Could not store {uploaded_file.name}: {str(e)}")
+        return None
+    attachment_extraction(file_id)
     return file_id
 
-def create_claude_message(message_text, file_ids=None):
-    if not file_ids:
-        return {"role": "user", "content": message_text}
-    
-    message_content = [{"type": "text", "text": message_text}]
-    
+# Extraction result for a PDF, XLSX or image attachment, starting the work if it has not
+# run yet. None for files that are sent as they are.
+def attachment_extraction(file_id):
+    file_data = st.session_state.file_buffer[file_id]
+    if not needs_extraction(file_data["type"], file_data["name"]):
+        return None
+    extractor = get_extractor()
+    result = extractor.result(file_id)
+    if result is None:
+        blobs = st.session_state.file_buffer.blobs
+        extractor.submit(file_id, file_data["type"], file_data["name"], functools.partial(blobs.read, file_id))
+        result = extractor.result(file_id)
+    return result
+
+# One line per attached file, with its extraction progress: a bar for PDFs and
+# workbooks once pages or sheets are being read
+def render_attachment_list(file_ids):
+    st.write("Files attached:")
+    pending = False
     for file_id in file_ids:
-        if file_id in st.session_state.file_buffer:
-            file_data = st.session_state.file_buffer[file_id]
-            
-            # For images, add as image type
-            if file_data['type'].startswith('image/'):
-                message_content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": file_data['type'],
-                        "data": file_data['data']
-                    }
-                })
-            # For text files, include content as text
-            elif 'text_content' in file_data and file_data['text_content']:
-                message_content.append({
-                    "type": "text",
-                    "text": f"\n\nFile: {file_data['name']}\n\n{file_data['text_content']}"
-                })
-            # For other files that could not be directly processed, notify in the message
-            else:
-                message_content.append({
-                    "type": "text",
-                    "text": f"\n\nFile attached: {file_data['name']} (size: {file_data['size']} bytes, type: {file_data['type']})"
-                })
-    
-    return {"role": "user", "content": message_content}
+        file_data = st.session_state.file_buffer[file_id]
+        extraction = attachment_extraction(file_id)
+        status = f" · {extraction['summary']}" if extraction else ""
+        if extraction and "sent_bytes" in extraction:
+            status += f", {format_bytes(extraction['original_bytes'])} → {format_bytes(extraction['sent_bytes'])} sent"
+        pending = pending or (extraction is not None and extraction["status"] == "pending")
+        st.write(f"- {file_data['name']} ({format_bytes(file_data['size'])}){status}")
+        if extraction and extraction.get("progress"):
+            done, total, _ = extraction["progress"]
+            st.progress(min(done / total, 1.0))
+    if pending:
+        st.caption("Files still being processed are sent as a placeholder, or as uploaded for images, if you send now.")
 
-# Function to parse and extract code from Claude's responses
-def extract_code_blocks(text):
-    # Improved regex pattern to better match code blocks
-    code_pattern = r'```([\w\+\#\-\.]*)\s*\n(.*?)```'
-    matches = re.findall(code_pattern, text, re.DOTALL)
-    
-    code_blocks = []
-    for lang, code in matches:
-        # Default to text if language is empty, otherwise clean up language name
-        language = lang.strip().lower() if lang.strip() else "text"
-        # Map common language aliases
-        if language in ["py", "python3"]:
-            language = "python"
-        elif language in ["js", "jsx"]:
-            language = "javascript"
-        elif language in ["ts", "typescript"]:
-            language = "typescript"
-        
-        code_blocks.append({
-            "language": language,
-            "code": code.strip()
-        })
-    
-    return code_blocks
+# Attachment list that refreshes itself while extraction is running, then
+# hands back to a normal rerun once every file is ready
+@st.fragment(run_every=EXTRACTION_POLL_SECONDS)
+def poll_attachment_list(file_ids):
+    render_attachment_list(file_ids)
+    if not any(extraction_pending(file_id) for file_id in file_ids):
+        st.rerun()
 
-# Function to extract tables from responses
-def extract_tables(text):
-    # Improved markdown table pattern with better matching
-    table_pattern = r'(\|.*\|.*\n\|[-:| ]+\|\n(?:\|.*\|.*\n)+)'
-    matches = re.findall(table_pattern, text, re.DOTALL)
-    
-    tables = []
-    for table_text in matches:
-        tables.append(table_text.strip())
-    
-    return tables
+def extraction_pending(file_id):
+    extraction = attachment_extraction(file_id)
+    return extraction is not None and extraction["status"] == "pending"
+
+# File ids still referenced by messages in the chat history
+def message_file_ids():
+    file_ids = set()
+    for msg in st.session_state.messages:
+        file_ids.update(msg.get("file_ids", []))
+    return file_ids
+
+def create_claude_message(message_text, file_ids=None):
+    file_store = st.session_state.file_buffer
+    attachments = []
+    for file_id in file_ids or []:
+        if file_id in file_store:
+            file_data = file_store[file_id]
+            attachments.append({
+                "name": file_data["name"],
+                "type": file_data["type"],
+                "size": file_data["size"],
+                "extraction": attachment_extraction(file_id),
+                "base64": functools.partial(file_store.base64, file_id),
+                "text": functools.partial(file_store.text, file_id)
+            })
+    return build_user_message(message_text, attachments)
+
+# The chat history as API messages. The newest user message goes with its
+# attachments; so do the first pinned messages, so that they are sent the same
+# way every turn and stay in the prompt cache. Older messages go as text.
+def history_for_api(claude_message, pinned=0):
+    messages = st.session_state.messages
+    api_messages = []
+    for i, msg in enumerate(messages):
+        if i == len(messages) - 1 and msg["role"] == "user":
+            api_messages.append(claude_message)
+        elif i < pinned and msg.get("file_ids"):
+            api_messages.append(create_claude_message(msg["content"], msg["file_ids"]))
+        else:
+            api_messages.append({"role": msg["role"], "content": msg["content"]})
+    return api_messages
 
 # Add new item to scratchpad
 def add_to_scratchpad(name, content_type, content):
@@ -337,56 +1187,572 @@ def add_to_scratchpad(name, content_type, content):
     if not clean_name:
         clean_name = f"{content_type}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
     
-    if clean_name in st.session_state.scratchpad:
-        # Increment name if it already exists
-        count = 1
-        new_name = f"{clean_name}_{count}"
-        while new_name in st.session_state.scratchpad:
-            count += 1
-            new_name = f"{clean_name}_{count}"
-        clean_name = new_name
-    
-    # Add the item to the scratchpad
-    st.session_state.scratchpad[clean_name] = {
-        "type": content_type,
-        "content": content,
-        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    
-    # Log to console for debugging
-    print(f"Added to scratchpad: {clean_name} ({content_type})")
+    # Add the item to the scratchpad under a name no other item uses
+    item = st.session_state.scratchpad.add(
+        clean_name,
+        content_type,
+        content,
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+
+    get_metrics().inc("claude_ui_scratchpad_items_total", {"type": content_type})
     
-    return clean_name
+    return item.name
+
+# Page picker for one scratchpad section; returns the items on the chosen page
+def scratchpad_section_page(group):
+    total = len(st.session_state.scratchpad.of_type(group))
+    pages = max(1, -(-total // SCRATCHPAD_PAGE_SIZE))
+    page = 1
+    if pages > 1:
+        key = f"scratchpad_page_{group}"
+        # Deleting items can leave the remembered page past the end
+        if st.session_state.get(key, 1) > pages:
+            st.session_state[key] = pages
+        page = st.number_input(f"Page (of {pages}, newest first)", min_value=1, max_value=pages, value=1, key=key)
+    return st.session_state.scratchpad.page(group, page - 1, SCRATCHPAD_PAGE_SIZE)
+
+# Process-wide pool of Anthropic clients, one per (API key, base URL)
+class ClientPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, api_key, base_url=None):
+        key = (api_key, base_url)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = {"client": self._create_client(api_key, base_url), "last_used": now}
+                self._clients[key] = entry
+            entry["last_used"] = now
+            return entry["client"]
+
+    def _create_client(self, api_key, base_url):
+        # One keep-alive connection pool per client so TLS sessions are reused across turns
+        anthropic = timed_import("anthropic")
+        http_client = anthropic.DefaultHttpxClient(
+            limits=timed_import("httpx").Limits(
+                max_connections=CLIENT_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_MAX_KEEPALIVE,
+                keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY
+            )
+        )
+        kwargs = {
+            "api_key": api_key,
+            "http_client": http_client,
+            "timeout": anthropic.Timeout(CLIENT_READ_TIMEOUT, connect=CLIENT_CONNECT_TIMEOUT),
+            # Retries go through the request scheduler, which spaces them out across sessions
+            "max_retries": 0
+        }
+        if base_url:
+            kwargs["base_url"] = base_url
+        return anthropic.Anthropic(**kwargs)
+
+    def _evict_idle(self, now):
+        expired = [k for k, v in self._clients.items() if now - v["last_used"] > CLIENT_IDLE_EVICTION]
+        for key in expired:
+            entry = self._clients.pop(key)
+            try:
+                entry["client"].close()
+            except Exception as e:
+                get_metrics().event("client_close_error", error=str(e))
+
+    def size(self):
+        with self._lock:
+            return len(self._clients)
+
+@st.cache_resource
+def get_client_pool():
+    return ClientPool()
+
+# Get the shared client for the current API key
+def get_claude_client(api_key):
+    return get_client_pool().get(api_key, ANTHROPIC_BASE_URL)
+
+# Queue and rate limits in front of the API, shared by every session in the process
+@st.cache_resource
+def get_request_scheduler():
+    return RequestScheduler(API_REQUESTS_PER_MINUTE, API_INPUT_TOKENS_PER_MINUTE, API_MAX_RETRIES,
+                            API_RETRY_BASE_SECONDS, API_RETRY_MAX_SECONDS)
+
+# Status text for a request waiting its turn
+def describe_wait(position, wait):
+    if position:
+        return f"Waiting for the API... {position} request(s) ahead in the queue"
+    return f"Waiting for the API rate limit... about {wait:.0f}s"
+
+# Status text for a failed request about to be retried
+def describe_retry(attempt, delay, error):
+    return (f"The API returned {getattr(error, 'status_code', 'an error')}; "
+            f"retrying in {delay:.0f}s (attempt {attempt} of {API_MAX_RETRIES})")
+
+# Input tokens a response counted against the rate limit
+def rate_limited_tokens(response):
+    usage = usage_summary(response)
+    return usage["input_tokens"] + usage["cache_creation_input_tokens"] if usage else None
+
+# Count a retry, and show it in the status box if there is one
+def note_retry(status, attempt, delay, error):
+    get_metrics().inc("claude_ui_api_retries_total", {"status": str(getattr(error, "status_code", ""))})
+    if status is not None:
+        status.update(label=describe_retry(attempt, delay, error))
+
+# Send a request with fn() once the scheduler gives this session a turn,
+# showing the queue position and any retries in status
+def send_scheduled(params, fn, status=None, can_retry=None):
+    scheduler = get_request_scheduler()
+    tokens = estimate_request_tokens(params)
+    response = scheduler.run(
+        st.session_state.session_id,
+        tokens,
+        fn,
+        on_wait=(lambda position, wait: status.update(label=describe_wait(position, wait))) if status is not None else None,
+        on_retry=functools.partial(note_retry, status),
+        can_retry=can_retry
+    )
+    scheduler.settle(tokens, rate_limited_tokens(response))
+    if status is not None:
+        status.update(label="Claude is thinking...")
+    return response
 
 # Function to call Claude API
-def query_claude(messages, model, system_prompt, temperature, max_tokens):
+def query_claude(messages, model, system_prompt, temperature, max_tokens, prompt_caching=True, use_cache=False, status=None, stable_prefix=None):
     if not st.session_state.api_key:
         st.error("Please enter your Anthropic API Key in the sidebar")
         return None
     
     try:
-        # Initialize Anthropic client with only the API key
-        client = anthropic.Anthropic(api_key=st.session_state.api_key)
+        params = request_params(messages, model, system_prompt, temperature, max_tokens, prompt_caching, stable_prefix)
+
+        # An identical earlier request answers without calling the API
+        cache_key = request_key(params, tenant_key(st.session_state.api_key, ANTHROPIC_BASE_URL)) if use_cache else None
+        if cache_key:
+            entry = get_response_cache().get(cache_key)
+            if entry is not None:
+                return cached_message(entry)
+
+        # Reuse the pooled client so keep-alive connections survive between turns
+        client = get_claude_client(st.session_state.api_key)
         
-        # Call the messages API
-        response = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            system=system_prompt,
-            messages=messages
-        )
+        # Call the messages API when the scheduler allows
+        response = send_scheduled(params, functools.partial(client.messages.create, **params), status)
+
+        if cache_key:
+            get_response_cache().put(cache_key, response)
         
         return response
     except Exception as e:
         st.error(f"Error calling Claude API: {str(e)}")
         return None
 
+# Build the HTML bubble for one chat message
+def format_message_html(role, content, cached=False):
+    if role == "user":
+        return f'''
+                <div class="user-message">
+                    <strong>You:</strong><br>
+                    {content}
+                </div>
+                '''
+    return f'''
+                <div class="assistant-message">
+                    <strong>Claude{" (from response cache)" if cached else ""}:</strong><br>
+                    {content}
+                </div>
+                '''
+
+# Rendered HTML for a stored message, cached by message id
+def get_message_html(msg):
+    cache = st.session_state.message_html_cache
+    html = cache.get(msg["id"])
+    if html is None:
+        html = format_message_html(msg["role"], msg["content"], msg.get("cached", False))
+        cache[msg["id"]] = html
+    return html
+
+# Append a message to the chat history with a stable id
+def append_message(role, content, **extra):
+    message = {"id": st.session_state.next_message_id, "role": role, "content": content}
+    message.update(extra)
+    st.session_state.next_message_id += 1
+    st.session_state.messages.append(message)
+    index_message(st.session_state.search_index, message)
+    get_storage().save_message(st.session_state.session_id, message)
+    return message
+
+# Clear the chat history along with its render cache
+def reset_messages():
+    st.session_state.messages = []
+    st.session_state.search_index.clear(["message"])
+    get_storage().clear_messages(st.session_state.session_id)
+    st.session_state.message_html_cache = {}
+    st.session_state.transcript_turns = TRANSCRIPT_PAGE_TURNS
+
+# Render the assistant bubble used while a response is streaming in
+def render_assistant_bubble(placeholder, text, cached=False):
+    placeholder.markdown(
+        f'<div class="chat-container">{format_message_html("assistant", text, cached)}</div>',
+        unsafe_allow_html=True
+    )
+
+# Function to call Claude API and render partial text as it arrives
+def stream_claude(messages, model, system_prompt, temperature, max_tokens, placeholder, status=None, prompt_caching=True, scanner=None, use_cache=False, stable_prefix=None):
+    if not st.session_state.api_key:
+        st.error("Please enter your Anthropic API Key in the sidebar")
+        return None, None
+
+    try:
+        params = request_params(messages, model, system_prompt, temperature, max_tokens, prompt_caching, stable_prefix)
+
+        cache_key = request_key(params, tenant_key(st.session_state.api_key, ANTHROPIC_BASE_URL)) if use_cache else None
+        if cache_key:
+            entry = get_response_cache().get(cache_key)
+            if entry is not None:
+                return replay_cached_stream(entry, placeholder, status, scanner)
+
+        client = get_claude_client(st.session_state.api_key)
+        progress = {"text": "", "ttft": None, "artifacts": []}
+        # Once part of the reply is on screen a failure is not retried
+        response = send_scheduled(
+            params,
+            functools.partial(stream_attempt, client, params, placeholder, status, scanner, progress),
+            status,
+            can_retry=lambda: progress["ttft"] is None
+        )
+
+        render_assistant_bubble(placeholder, progress["text"])
+        # Only a finished reply leaves anything in the scratchpad
+        save_artifacts(progress["artifacts"])
+        if cache_key:
+            get_response_cache().put(cache_key, response)
+        return response, progress["ttft"]
+    except Exception as e:
+        st.error(f"Error calling Claude API: {str(e)}")
+        return None, None
+
+# One attempt at streaming a reply into the placeholder. The text so far, the
+# time to first token and the artifacts found so far are kept in progress.
+def stream_attempt(client, params, placeholder, status, scanner, progress):
+    start_time = time.perf_counter()
+    last_render = 0.0
+    with client.messages.stream(**params) as stream:
+        for chunk in stream.text_stream:
+            now = time.perf_counter()
+            if progress["ttft"] is None:
+                progress["ttft"] = now - start_time
+                if status is not None:
+                    status.update(label=f"Claude is responding... (first token after {progress['ttft']:.2f}s)")
+            progress["text"] += chunk
+            # Code blocks and tables are picked out as soon as they close
+            if scanner is not None:
+                progress["artifacts"].extend(scanner.feed(chunk))
+            # Throttle redraws so long answers don't resend the whole bubble per token
+            if now - last_render >= STREAM_RENDER_INTERVAL:
+                render_assistant_bubble(placeholder, progress["text"] + " ▌")
+                last_render = now
+        return stream.get_final_message()
+
+# Show a cached reply at once in the bubble a live stream uses, passing it
+# through the scanner in one piece. There is no time to first token to report.
+def replay_cached_stream(entry, placeholder, status=None, scanner=None):
+    text = entry["text"]
+    if scanner is not None:
+        save_artifacts(scanner.feed(text))
+    render_assistant_bubble(placeholder, text, cached=True)
+    return cached_message(entry), None
+
+# One attempt at streaming a model's reply onto a queue
+def stream_attempt_to_queue(client, model, params, events, progress):
+    progress["start"] = time.perf_counter()
+    with client.messages.stream(**params) as stream:
+        for chunk in stream.text_stream:
+            if progress["ttft"] is None:
+                progress["ttft"] = time.perf_counter() - progress["start"]
+            events.put((model, "delta", chunk))
+        return stream.get_final_message()
+
+# Stream one model's reply onto a queue, in turn with other requests. Runs on
+# a worker thread, so it must not call Streamlit; the script thread renders
+# what it puts on the queue, including queue position and retries.
+def stream_to_queue(client, model, params, events, scheduler, session_id):
+    progress = {"start": None, "ttft": None}
+    tokens = estimate_request_tokens(params)
+    try:
+        response = scheduler.run(
+            session_id,
+            tokens,
+            functools.partial(stream_attempt_to_queue, client, model, params, events, progress),
+            on_wait=lambda position, wait: events.put((model, "wait", describe_wait(position, wait))),
+            on_retry=lambda attempt, delay, error: events.put((model, "retry", (error, describe_retry(attempt, delay, error)))),
+            can_retry=lambda: progress["ttft"] is None
+        )
+        scheduler.settle(tokens, rate_limited_tokens(response))
+        events.put((model, "done", {"response": response, "ttft": progress["ttft"],
+                                    "latency": time.perf_counter() - progress["start"]}))
+    except Exception as e:
+        events.put((model, "error", str(e)))
+
+# Send the same messages to several models at once and stream each reply into
+# its own pane. Returns one result per model, in order.
+def run_model_comparison(messages, models, system_prompt, temperature, max_tokens, panes, prompt_caching=True, stable_prefix=None):
+    if not st.session_state.api_key:
+        st.error("Please enter your Anthropic API Key in the sidebar")
+        return None
+
+    client = get_claude_client(st.session_state.api_key)
+    events = queue.Queue()
+    for model in models:
+        params = request_params(messages, model, system_prompt, temperature, max_tokens, prompt_caching, stable_prefix)
+        threading.Thread(target=stream_to_queue, daemon=True,
+                         args=(client, model, params, events, get_request_scheduler(), st.session_state.session_id)).start()
+
+    results = {model: {"model": model, "text": "", "response": None, "ttft": None, "latency": None, "error": None}
+               for model in models}
+    remaining = set(models)
+    changed = set()
+    last_render = 0.0
+    while remaining:
+        try:
+            model, kind, payload = events.get(timeout=STREAM_RENDER_INTERVAL)
+            if kind == "delta":
+                results[model]["text"] += payload
+            elif kind == "wait":
+                panes[model]["stats"].caption(payload)
+                continue
+            elif kind == "retry":
+                get_metrics().inc("claude_ui_api_retries_total", {"status": str(getattr(payload[0], "status_code", ""))})
+                panes[model]["stats"].caption(payload[1])
+                continue
+            elif kind == "done":
+                results[model].update(payload)
+                remaining.discard(model)
+            else:
+                results[model]["error"] = payload
+                remaining.discard(model)
+            changed.add(model)
+        except queue.Empty:
+            pass
+        # Redraw changed panes at most once per interval
+        now = time.perf_counter()
+        if changed and (now - last_render >= STREAM_RENDER_INTERVAL or not remaining):
+            for model in changed:
+                render_assistant_bubble(panes[model]["text"], results[model]["text"] + (" ▌" if model in remaining else ""))
+            changed.clear()
+            last_render = now
+
+    summaries = []
+    for model in models:
+        summary = comparison_summary(results[model])
+        if summary["error"]:
+            panes[model]["stats"].error(summary["error"])
+        else:
+            panes[model]["stats"].caption(describe_comparison(summary))
+        summaries.append(dict(summary, response=results[model]["response"]))
+    return summaries
+
+# Plain-dict result of one compared model, kept in session state for the next rerun
+def comparison_summary(result):
+    usage = usage_summary(result["response"]) if result["response"] else None
+    return {
+        "model": result["model"],
+        "text": response_text(result["response"]) if result["response"] else result["text"],
+        "ttft": result["ttft"],
+        "latency": result["latency"],
+        "usage": usage,
+        "cost": estimate_cost(result["model"], usage["input_tokens"], usage["output_tokens"]) if usage else None,
+        "error": result["error"]
+    }
+
+# Latency, TTFT, tokens and cost of one compared reply
+def describe_comparison(summary):
+    parts = []
+    if summary["latency"] is not None:
+        parts.append(f"{summary['latency']:.2f}s total")
+    if summary["ttft"] is not None:
+        parts.append(f"first token {summary['ttft']:.2f}s")
+    if summary["usage"]:
+        parts.append(f"{summary['usage']['input_tokens']:,} in / {summary['usage']['output_tokens']:,} out tokens")
+    if summary["cost"] is not None:
+        parts.append(f"${summary['cost']:.4f}")
+    return " · ".join(parts)
+
+# Token count for one API message, cached by a hash of its content
+def count_message_tokens(message, model=None, exact=False):
+    content = message["content"]
+    raw = content if isinstance(content, str) else json.dumps(content, sort_keys=True)
+    key = hashlib.sha256(f"{model if exact else ''}:{raw}".encode('utf-8')).hexdigest()
+    cache = st.session_state.token_count_cache
+    if key in cache:
+        return cache[key]
+
+    tokens = None
+    if exact and model and st.session_state.api_key:
+        try:
+            result = get_claude_client(st.session_state.api_key).messages.count_tokens(
+                model=model,
+                messages=[{"role": "user", "content": content}]
+            )
+            tokens = result.input_tokens
+        except Exception as e:
+            get_metrics().event("token_count_error", session=st.session_state.session_id, model=model, error=str(e))
+    if tokens is None:
+        tokens = estimate_tokens(content)
+
+    cache[key] = tokens
+    return tokens
+
+# Fit the conversation into a token budget. The newest message is always kept;
+# with "Pin first N" the opening messages are kept too and older middle turns are dropped.
+def fit_messages_to_budget(messages, budget, policy="Drop oldest", pin_count=0, system_prompt="", model=None, exact=False):
+    counts = [count_message_tokens(msg, model, exact) for msg in messages]
+    reserved_tokens = estimate_tokens(system_prompt) if system_prompt else 0
+    pinned = pin_count if policy == "Pin first N" else 0
+    fitted, used = trim_history(messages, counts, budget, pinned, reserved_tokens)
+    # Leading messages that are sent the same way next turn, which is as far as
+    # prompt cache breakpoints pay off: only the pinned ones once trimming has
+    # moved the rest, otherwise all but a newest message whose attachments are
+    # not sent again
+    if len(fitted) < len(messages):
+        stable = next((i for i, msg in enumerate(fitted) if msg is not messages[i]), len(fitted))
+    elif isinstance(messages[-1]["content"], str) or len(messages) <= pinned:
+        stable = len(messages)
+    else:
+        stable = len(messages) - 1
+    return fitted, {
+        "tokens": used,
+        "budget": budget,
+        "kept": len(fitted),
+        "total": len(messages),
+        "stable": stable,
+        "over_budget": used > budget
+    }
+
+# Estimated USD cost of a request for the given model
+def estimate_cost(model, input_tokens, output_tokens=0):
+    input_price, output_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+# One-line summary of what the next request will send
+def describe_context(stats, model, max_tokens):
+    input_cost = estimate_cost(model, stats["tokens"])
+    max_cost = input_cost + estimate_cost(model, 0, max_tokens)
+    summary = (f"Context: ~{stats['tokens']:,} / {stats['budget']:,} tokens "
+               f"({stats['kept']} of {stats['total']} messages) · "
+               f"est. input ${input_cost:.4f}, up to ${max_cost:.4f} with output")
+    if stats["over_budget"]:
+        summary += " · latest message alone exceeds the budget"
+    return summary
+
+# Save code, table and note artifacts found by the response scanner
+def save_artifacts(artifacts):
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    for artifact in artifacts:
+        if artifact["type"] == "code":
+            add_to_scratchpad(f"code_snippet_{timestamp}_{artifact['index']}", "code", artifact["content"])
+        elif artifact["type"] == "table":
+            add_to_scratchpad(f"table_{timestamp}_{artifact['index']}", "table", artifact["content"])
+        else:
+            add_to_scratchpad(f"note_{timestamp}", "text", artifact["content"])
+
+# Post-process a finished assistant reply into the scratchpad. A scanner that was
+# fed the streamed reply has already saved its earlier artifacts and is just closed.
+def process_assistant_message(assistant_message, scanner=None):
+    if scanner is None:
+        save_artifacts(scan_response(assistant_message))
+    else:
+        save_artifacts(scanner.close())
+
 # Toggle scratchpad visibility
 def toggle_scratchpad():
     st.session_state.scratchpad_visible = not st.session_state.scratchpad_visible
     st.rerun()
 
+# True while only a fragment is rerunning rather than the whole script
+def in_fragment_rerun():
+    return bool(get_script_run_ctx().fragment_ids_this_run)
+
+# Rerun the calling fragment on its own if that is how it is running, else
+# the whole script
+def rerun_fragment():
+    st.rerun(scope="fragment" if in_fragment_rerun() else "app")
+
+# Timer for a fragment's sections: the script's own during a full run, a new
+# one when the fragment reruns on its own. The top of the script is skipped
+# then, so this is also where such a rerun marks the session active and
+# reloads a session that was evicted.
+def fragment_timer():
+    if not in_fragment_rerun():
+        return rerun_timer
+    get_session_registry().begin_run(st.session_state.session_id, st.session_state.memory_handle)
+    reload_evicted_session()
+    return RerunTimer()
+
+# A fragment rerunning on its own never reaches the end of the script, so its
+# memory budget is enforced and its rerun recorded here. section names the
+# time since the last mark.
+def record_fragment_rerun(timer, section=None):
+    if not in_fragment_rerun():
+        return
+    if section:
+        timer.mark(section)
+    memory_bytes, memory_actions = enforce_memory_budget(session_memory_bytes())
+    if memory_actions:
+        st.toast("Over the memory budget: " + "; ".join(memory_actions))
+    timer.mark("memory")
+    st.session_state.last_rerun = get_metrics().record_rerun(
+        st.session_state.session_id,
+        timer.sections,
+        timer.total(),
+        memory_bytes
+    )
+
+# Sample data, chart data summary and chart creation in the sidebar. Runs as a
+# fragment, so choosing a chart type or loading sample data reruns only this.
+@st.fragment
+def visualization_controls():
+    timer = fragment_timer()
+    st.subheader("Visualization")
+    
+    # Create a chart with sample data
+    if st.button("Create Sample Chart", help="Create a sample chart to test visualization"):
+        # Generate sample data
+        pd = timed_import("pandas")
+        dates = pd.date_range(start='2023-01-01', periods=30, freq='D')
+        data = {
+            'date': dates,
+            'value1': np.random.randint(10, 100, size=30),
+            'value2': np.random.randint(20, 80, size=30),
+            'category': np.random.choice(['A', 'B', 'C'], size=30)
+        }
+        
+        set_chart_data(pd.DataFrame(data))
+        st.success("Sample data created! Use 'Visualize Data' to create charts.")
+    
+    # Chart type selector (only show if data exists)
+    if st.session_state.chart_data is not None:
+        rows, columns = frame_shape(st.session_state.chart_data)
+        location = "on disk" if isinstance(st.session_state.chart_data, SpilledFrame) else "in memory"
+        st.caption(f"Chart data: {rows:,} rows × {columns} columns, "
+                   f"{format_bytes(st.session_state.chart_data_memory)} {location}")
+        chart_type = st.selectbox(
+            "Chart Type", 
+            ["Line Chart", "Bar Chart", "Scatter Plot", "Pie Chart", "Heatmap"],
+            index=0
+        )
+        
+        if st.button("Visualize Data"):
+            chart_data = get_chart_data()
+            if chart_data is not None and create_chart(chart_data, chart_type):
+                # The new chart is shown in the scratchpad, outside this fragment
+                st.toast("Chart added to the scratchpad")
+                st.rerun()
+    record_fragment_rerun(timer, "visualization")
+
+rerun_timer.mark("setup")
+
 # Sidebar settings
 with st.sidebar:
     st.title("Custom Claude UI")
@@ -419,48 +1785,116 @@ with st.sidebar:
     # Max token settings
     max_tokens = st.slider("Max Tokens", min_value=100, max_value=200000, value=4000, step=100)
 
+    # Streaming toggle
+    stream_responses = st.toggle("Stream responses", value=True, help="Show Claude's reply as it is generated")
+
+    # Compare mode sends each prompt to several models at once
+    compare_mode = st.toggle("Compare models", value=False, help="Send each prompt to several models side by side")
+    comparison_models = []
+    if compare_mode:
+        comparison_models = st.multiselect(
+            "Compare with",
+            [m for m in model_options if m != selected_model],
+            default=[m for m in model_options if m != selected_model][-1:],
+            help=f"Replies are compared with {selected_model}, which stays the model of record for the chat"
+        )
+
+    # Context window settings
+    st.subheader("Context Window")
+    context_budget = st.number_input("Context budget (tokens)", min_value=1000, max_value=1000000,
+                                     value=DEFAULT_CONTEXT_BUDGET, step=1000,
+                                     help="Older messages are left out of the request once the history exceeds this")
+    context_policy = st.selectbox("Trimming policy", CONTEXT_POLICIES, index=0)
+    pin_count = 0
+    if context_policy == "Pin first N":
+        pin_count = st.number_input("Messages to pin", min_value=1, max_value=50, value=2, step=1)
+    exact_token_counts = st.checkbox("Exact token counts (uses the token counting API)", value=False)
+    prompt_caching = st.checkbox("Prompt caching", value=True,
+                                 help="Cache the system prompt, conversation prefix and large attachments between turns")
+    response_caching = st.checkbox("Reuse cached responses", value=False,
+                                   help="Answer a request identical to an earlier one from the on-disk response cache "
+                                        "instead of the API. Only temperature 0 requests are cached.")
+    if response_caching:
+        if temperature != 0:
+            st.caption("Set temperature to 0 to use the response cache")
+        if st.button("Clear response cache"):
+            get_response_cache().clear()
+
     # Reset chat button (keeps scratchpad)
     st.subheader("Chat Controls")
     
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Reset Chat", help="Clear chat messages but keep scratchpad"):
-            st.session_state.messages = []
+            reset_messages()
             st.rerun()
     
     with col2:
         if st.button("Clear All", help="Clear both chat and scratchpad"):
-            st.session_state.messages = []
-            st.session_state.scratchpad = {}
+            reset_messages()
+            charts = list(st.session_state.scratchpad.of_type("chart").values())
+            st.session_state.scratchpad.clear()
+            release_chart_images(charts)
+            prune_chart_sources()
             st.rerun()
+
+    # Session controls
+    if get_storage().persistent:
+        st.subheader("Session")
+        st.caption(f"Session id: `{st.session_state.session_id}`")
+        resume_id = st.text_input("Resume session", placeholder="Session id", key="resume_session_id")
+        if st.button("Resume", disabled=not resume_id.strip()):
+            resume_id = resume_id.strip()
+            if get_storage().session_exists(resume_id):
+                load_session(resume_id)
+                prune_chart_sources()
+                st.rerun()
+            else:
+                st.error(f"No saved session with id {resume_id}")
             
-    # Visualization controls
-    st.subheader("Visualization")
-    
-    # Create a chart with sample data
-    if st.button("Create Sample Chart", help="Create a sample chart to test visualization"):
-        # Generate sample data
-        dates = pd.date_range(start='2023-01-01', periods=30, freq='D')
-        data = {
-            'date': dates,
-            'value1': np.random.randint(10, 100, size=30),
-            'value2': np.random.randint(20, 80, size=30),
-            'category': np.random.choice(['A', 'B', 'C'], size=30)
-        }
-        
-        st.session_state.chart_data = pd.DataFrame(data)
-        st.success("Sample data created! Use 'Visualize Data' to create charts.")
-    
-    # Chart type selector (only show if data exists)
-    if st.session_state.chart_data is not None:
-        chart_type = st.selectbox(
-            "Chart Type", 
-            ["Line Chart", "Bar Chart", "Scatter Plot", "Pie Chart", "Heatmap"],
-            index=0
+    visualization_controls()
+
+    # Memory this session holds against its budget
+    st.subheader("Memory")
+    session_memory = st.session_state.last_rerun["memory_bytes"] if st.session_state.last_rerun else 0
+    st.progress(min(session_memory / SESSION_MEMORY_BUDGET_BYTES, 1.0),
+                text=f"This session: {format_bytes(session_memory)} of {format_bytes(SESSION_MEMORY_BUDGET_BYTES)}")
+    registry = get_session_registry()
+    st.caption(f"All sessions: {format_bytes(registry.total_bytes())} of {format_bytes(GLOBAL_MEMORY_BUDGET_BYTES)} "
+               f"across {len(registry)} session(s)")
+
+    # Where the time and memory go, for this session and the whole process
+    with st.expander("Diagnostics"):
+        last_rerun = st.session_state.last_rerun
+        if last_rerun:
+            section_times = ", ".join(f"{section} {seconds * 1000:.0f} ms" for section, seconds in last_rerun["sections"].items())
+            st.caption(f"Last rerun: {last_rerun['total'] * 1000:.0f} ms ({section_times})")
+            st.caption(f"Session state: about {format_bytes(last_rerun['memory_bytes'])}")
+        last_turn = st.session_state.last_turn
+        if last_turn:
+            turn_stats = [last_turn["model"], last_turn["outcome"], f"{last_turn['latency']:.2f}s"]
+            if last_turn["ttft"] is not None:
+                turn_stats.append(f"first token {last_turn['ttft']:.2f}s")
+            st.caption("Last request: " + " · ".join(turn_stats))
+        metrics = get_metrics()
+        active_memory = metrics.active_sessions()
+        st.caption(
+            f"Process: {metrics.total('claude_ui_api_requests_total'):,} requests, "
+            f"{metrics.total('claude_ui_tokens_total', kind='input'):,} input / "
+            f"{metrics.total('claude_ui_tokens_total', kind='output'):,} output tokens, "
+            f"{len(active_memory)} active session(s) using about {format_bytes(sum(active_memory))}"
         )
-        
-        if st.button("Visualize Data"):
-            create_chart(st.session_state.chart_data, chart_type)
+        loaded = [f"{name} {seconds * 1000:.0f} ms" for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1])]
+        not_loaded = [name for name in LAZY_MODULES if name not in sys.modules]
+        st.caption("Imported on first use: " + (", ".join(loaded) or "nothing yet")
+                   + (f" · not loaded: {', '.join(not_loaded)}" if not_loaded else ""))
+        st.download_button("Metrics (Prometheus)", metrics.render_prometheus, file_name="claude_ui_metrics.prom",
+                           mime="text/plain", on_click="ignore")
+        st.download_button("Session events (JSONL)", functools.partial(metrics.recent_jsonl, st.session_state.session_id),
+                           file_name=f"claude_ui_events_{st.session_state.session_id}.jsonl",
+                           mime="application/x-ndjson", on_click="ignore")
+
+rerun_timer.mark("sidebar")
 
 # Main layout with two columns
 if st.session_state.scratchpad_visible:
@@ -469,38 +1903,61 @@ else:
     chat_col = st.container()
     scratchpad_col = None
 
-# Chat interface - simplified and direct
-with chat_col:
+# Chat interface - simplified and direct. Runs as a fragment, so sending a
+# message or paging the transcript reruns only this pane; the settings are
+# passed in from the sidebar.
+@st.fragment
+def chat_pane(selected_model, system_prompt, temperature, max_tokens, stream_responses, compare_mode,
+              comparison_models, context_budget, context_policy, pin_count, exact_token_counts,
+              prompt_caching, response_caching):
+    timer = fragment_timer()
     st.subheader("Chat with Claude")
     
     # Display messages in a more direct way
     chat_container = st.container()
     with chat_container:
-        # Create a div for messages
-        messages_html = '<div class="chat-container">'
-        
-        # Add each message to the HTML
-        for msg in st.session_state.messages:
-            if msg["role"] == "user":
-                messages_html += f'''
-                <div class="user-message">
-                    <strong>You:</strong><br>
-                    {msg["content"]}
-                </div>
-                '''
-            else:
-                messages_html += f'''
-                <div class="assistant-message">
-                    <strong>Claude:</strong><br>
-                    {msg["content"]}
-                </div>
-                '''
-        
-        # Close the chat container
-        messages_html += '</div>'
-        
-        # Render the HTML
-        st.markdown(messages_html, unsafe_allow_html=True)
+        # Only the most recent turns are rendered; older ones are paged in on demand
+        visible_count = st.session_state.transcript_turns * 2
+        hidden_count = max(0, len(st.session_state.messages) - visible_count)
+        if hidden_count:
+            if st.button(f"Show earlier messages ({hidden_count} hidden)", key="show_earlier_messages"):
+                st.session_state.transcript_turns += TRANSCRIPT_PAGE_TURNS
+                rerun_fragment()
+
+        # One element per message, keyed by its id, with its HTML built once and
+        # reused from the cache, so a rerun leaves earlier messages unchanged
+        with st.container(key="transcript"):
+            for msg in st.session_state.messages[hidden_count:]:
+                with st.container(key=f"message_{msg['id']}"):
+                    st.markdown(f'<div class="chat-row">{get_message_html(msg)}</div>', unsafe_allow_html=True)
+
+    # Timing and token usage of the last response
+    last_response_stats = []
+    if st.session_state.last_cache_hit:
+        last_response_stats.append("served from the response cache, no API call")
+    if st.session_state.last_ttft is not None:
+        last_response_stats.append(f"first token after {st.session_state.last_ttft:.2f}s")
+    if st.session_state.last_usage:
+        usage = st.session_state.last_usage
+        last_response_stats.append(
+            f"{usage['input_tokens']:,} input, {usage['output_tokens']:,} output tokens · "
+            f"cache read {usage['cache_read_input_tokens']:,}, cache write {usage['cache_creation_input_tokens']:,}"
+        )
+    if last_response_stats:
+        st.caption("Last response: " + " · ".join(last_response_stats))
+
+    # Side-by-side replies from the last compare-mode prompt
+    if st.session_state.last_comparison:
+        st.caption("Model comparison for the last prompt")
+        for column, summary in zip(st.columns(len(st.session_state.last_comparison)), st.session_state.last_comparison):
+            with column:
+                st.markdown(f"**{summary['model']}**")
+                if summary["error"]:
+                    st.error(summary["error"])
+                else:
+                    st.markdown(summary["text"])
+                    st.caption(describe_comparison(summary))
+    timer.mark("transcript")
     
     # File uploader
     uploaded_files = st.file_uploader("Upload files", 
@@ -510,115 +1967,271 @@ with chat_col:
     # Process uploaded files with a simple approach
     active_file_ids = []
     if uploaded_files:
-        file_display = st.empty()
-        with file_display.container():
-            st.write("Files attached:")
-            for uploaded_file in uploaded_files:
-                file_id = handle_uploaded_file(uploaded_file)
-                if file_id:
-                    active_file_ids.append(file_id)
-                    file_data = st.session_state.file_buffer[file_id]
-                    st.write(f"- {file_data['name']} ({file_data['size']} bytes)")
+        for uploaded_file in uploaded_files:
+            file_id = handle_uploaded_file(uploaded_file)
+            if file_id:
+                active_file_ids.append(file_id)
+        # PDFs, spreadsheets and images are processed in the background; the list
+        # polls for progress on its own so the chat input stays usable
+        if any(extraction_pending(file_id) for file_id in active_file_ids):
+            poll_attachment_list(active_file_ids)
+        else:
+            render_attachment_list(active_file_ids)
+
+    # Forget files that were removed from the uploader and never sent
+    st.session_state.file_buffer.evict_unreferenced(active_file_ids, message_file_ids())
+    timer.mark("uploads")
     
+    # Show what the current history would cost to send
+    if st.session_state.messages:
+        history = [{"role": msg["role"], "content": msg["content"]} for msg in st.session_state.messages]
+        _, history_stats = fit_messages_to_budget(history, context_budget, context_policy, pin_count,
+                                                  system_prompt, selected_model, exact_token_counts)
+        st.caption(describe_context(history_stats, selected_model, max_tokens))
+
     # Chat input
     user_input = st.chat_input("Message Claude...")
     
     # Process user input
     if user_input:
-        # Add message to UI display
-        st.session_state.messages.append({"role": "user", "content": user_input})
+        # Add message to UI display, remembering which stored files it carried
+        if active_file_ids:
+            user_message = append_message("user", user_input, file_ids=list(active_file_ids))
+        else:
+            user_message = append_message("user", user_input)
         
         # Create message for Claude API with file attachments
         claude_message = create_claude_message(user_input, active_file_ids)
         
         # Prepare messages for Claude API
-        api_messages = []
-        for i, msg in enumerate(st.session_state.messages):
-            # For all messages except the last user message, add them as is
-            if i < len(st.session_state.messages) - 1 or msg["role"] != "user":
-                api_messages.append(msg)
-            else:
-                # Replace the last user message with the one that includes files
-                api_messages.append(claude_message)
+        api_messages = history_for_api(claude_message, pin_count if context_policy == "Pin first N" else 0)
+
+        # Trim the history to the context budget
+        api_messages, context_stats = fit_messages_to_budget(
+            api_messages,
+            context_budget,
+            context_policy,
+            pin_count,
+            system_prompt,
+            selected_model,
+            exact_token_counts
+        )
+        st.caption(describe_context(context_stats, selected_model, max_tokens))
         
         # Call Claude API
-        with st.status("Claude is thinking..."):
-            response = query_claude(
+        scratchpad_size = len(st.session_state.scratchpad)
+        scanner = None
+        st.session_state.last_comparison = None
+        # Only deterministic requests are answered from the response cache
+        use_response_cache = response_caching and temperature == 0
+        request_start = time.perf_counter()
+        if compare_mode and comparison_models:
+            # The sidebar model comes first and its reply goes into the chat
+            models = [selected_model] + comparison_models
+            with chat_container:
+                st.markdown(
+                    f'<div class="chat-container">{get_message_html(user_message)}</div>',
+                    unsafe_allow_html=True
+                )
+                panes = {}
+                for column, model in zip(st.columns(len(models)), models):
+                    with column:
+                        st.markdown(f"**{model}**")
+                        panes[model] = {"text": st.empty(), "stats": st.empty()}
+
+            summaries = run_model_comparison(
                 api_messages,
-                selected_model,
+                models,
                 system_prompt,
                 temperature,
-                max_tokens
+                max_tokens,
+                panes,
+                prompt_caching,
+                stable_prefix=context_stats["stable"]
             )
-        
-        if response:
-            assistant_message = response.content[0].text
-            st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-            
-            # Extract code blocks and add to scratchpad
-            code_blocks = extract_code_blocks(assistant_message)
-            for i, block in enumerate(code_blocks):
-                name = f"code_snippet_{datetime.now().strftime('%Y%m%d%H%M%S')}_{i}"
-                add_to_scratchpad(name, "code", block)
-            
-            # Extract tables and add to scratchpad
-            tables = extract_tables(assistant_message)
-            for i, table in enumerate(tables):
-                name = f"table_{datetime.now().strftime('%Y%m%d%H%M%S')}_{i}"
-                add_to_scratchpad(name, "table", table)
-            
-            # Also add the entire response as a note
-            if len(assistant_message) > 0:
-                note_name = f"note_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                add_to_scratchpad(note_name, "text", assistant_message)
-        
-        # Rerun to update the UI
-        st.rerun()
+            response = summaries[0]["response"] if summaries else None
+            for summary in summaries:
+                record_turn(summary["model"], "compare", summary["latency"] or time.perf_counter() - request_start,
+                            summary["response"], summary["ttft"], summary["error"])
+            st.session_state.last_ttft = summaries[0]["ttft"] if summaries else None
+            if summaries:
+                st.session_state.last_comparison = [
+                    {k: v for k, v in summary.items() if k != "response"} for summary in summaries
+                ]
+        elif stream_responses:
+            # Show the new user message and a live assistant bubble under the transcript
+            with chat_container:
+                st.markdown(
+                    f'<div class="chat-container">{get_message_html(user_message)}</div>',
+                    unsafe_allow_html=True
+                )
+                stream_placeholder = st.empty()
 
-# Scratchpad section in right column
-if st.session_state.scratchpad_visible and scratchpad_col is not None:
-    with scratchpad_col:
-        st.header("Scratchpad")
-        
-        # Add new item manually
-        with st.expander("Add New Item", expanded=False):
-            item_name = st.text_input("Item Name", key="new_item_name")
-            item_type = st.selectbox("Content Type", ["text", "code", "table", "chart"])
-            
-            if item_type == "code":
-                language = st.selectbox("Language", ["python", "javascript", "html", "css", "sql", "bash", "text"])
-                code = st.text_area("Code Content", height=150)
-                if st.button("Save Code"):
-                    if item_name:
-                        add_to_scratchpad(item_name, "code", {"language": language, "code": code})
-                        st.success(f"Saved '{item_name}' to scratchpad")
-            elif item_type == "table":
-                table_markdown = st.text_area("Table (Markdown Format)", value="| Column 1 | Column 2 |\n| --- | --- |\n| Data 1 | Data 2 |", height=150)
-                if st.button("Save Table"):
-                    if item_name:
-                        add_to_scratchpad(item_name, "table", table_markdown)
-                        st.success(f"Saved '{item_name}' to scratchpad")
-            elif item_type == "chart":
-                st.info("To create charts, use the visualization tools in the sidebar.")
+            scanner = ResponseScanner()
+            with st.status("Claude is thinking...") as status:
+                response, ttft = stream_claude(
+                    api_messages,
+                    selected_model,
+                    system_prompt,
+                    temperature,
+                    max_tokens,
+                    stream_placeholder,
+                    status,
+                    prompt_caching,
+                    scanner,
+                    use_response_cache,
+                    stable_prefix=context_stats["stable"]
+                )
+                if response and getattr(response, "cached", False):
+                    status.update(label="Served from the response cache", state="complete")
+                elif response and ttft is not None:
+                    status.update(label=f"Response complete (time to first token: {ttft:.2f}s)", state="complete")
+            st.session_state.last_ttft = ttft
+            record_turn(selected_model, "stream", time.perf_counter() - request_start, response, ttft)
+        else:
+            with st.status("Claude is thinking...") as status:
+                response = query_claude(
+                    api_messages,
+                    selected_model,
+                    system_prompt,
+                    temperature,
+                    max_tokens,
+                    prompt_caching,
+                    use_response_cache,
+                    status,
+                    stable_prefix=context_stats["stable"]
+                )
+            st.session_state.last_ttft = None
+            record_turn(selected_model, "blocking", time.perf_counter() - request_start, response)
+
+        st.session_state.last_cache_hit = getattr(response, "cached", False)
+        # A cached reply used no tokens this time
+        st.session_state.last_usage = usage_summary(response) if response and not st.session_state.last_cache_hit else None
+        if response:
+            assistant_message = response_text(response)
+            if st.session_state.last_cache_hit:
+                append_message("assistant", assistant_message, cached=True)
             else:
-                text = st.text_area("Text Content", height=150)
-                if st.button("Save Text"):
-                    if item_name:
-                        add_to_scratchpad(item_name, "text", text)
-                        st.success(f"Saved '{item_name}' to scratchpad")
+                append_message("assistant", assistant_message)
+            process_assistant_message(assistant_message, scanner)
+
+        # Rerun to update the UI: only this pane, unless the reply added
+        # items to a visible scratchpad
+        if st.session_state.scratchpad_visible and len(st.session_state.scratchpad) != scratchpad_size:
+            st.rerun()
+        rerun_fragment()
+    record_fragment_rerun(timer, "chat")
+
+with chat_col:
+    chat_pane(
+        selected_model=selected_model,
+        system_prompt=system_prompt,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream_responses=stream_responses,
+        compare_mode=compare_mode,
+        comparison_models=comparison_models,
+        context_budget=context_budget,
+        context_policy=context_policy,
+        pin_count=pin_count,
+        exact_token_counts=exact_token_counts,
+        prompt_caching=prompt_caching,
+        response_caching=response_caching
+    )
+rerun_timer.mark("chat")
+
+# Scratchpad panel in the right column. Runs as a fragment, so searching,
+# expanding, editing and deleting items rerun only this panel.
+@st.fragment
+def scratchpad_panel():
+    timer = fragment_timer()
+    st.header("Scratchpad")
+    
+    # Search scratchpad items and chat history
+    search_query = st.text_input("Search", placeholder="Search scratchpad and chat", key="search_query")
+    if search_query.strip():
+        st.session_state.scratchpad.index_unloaded()
+        search_index = st.session_state.search_index
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            search_filter = st.selectbox("Type", list(SEARCH_FILTERS), key="search_filter")
+        with col2:
+            search_language = st.selectbox("Language", ["Any"] + search_index.languages_in_use(), key="search_language")
+        search_start = time.perf_counter()
+        results = search_index.search(
+            search_query,
+            kinds=SEARCH_FILTERS[search_filter],
+            language=None if search_language == "Any" else search_language,
+            limit=SEARCH_RESULT_LIMIT
+        )
+        search_ms = (time.perf_counter() - search_start) * 1000
+        st.caption(f"{len(results)} result(s) from {len(search_index):,} indexed in {search_ms:.1f} ms")
+        for result in results:
+            with st.expander(f"{result['title']} · {result['kind']}"):
+                if result["kind"] == "code":
+                    st.code(result["preview"], language=result["language"])
+                else:
+                    st.text(result["preview"])
+    
+    # Add new item manually
+    with st.expander("Add New Item", expanded=False):
+        item_name = st.text_input("Item Name", key="new_item_name")
+        item_type = st.selectbox("Content Type", ["text", "code", "table", "chart"])
         
-        # Upload CSV for visualization
-        with st.expander("Import Data for Visualization", expanded=False):
-            uploaded_csv = st.file_uploader("Upload CSV file", type=["csv"], key="data_csv")
-            if uploaded_csv:
-                try:
-                    import pandas as pd
-                    data = pd.read_csv(uploaded_csv)
-                    st.session_state.chart_data = data
-                    st.success(f"Successfully imported {uploaded_csv.name} with {len(data)} rows and {len(data.columns)} columns.")
+        if item_type == "code":
+            language = st.selectbox("Language", ["python", "javascript", "html", "css", "sql", "bash", "text"])
+            code = st.text_area("Code Content", height=150)
+            if st.button("Save Code"):
+                if item_name:
+                    add_to_scratchpad(item_name, "code", {"language": language, "code": code})
+                    st.success(f"Saved '{item_name}' to scratchpad")
+        elif item_type == "table":
+            table_markdown = st.text_area("Table (Markdown Format)", value="| Column 1 | Column 2 |\n| --- | --- |\n| Data 1 | Data 2 |", height=150)
+            if st.button("Save Table"):
+                if item_name:
+                    add_to_scratchpad(item_name, "table", table_markdown)
+                    st.success(f"Saved '{item_name}' to scratchpad")
+        elif item_type == "chart":
+            st.info("To create charts, use the visualization tools in the sidebar.")
+        else:
+            text = st.text_area("Text Content", height=150)
+            if st.button("Save Text"):
+                if item_name:
+                    add_to_scratchpad(item_name, "text", text)
+                    st.success(f"Saved '{item_name}' to scratchpad")
+    
+    # Upload CSV for visualization
+    with st.expander("Import Data for Visualization", expanded=False):
+        uploaded_csv = st.file_uploader("Upload CSV file", type=["csv"], key="data_csv")
+        if uploaded_csv:
+            try:
+                content_hash, all_columns = csv_upload_info(uploaded_csv)
+                selected_columns = st.multiselect("Columns to load", all_columns, default=all_columns,
+                                                  key=f"csv_columns_{content_hash[:12]}")
+                categorize = st.checkbox("Store repeated text as categories", value=True,
+                                         help="Low-cardinality text columns use much less memory as categories")
+                if not selected_columns:
+                    st.warning("Select at least one column to load.")
+                else:
+                    # Parsed again only when the load changes, so data moved
+                    # to disk for the memory budget stays there
+                    csv_source = (content_hash, tuple(selected_columns), categorize)
+                    if st.session_state.chart_data_source != csv_source or st.session_state.chart_data is None:
+                        data, memory_bytes = load_csv(uploaded_csv, content_hash, selected_columns, categorize)
+                        set_chart_data(data, memory_bytes, csv_source)
+                        # The visualization controls in the sidebar show the chart data too
+                        st.rerun()
+                    rows, columns = frame_shape(st.session_state.chart_data)
+                    st.success(f"Successfully imported {uploaded_csv.name} with {rows} rows and {columns} columns.")
+                    if isinstance(st.session_state.chart_data, SpilledFrame):
+                        st.caption(f"Moved to disk: {format_bytes(st.session_state.chart_data_memory)}")
+                    else:
+                        st.caption(f"In memory: {format_bytes(st.session_state.chart_data_memory)}")
                     
                     if st.button("Preview Data"):
-                        st.dataframe(data.head())
+                        data = get_chart_data()
+                        if data is not None:
+                            st.dataframe(data.head())
                         
                     chart_type = st.selectbox(
                         "Chart Type", 
@@ -627,134 +2240,175 @@ if st.session_state.scratchpad_visible and scratchpad_col is not None:
                     )
                     
                     if st.button("Create Visualization"):
-                        create_chart(data, chart_type)
-                except Exception as e:
-                    st.error(f"Error loading CSV: {str(e)}")
+                        data = get_chart_data()
+                        if data is not None:
+                            create_chart(data, chart_type)
+            except Exception as e:
+                st.error(f"Error loading CSV: {str(e)}")
+    
+    # Display scratchpad items
+    if not st.session_state.scratchpad:
+        st.info("Your scratchpad is empty. Chat with Claude to automatically collect useful information here.")
+    else:
+        # Items are grouped by type in indexes the scratchpad keeps up to date
+        scratchpad = st.session_state.scratchpad
         
-        # Display scratchpad items
-        if not st.session_state.scratchpad:
-            st.info("Your scratchpad is empty. Chat with Claude to automatically collect useful information here.")
-        else:
-            # Group scratchpad items by type
-            code_items = {k: v for k, v in st.session_state.scratchpad.items() if v["type"] == "code"}
-            table_items = {k: v for k, v in st.session_state.scratchpad.items() if v["type"] == "table"}
-            chart_items = {k: v for k, v in st.session_state.scratchpad.items() if v["type"] == "chart"}
-            text_items = {k: v for k, v in st.session_state.scratchpad.items() if v["type"] not in ["code", "table", "chart"]}
-            
-            # Display charts first
-            if chart_items:
-                st.subheader("Charts & Visualizations")
-                for name, item in chart_items.items():
-                    with st.expander(f"{name}"):
-                        # Display the chart image
-                        import base64
-                        from PIL import Image
-                        import io
-                        
-                        try:
-                            image_data = base64.b64decode(item["content"]["image_data"])
-                            image = Image.open(io.BytesIO(image_data))
-                            st.image(image, caption=item["content"]["description"])
-                        except Exception as e:
-                            st.error(f"Error displaying chart: {str(e)}")
-                        
-                        col1, col2 = st.columns([1, 1])
-                        with col2:
-                            if st.button(f"Delete", key=f"delete_chart_{name}"):
-                                del st.session_state.scratchpad[name]
-                                st.success(f"Deleted '{name}'")
-                                st.rerun()
-            
-            # Display code snippets
-            if code_items:
-                st.subheader("Code Snippets")
-                for name, item in code_items.items():
-                    with st.expander(f"{name}"):
-                        st.code(item["content"]["code"], language=item["content"]["language"])
-                        col1, col2 = st.columns([1, 1])
-                        with col1:
-                            # Edit button opens edit form
-                            if st.button(f"Edit", key=f"edit_{name}"):
-                                st.session_state.current_scratchpad_item = name
-                                st.session_state["edit_mode"] = True
-                                st.rerun()
-                        with col2:
-                            # Delete button
-                            if st.button(f"Delete", key=f"delete_{name}"):
-                                del st.session_state.scratchpad[name]
-                                st.success(f"Deleted '{name}'")
-                                st.rerun()
-            
-            # Display tables
-            if table_items:
-                st.subheader("Tables")
-                for name, item in table_items.items():
-                    with st.expander(f"{name}"):
-                        st.markdown(item["content"])
-                        col1, col2 = st.columns([1, 1])
-                        with col1:
-                            if st.button(f"Edit", key=f"edit_table_{name}"):
-                                st.session_state.current_scratchpad_item = name
-                                st.session_state["edit_mode"] = True
-                                st.rerun()
-                        with col2:
-                            if st.button(f"Delete", key=f"delete_table_{name}"):
-                                del st.session_state.scratchpad[name]
-                                st.success(f"Deleted '{name}'")
-                                st.rerun()
-            
-            # Display other text content
-            if text_items:
-                st.subheader("Notes")
-                for name, item in text_items.items():
-                    with st.expander(f"{name}"):
-                        st.write(item["content"])
-                        col1, col2 = st.columns([1, 1])
-                        with col1:
-                            if st.button(f"Edit", key=f"edit_text_{name}"):
-                                st.session_state.current_scratchpad_item = name
-                                st.session_state["edit_mode"] = True
-                                st.rerun()
-                        with col2:
-                            if st.button(f"Delete", key=f"delete_text_{name}"):
-                                del st.session_state.scratchpad[name]
-                                st.success(f"Deleted '{name}'")
-                                st.rerun()
+        # Display charts first
+        if scratchpad.of_type("chart"):
+            st.subheader("Charts & Visualizations")
+            for item in scratchpad_section_page("chart"):
+                name = item.name
+                with st.expander(f"{name}"):
+                    # Display the chart image straight from the blob store, no base64 round trip
+                    try:
+                        if "image_blob" in item.content:
+                            image_data = get_blob_store().read(item.content["image_blob"])
+                        else:
+                            image_data = base64.b64decode(item.content["image_data"])
+                        if image_data is None:
+                            st.info("This chart image is no longer available.")
+                        else:
+                            st.image(image_data, caption=item.content["description"])
+                    except Exception as e:
+                        st.error(f"Error displaying chart: {str(e)}")
+                    
+                    # The full-resolution render is only made when asked for
+                    if name in st.session_state.full_res_charts:
+                        full_png = render_full_chart(item.content)
+                        if full_png is None:
+                            st.info("The data for this chart is no longer available.")
+                        else:
+                            st.image(full_png)
+                            st.download_button("Download PNG", full_png, file_name=f"{name}.png",
+                                               mime="image/png", key=f"download_chart_{name}")
+                    
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        if name not in st.session_state.full_res_charts and "fingerprint" in item.content:
+                            if st.button("Full resolution", key=f"full_chart_{name}"):
+                                st.session_state.full_res_charts.add(name)
+                                rerun_fragment()
+                    with col2:
+                        if st.button(f"Delete", key=f"delete_chart_{name}"):
+                            release_chart_images([scratchpad.delete(name)])
+                            st.session_state.full_res_charts.discard(name)
+                            prune_chart_sources()
+                            st.success(f"Deleted '{name}'")
+                            rerun_fragment()
         
-        # Edit mode for selected scratchpad item
-        if "edit_mode" in st.session_state and st.session_state["edit_mode"] and st.session_state.current_scratchpad_item:
-            st.subheader(f"Edit: {st.session_state.current_scratchpad_item}")
-            item = st.session_state.scratchpad[st.session_state.current_scratchpad_item]
-            
-            if item["type"] == "code":
-                language = st.selectbox("Language", ["python", "javascript", "html", "css", "sql", "bash", "text"], 
-                                        index=["python", "javascript", "html", "css", "sql", "bash", "text"].index(item["content"]["language"]))
-                code = st.text_area("Code", value=item["content"]["code"], height=300)
-                if st.button("Update Code"):
-                    st.session_state.scratchpad[st.session_state.current_scratchpad_item]["content"] = {"language": language, "code": code}
-                    st.success("Updated successfully")
-                    st.session_state["edit_mode"] = False
-                    st.rerun()
-            elif item["type"] == "table":
-                table_markdown = st.text_area("Table (Markdown)", value=item["content"], height=300)
-                if st.button("Update Table"):
-                    st.session_state.scratchpad[st.session_state.current_scratchpad_item]["content"] = table_markdown
-                    st.success("Updated successfully")
-                    st.session_state["edit_mode"] = False
-                    st.rerun()
-            else:
-                text = st.text_area("Text", value=item["content"], height=300)
-                if st.button("Update Text"):
-                    st.session_state.scratchpad[st.session_state.current_scratchpad_item]["content"] = text
-                    st.success("Updated successfully")
-                    st.session_state["edit_mode"] = False
-                    st.rerun()
-            
-            if st.button("Cancel"):
+        # Display code snippets
+        if scratchpad.of_type("code"):
+            st.subheader("Code Snippets")
+            for item in scratchpad_section_page("code"):
+                name = item.name
+                with st.expander(f"{name}"):
+                    st.code(item.content["code"], language=item.content["language"])
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        # Edit button opens edit form
+                        if st.button(f"Edit", key=f"edit_{name}"):
+                            st.session_state.current_scratchpad_item = name
+                            st.session_state["edit_mode"] = True
+                            rerun_fragment()
+                    with col2:
+                        # Delete button
+                        if st.button(f"Delete", key=f"delete_{name}"):
+                            scratchpad.delete(name)
+                            st.success(f"Deleted '{name}'")
+                            rerun_fragment()
+        
+        # Display tables
+        if scratchpad.of_type("table"):
+            st.subheader("Tables")
+            for item in scratchpad_section_page("table"):
+                name = item.name
+                with st.expander(f"{name}"):
+                    st.markdown(item.content)
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        if st.button(f"Edit", key=f"edit_table_{name}"):
+                            st.session_state.current_scratchpad_item = name
+                            st.session_state["edit_mode"] = True
+                            rerun_fragment()
+                    with col2:
+                        if st.button(f"Delete", key=f"delete_table_{name}"):
+                            scratchpad.delete(name)
+                            st.success(f"Deleted '{name}'")
+                            rerun_fragment()
+        
+        # Display other text content
+        if scratchpad.of_type("text"):
+            st.subheader("Notes")
+            for item in scratchpad_section_page("text"):
+                name = item.name
+                with st.expander(f"{name}"):
+                    st.write(item.content)
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        if st.button(f"Edit", key=f"edit_text_{name}"):
+                            st.session_state.current_scratchpad_item = name
+                            st.session_state["edit_mode"] = True
+                            rerun_fragment()
+                    with col2:
+                        if st.button(f"Delete", key=f"delete_text_{name}"):
+                            scratchpad.delete(name)
+                            st.success(f"Deleted '{name}'")
+                            rerun_fragment()
+    
+    # Edit mode for selected scratchpad item
+    if "edit_mode" in st.session_state and st.session_state["edit_mode"] and st.session_state.current_scratchpad_item:
+        st.subheader(f"Edit: {st.session_state.current_scratchpad_item}")
+        item = st.session_state.scratchpad[st.session_state.current_scratchpad_item]
+        
+        if item.type == "code":
+            language = st.selectbox("Language", ["python", "javascript", "html", "css", "sql", "bash", "text"], 
+                                    index=["python", "javascript", "html", "css", "sql", "bash", "text"].index(item.content["language"]))
+            code = st.text_area("Code", value=item.content["code"], height=300)
+            if st.button("Update Code"):
+                st.session_state.scratchpad.update(st.session_state.current_scratchpad_item, {"language": language, "code": code})
+                st.success("Updated successfully")
                 st.session_state["edit_mode"] = False
-                st.session_state.current_scratchpad_item = None
-                st.rerun()
+                rerun_fragment()
+        elif item.type == "table":
+            table_markdown = st.text_area("Table (Markdown)", value=item.content, height=300)
+            if st.button("Update Table"):
+                st.session_state.scratchpad.update(st.session_state.current_scratchpad_item, table_markdown)
+                st.success("Updated successfully")
+                st.session_state["edit_mode"] = False
+                rerun_fragment()
+        else:
+            text = st.text_area("Text", value=item.content, height=300)
+            if st.button("Update Text"):
+                st.session_state.scratchpad.update(st.session_state.current_scratchpad_item, text)
+                st.success("Updated successfully")
+                st.session_state["edit_mode"] = False
+                rerun_fragment()
+        
+        if st.button("Cancel"):
+            st.session_state["edit_mode"] = False
+            st.session_state.current_scratchpad_item = None
+            rerun_fragment()
+    record_fragment_rerun(timer, "scratchpad")
+
+if st.session_state.scratchpad_visible and scratchpad_col is not None:
+    with scratchpad_col:
+        scratchpad_panel()
+rerun_timer.mark("scratchpad")
 
 # Footer
 st.divider()
 st.caption("Custom Claude UI - Built with Streamlit")
+
+memory_bytes, memory_actions = enforce_memory_budget(session_memory_bytes())
+if memory_actions:
+    st.toast("Over the memory budget: " + "; ".join(memory_actions))
+memory_check()
+rerun_timer.mark("memory")
+
+# Runs cut short by st.rerun() are not recorded; the run that follows is
+st.session_state.last_rerun = get_metrics().record_rerun(
+    st.session_state.session_id,
+    rerun_timer.sections,
+    rerun_timer.total(),
+    memory_bytes
+)
@@ -0,0 +1,295 @@
+# Headless batch runner: sends every prompt in a JSONL file through the same
+# message pipeline as the app (attachments, extraction, prompt caching) and
+# streams one JSON result per line to the output file.
+#
+#   python batch.py prompts.jsonl -o results.jsonl [--concurrency 8]
+#   python batch.py prompts.jsonl -o results.jsonl --mode batches
+#
+# Input lines look like {"id": "q1", "prompt": "...", "attachments": ["report.pdf"]};
+# "system", "model", "max_tokens" and "temperature" override the defaults per
+# line. Attachment paths are relative to the input file. Runs are resumable:
+# input lines that already have a succeeded result in the output are skipped, and
+# submitted batches are tracked in <output>.batches.json, with the input line
+# behind every custom_id, so a restart polls them instead of submitting again.
+import argparse
+import base64
+import json
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import anthropic
+import httpx
+
+from extraction import needs_extraction, run_extraction
+from pipeline import build_user_message, decode_text, request_params, response_text, usage_summary
+from response_scanner import scan_response
+
+DEFAULT_MODEL = "claude-3-sonnet-20240229"
+DEFAULT_SYSTEM_PROMPT = "You are Claude, an AI assistant created by Anthropic. You're helpful, harmless, and honest."
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 4000
+# The Message Batches API takes up to 100,000 requests per batch
+MAX_BATCH_REQUESTS = 100000
+CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+
+def read_prompts(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            prompt = json.loads(line)
+            prompt.setdefault("id", f"line-{line_number}")
+            prompt["id"] = str(prompt["id"])
+            prompt["line"] = line_number
+            yield prompt
+
+# Input lines that already have a succeeded result. Results carry their input
+# line because prompt ids may repeat; a later result for the same line wins.
+def completed_lines(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            if result.get("status") == "succeeded":
+                done.add(result.get("line"))
+            else:
+                done.discard(result.get("line"))
+    done.discard(None)
+    return done
+
+# An attachment in the form build_user_message expects, read from disk
+def load_attachment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    name = os.path.basename(path)
+    file_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    extraction = run_extraction(file_type, name, lambda: data) if needs_extraction(file_type, name) else None
+    return {
+        "name": name,
+        "type": file_type,
+        "size": len(data),
+        "extraction": extraction,
+        "base64": lambda: base64.b64encode(data).decode("utf-8"),
+        "text": lambda: decode_text(file_type, data)
+    }
+
+def build_params(prompt, args, base_dir):
+    attachments = [load_attachment(os.path.join(base_dir, path)) for path in prompt.get("attachments", [])]
+    message = build_user_message(prompt["prompt"], attachments)
+    return request_params(
+        [message],
+        prompt.get("model", args.model),
+        prompt.get("system", args.system),
+        prompt.get("temperature", args.temperature),
+        prompt.get("max_tokens", args.max_tokens),
+        not args.no_prompt_caching
+    )
+
+def success_result(prompt_id, line, message, elapsed=None):
+    text = response_text(message)
+    result = {
+        "id": prompt_id,
+        "line": line,
+        "status": "succeeded",
+        "model": message.model,
+        "text": text,
+        "usage": usage_summary(message),
+        # Code blocks and tables, as the app saves them to the scratchpad
+        "artifacts": [a for a in scan_response(text) if a["type"] != "text"]
+    }
+    if elapsed is not None:
+        result["elapsed"] = round(elapsed, 3)
+    return result
+
+def error_result(prompt_id, line, error):
+    return {"id": prompt_id, "line": line, "status": "errored", "error": error}
+
+
+# Appends results to the output file as they arrive, one flushed line each
+class ResultWriter:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+        self.counts = {"succeeded": 0, "errored": 0}
+
+    def write(self, result):
+        line = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.counts[result["status"]] += 1
+
+    def close(self):
+        self._file.close()
+
+
+def make_client(args):
+    base_url = args.base_url or os.environ.get("ANTHROPIC_BASE_URL") or None
+    api_key = os.environ.get("ANTHROPIC_API_KEY") or ("mock" if base_url else None)
+    if not api_key:
+        sys.exit("Set ANTHROPIC_API_KEY (or --base-url for a mock server)")
+    http_client = anthropic.DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    )
+    return anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=args.max_retries,
+                               http_client=http_client)
+
+
+def run_one(client, prompt, args, base_dir):
+    start = time.perf_counter()
+    try:
+        params = build_params(prompt, args, base_dir)
+        message = client.messages.create(**params)
+        return success_result(prompt["id"], prompt["line"], message, time.perf_counter() - start)
+    except Exception as e:
+        return error_result(prompt["id"], prompt["line"], str(e))
+
+# Messages API with at most --concurrency requests in flight; prompts are read
+# lazily so huge input files are never held in memory
+def run_direct(client, prompts, args, base_dir, writer):
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        in_flight = set()
+        for prompt in prompts:
+            if len(in_flight) >= args.concurrency * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    writer.write(future.result())
+            in_flight.add(executor.submit(run_one, client, prompt, args, base_dir))
+        for future in wait(in_flight).done:
+            writer.write(future.result())
+
+
+def load_batch_state(path):
+    if not os.path.exists(path):
+        return {"batches": []}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_batch_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+# The prompt's own id when the API accepts it, else one from its line number,
+# with a numeric suffix if that custom_id is already in used. Repeated prompt
+# ids, and generated ids that match a literal one, get distinct custom_ids.
+def custom_id_for(prompt_id, line, used):
+    base = prompt_id if CUSTOM_ID_PATTERN.match(prompt_id) else f"req-{line}"
+    custom_id, suffix = base, 1
+    while custom_id in used:
+        suffix += 1
+        custom_id = f"{base[:63 - len(str(suffix))]}-{suffix}"
+    used.add(custom_id)
+    return custom_id
+
+# Message Batches API: submit in chunks of --batch-size, record each batch in
+# the state file as soon as it exists, then poll until every batch has ended
+def run_batches(client, prompts, args, base_dir, writer, state_path):
+    state = load_batch_state(state_path)
+    save_batch_state(state_path, state)
+    # Each batch maps its custom_ids to the prompt id and input line they came from
+    submitted = {ref["line"] for batch in state["batches"] for ref in batch["ids"].values()}
+    used = {custom_id for batch in state["batches"] for custom_id in batch["ids"]}
+
+    def submit(chunk):
+        requests = []
+        ids = {}
+        for prompt in chunk:
+            custom_id = custom_id_for(prompt["id"], prompt["line"], used)
+            try:
+                requests.append({"custom_id": custom_id, "params": build_params(prompt, args, base_dir)})
+                ids[custom_id] = {"id": prompt["id"], "line": prompt["line"]}
+            except Exception as e:
+                writer.write(error_result(prompt["id"], prompt["line"], str(e)))
+        if requests:
+            batch = client.messages.batches.create(requests=requests)
+            state["batches"].append({"batch_id": batch.id, "ids": ids})
+            save_batch_state(state_path, state)
+            print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+    chunk = []
+    for prompt in prompts:
+        if prompt["line"] in submitted:
+            continue
+        chunk.append(prompt)
+        if len(chunk) >= args.batch_size:
+            submit(chunk)
+            chunk = []
+    if chunk:
+        submit(chunk)
+
+    while state["batches"]:
+        for batch in list(state["batches"]):
+            info = client.messages.batches.retrieve(batch["batch_id"])
+            if info.processing_status != "ended":
+                continue
+            for entry in client.messages.batches.results(batch["batch_id"]):
+                ref = batch["ids"].get(entry.custom_id, {"id": entry.custom_id, "line": None})
+                if entry.result.type == "succeeded":
+                    writer.write(success_result(ref["id"], ref["line"], entry.result.message))
+                elif entry.result.type == "errored":
+                    writer.write(error_result(ref["id"], ref["line"], str(entry.result.error)))
+                else:
+                    writer.write(error_result(ref["id"], ref["line"], entry.result.type))
+            state["batches"].remove(batch)
+            save_batch_state(state_path, state)
+        if state["batches"]:
+            time.sleep(args.poll_seconds)
+    os.remove(state_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through Claude without the UI")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--mode", choices=["direct", "batches"], default="direct",
+                        help="direct: Messages API calls; batches: Message Batches API")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--system", default=DEFAULT_SYSTEM_PROMPT)
+    parser.add_argument("--temperature", type=float, default=DEFAULT_TEMPERATURE)
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS)
+    parser.add_argument("--no-prompt-caching", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight in direct mode")
+    parser.add_argument("--max-retries", type=int, default=4, help="client retries on rate limits and server errors")
+    parser.add_argument("--batch-size", type=int, default=10000, help="requests per submitted batch")
+    parser.add_argument("--poll-seconds", type=float, default=30.0, help="how often to check batch status")
+    parser.add_argument("--base-url", help="API base URL, e.g. a local mock_server.py")
+    args = parser.parse_args()
+    args.batch_size = min(args.batch_size, MAX_BATCH_REQUESTS)
+
+    base_dir = os.path.dirname(os.path.abspath(args.input))
+    done = completed_lines(args.output)
+    prompts = (prompt for prompt in read_prompts(args.input) if prompt["line"] not in done)
+    if done:
+        print(f"Skipping {len(done):,} prompts already completed in {args.output}")
+
+    client = make_client(args)
+    writer = ResultWriter(args.output)
+    start = time.perf_counter()
+    try:
+        if args.mode == "batches":
+            run_batches(client, prompts, args, base_dir, writer, args.output + ".batches.json")
+        else:
+            run_direct(client, prompts, args, base_dir, writer)
+    finally:
+        writer.close()
+    print(f"{writer.counts['succeeded']:,} succeeded, {writer.counts['errored']:,} errored "
+          f"in {time.perf_counter() - start:.1f}s")
+    return 1 if writer.counts["errored"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+# Benchmark for what a script rerun costs as a session grows: chat history
+# length, scratchpad size, upload size and chart rows. Drives app.py through
+# Streamlit's AppTest with a stub in place of anthropic.Anthropic, and runs
+# each case in its own process so peak RSS belongs to that case alone.
+#
+#   python benchmarks/bench_app_rerun.py [--quick] [-o results.json] [--baseline old.json]
+#
+# For every case it records the first rerun after the session reached that
+# size, the median idle rerun, a full chat turn, the bytes of ForwardMsgs and
+# media each would send to the browser, the app's own per-section timings and
+# the peak RSS. Results are JSON; with --baseline, cases that got slower or
+# bigger by more than --tolerance are listed and the exit status is 1.
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_PATH = os.path.join(ROOT, "app.py")
+
+MB = 1024 * 1024
+SWEEPS = {
+    "history": [10, 100, 1000],
+    "scratchpad": [10, 100, 1000, 10000],
+    "upload": [1024, MB, 10 * MB, 50 * MB],
+    "chart": [1000, 100_000, 1_000_000],
+}
+QUICK_SWEEPS = {
+    "history": [10, 100],
+    "scratchpad": [10, 1000],
+    "upload": [1024, MB],
+    "chart": [1000, 100_000],
+}
+# Result fields compared against a baseline
+COMPARED_FIELDS = ["load_ms", "rerun_ms", "app_rerun_ms", "turn_ms", "rerun_bytes", "turn_bytes", "media_bytes", "peak_rss_mb"]
+
+REPLY = (
+    "Here is a helper:\n```python\ndef total(values):\n    return sum(values)\n```\n\n"
+    "| name | value |\n| --- | --- |\n| a | 1 |\n| b | 2 |\n\nLet me know if you need more."
+)
+
+
+# Stand-in for anthropic.Anthropic: every request gets REPLY, streamed in small chunks
+class StubMessages:
+    def _message(self, model):
+        return SimpleNamespace(
+            id="msg_stub",
+            model=model,
+            stop_reason="end_turn",
+            content=[SimpleNamespace(type="text", text=REPLY)],
+            usage=SimpleNamespace(input_tokens=100, output_tokens=50,
+                                  cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        )
+
+    def create(self, model, **kwargs):
+        return self._message(model)
+
+    def stream(self, model, **kwargs):
+        messages = self
+
+        class Stream:
+            text_stream = (REPLY[i:i + 8] for i in range(0, len(REPLY), 8))
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def get_final_message(self):
+                return messages._message(model)
+
+        return Stream()
+
+    def count_tokens(self, messages, **kwargs):
+        return SimpleNamespace(input_tokens=len(json.dumps(messages)) // 4)
+
+
+class StubAnthropic:
+    def __init__(self, *args, **kwargs):
+        self.messages = StubMessages()
+
+    def close(self):
+        pass
+
+
+# Count what each run would send: ForwardMsg bytes, and media files the first time they are stored
+def install_byte_counters():
+    from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+
+    counts = {"forward": 0, "media": 0}
+    stored_media = set()
+    enqueue = ForwardMsgQueue.enqueue
+    load_and_get_id = MemoryMediaFileStorage.load_and_get_id
+
+    def counting_enqueue(self, msg):
+        counts["forward"] += msg.ByteSize()
+        return enqueue(self, msg)
+
+    def counting_load_and_get_id(self, path_or_data, *args, **kwargs):
+        file_id = load_and_get_id(self, path_or_data, *args, **kwargs)
+        if file_id not in stored_media and isinstance(path_or_data, bytes):
+            stored_media.add(file_id)
+            counts["media"] += len(path_or_data)
+        return file_id
+
+    ForwardMsgQueue.enqueue = counting_enqueue
+    MemoryMediaFileStorage.load_and_get_id = counting_load_and_get_id
+    return counts
+
+
+# Each prepare function grows the session to the given size and returns the
+# run that follows, which is timed as load_ms
+def prepare_history(at, turns):
+    messages = []
+    for turn in range(turns):
+        messages.append({"id": 2 * turn, "role": "user", "content": f"Question {turn}: how do I sum a list?"})
+        messages.append({"id": 2 * turn + 1, "role": "assistant", "content": REPLY})
+    at.session_state.messages = messages
+    at.session_state.next_message_id = len(messages)
+    # Show every turn, so the cost grows with the history rather than the page size
+    at.session_state.transcript_turns = turns
+    search_index = at.session_state.search_index
+    for message in messages:
+        search_index.add(("msg", message["id"]), "message", message["content"],
+                         f"{message['role'].capitalize()} message #{message['id'] + 1}")
+    return at.run
+
+def prepare_scratchpad(at, items):
+    scratchpad = at.session_state.scratchpad
+    for i in range(items):
+        scratchpad.add(f"snippet_{i}", "code",
+                       {"language": "python", "code": f"def f{i}(x):\n    return x * {i}\n"}, "2024-01-01 00:00:00")
+    return at.run
+
+def prepare_upload(at, size):
+    line = b"timestamp,sensor,reading,status\n"
+    data = (line * (size // len(line) + 1))[:size]
+    at.file_uploader[0].upload("upload.txt", data, "text/plain")
+    return at.run
+
+def prepare_chart(at, rows):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({
+        "date": pd.date_range("2024-01-01", periods=rows, freq="min"),
+        "value1": rng.standard_normal(rows).cumsum(),
+        "value2": rng.integers(0, 100, size=rows),
+        "category": rng.choice(np.array(["A", "B", "C"], dtype=object), size=rows),
+    })
+    at.session_state.chart_data = data
+    at.session_state.chart_data_memory = int(data.memory_usage(deep=True).sum())
+    at.run()
+    button = next(b for b in at.sidebar.button if b.label == "Visualize Data")
+    return button.click().run
+
+PREPARE = {
+    "history": prepare_history,
+    "scratchpad": prepare_scratchpad,
+    "upload": prepare_upload,
+    "chart": prepare_chart,
+}
+
+
+def timed_run(run, counts):
+    before = counts["forward"]
+    start = time.perf_counter()
+    at = run()
+    ms = (time.perf_counter() - start) * 1000
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return ms, counts["forward"] - before
+
+# One case in this process; prints its result as JSON
+def run_case(kind, size, repeats):
+    import anthropic
+    anthropic.Anthropic = StubAnthropic
+    from streamlit.testing.v1 import AppTest
+
+    counts = install_byte_counters()
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.run()
+    at.session_state.api_key = "stub"
+
+    load = PREPARE[kind](at, size)
+    load_ms, _ = timed_run(load, counts)
+
+    reruns = [timed_run(at.run, counts) for _ in range(repeats)]
+    # The app's own timing of the last idle rerun, without AppTest's overhead
+    last_rerun = at.session_state.last_rerun
+    # Session size is only sampled now and then; take a fresh sample outside the timed runs
+    del at.session_state["memory_sample"]
+    at.run()
+    memory_bytes = at.session_state.last_rerun["memory_bytes"]
+
+    turn_ms, turn_bytes = timed_run(at.chat_input[0].set_value("One more question").run, counts)
+
+    return {
+        "name": f"{kind}-{size}",
+        "kind": kind,
+        "size": size,
+        "load_ms": round(load_ms, 2),
+        "rerun_ms": round(statistics.median(ms for ms, _ in reruns), 2),
+        "app_rerun_ms": round(last_rerun["total"] * 1000, 2),
+        "turn_ms": round(turn_ms, 2),
+        "rerun_bytes": reruns[-1][1],
+        "turn_bytes": turn_bytes,
+        "media_bytes": counts["media"],
+        "session_memory_bytes": memory_bytes,
+        "sections_ms": {section: round(seconds * 1000, 2) for section, seconds in last_rerun["sections"].items()},
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (MB if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+# Run one case in a fresh process with its own blob and cache directories
+def run_case_process(kind, size, repeats):
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = dict(os.environ,
+                   CLAUDE_UI_STORAGE="memory",
+                   CLAUDE_UI_BLOB_DIR=os.path.join(work_dir, "blobs"),
+                   CLAUDE_UI_RESPONSE_CACHE_DIR=os.path.join(work_dir, "responses"))
+        env.pop("CLAUDE_UI_METRICS_PORT", None)
+        env.pop("CLAUDE_UI_METRICS_JSONL", None)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--case", f"{kind}:{size}", "--repeats", str(repeats)],
+            capture_output=True, text=True, env=env, cwd=work_dir
+        )
+    if completed.returncode != 0:
+        error = (completed.stderr.strip().splitlines() or ["failed"])[-1]
+        return {"name": f"{kind}-{size}", "kind": kind, "size": size, "error": error}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# Cases whose compared fields grew by more than tolerance over the baseline
+def find_regressions(results, baseline, tolerance):
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = previous.get(case["name"])
+        if old is None or "error" in case or "error" in old:
+            continue
+        for field in COMPARED_FIELDS:
+            if old.get(field) and case[field] > old[field] * (1 + tolerance):
+                regressions.append((case["name"], field, old[field], case[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app.py reruns against session size with a stubbed API")
+    parser.add_argument("--quick", action="store_true", help="smaller sweep for a fast check")
+    parser.add_argument("--only", help="comma-separated sweeps to run: " + ", ".join(SWEEPS))
+    parser.add_argument("--repeats", type=int, default=5, help="idle reruns per case; the median is reported")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth over the baseline (0.25 = 25%%)")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        kind, size = args.case.split(":")
+        print(json.dumps(run_case(kind, int(size), args.repeats)))
+        return 0
+
+    sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+    kinds = args.only.split(",") if args.only else list(sweeps)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeats": args.repeats,
+        "cases": [],
+    }
+
+    print(f"{'case':22} {'load ms':>9} {'rerun ms':>9} {'app ms':>9} {'turn ms':>9} {'rerun KB':>9} {'media KB':>9} {'RSS MB':>8}")
+    for kind in kinds:
+        for size in sweeps[kind]:
+            case = run_case_process(kind, size, args.repeats)
+            results["cases"].append(case)
+            if "error" in case:
+                print(f"{case['name']:22} error: {case['error']}")
+            else:
+                print(f"{case['name']:22} {case['load_ms']:9.1f} {case['rerun_ms']:9.1f} {case['app_rerun_ms']:9.1f} "
+                      f"{case['turn_ms']:9.1f} "
+                      f"{case['rerun_bytes'] / 1024:9.1f} {case['media_bytes'] / 1024:9.1f} {case['peak_rss_mb']:8.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    failed = any("error" in case for case in results["cases"])
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for name, field, old, new in regressions:
+            print(f"REGRESSION {name} {field}: {old} -> {new}")
+        if regressions:
+            failed = True
+        else:
+            print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+# Benchmark for the chart downsampling stage across frame sizes.
+#
+#   python benchmarks/bench_downsampling.py [--sizes 10000,100000,1000000,10000000]
+#
+# Prints one row per (rows, chart type) with the time taken and the number of
+# rows that would reach matplotlib.
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from downsampling import downsample_for_chart
+
+CHART_TYPES = ["Line Chart", "Scatter Plot", "Bar Chart", "Pie Chart", "Heatmap"]
+
+
+def make_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "value1": rng.standard_normal(rows).cumsum(),
+        "value2": rng.integers(0, 100, size=rows).astype("int64"),
+        "value3": rng.random(rows),
+        "category": rng.choice(np.array(["A", "B", "C", "D", "E"], dtype=object), size=rows),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chart downsampling")
+    parser.add_argument("--sizes", default="10000,100000,1000000,10000000",
+                        help="comma-separated row counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the best is reported")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'chart':14} {'seconds':>9} {'rendered':>9} method")
+    for rows in [int(size) for size in args.sizes.split(",")]:
+        data = make_frame(rows)
+        for chart_type in CHART_TYPES:
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                _, info = downsample_for_chart(data, chart_type)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{rows:>10} {chart_type:14} {best:9.4f} {info['rendered_rows']:>9} {info['method']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# Regression benchmark for the response scanner on adversarial ~1 MB replies.
+#
+#   python benchmarks/bench_response_scanner.py [--size BYTES] [--max-seconds S]
+#
+# Exits non-zero if any case takes longer than --max-seconds.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from response_scanner import ResponseScanner, scan_response
+
+
+def repeat_to_size(unit, size):
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+# Inputs that stress backtracking-prone patterns: long pipe runs, tables that
+# never complete, fences that never close and huge single lines
+def adversarial_inputs(size):
+    return {
+        "single_line_pipes": "|" * size,
+        "pipe_rows_no_separator": repeat_to_size("| a | b | c |\n", size),
+        "headers_and_separators_only": repeat_to_size("| a | b |\n|---|---|\ntext\n", size),
+        "one_huge_table": "| h1 | h2 |\n|---|---|\n" + repeat_to_size("| 1 | 2 |\n", size),
+        "unclosed_fence": "```python\n" + repeat_to_size("x = '| a | b |'\n", size),
+        "many_small_fences": repeat_to_size("```py\nx\n```\n", size),
+        "long_line_with_pipes": repeat_to_size("word |" * 1000 + "\n", size),
+        "backticks_and_pipes": repeat_to_size("``|`|``||`\n", size),
+    }
+
+
+def time_case(text, chunk_size=None):
+    start = time.perf_counter()
+    if chunk_size is None:
+        artifacts = scan_response(text)
+    else:
+        scanner = ResponseScanner()
+        for i in range(0, len(text), chunk_size):
+            scanner.feed(text[i:i + chunk_size])
+        scanner.close()
+        artifacts = scanner.artifacts
+    return time.perf_counter() - start, len(artifacts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the response scanner on adversarial inputs")
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="bytes per input")
+    parser.add_argument("--chunk-size", type=int, default=16, help="chunk size for the streamed variant")
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="fail if any case is slower")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'case':32} {'mode':9} {'seconds':>9} {'MB/s':>8} {'artifacts':>10}")
+    for name, text in adversarial_inputs(args.size).items():
+        for mode, chunk_size in (("whole", None), ("streamed", args.chunk_size)):
+            seconds, count = time_case(text, chunk_size)
+            rate = len(text) / seconds / 1e6 if seconds else float("inf")
+            flag = ""
+            if seconds > args.max_seconds:
+                failed = True
+                flag = "  SLOW"
+            print(f"{name:32} {mode:9} {seconds:9.4f} {rate:8.1f} {count:10d}{flag}")
+
+    if failed:
+        print(f"FAIL: at least one case exceeded {args.max_seconds}s")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
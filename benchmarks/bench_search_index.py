@@ -0,0 +1,84 @@
+# Benchmark for building and querying the search index at scratchpad scale.
+#
+#   python benchmarks/bench_search_index.py [--docs N] [--max-query-ms MS]
+#
+# Exits non-zero if any query takes longer than --max-query-ms.
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from search_index import SearchIndex
+
+KINDS = ["message", "code", "table", "text"]
+LANGUAGES = ["python", "javascript", "sql", "bash"]
+
+
+# Synthetic documents: a Zipf-like vocabulary so a few terms are very common
+# and most are rare, as in real chat text and code
+def make_documents(count, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(20000)]
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    for i in range(count):
+        kind = KINDS[i % len(KINDS)]
+        words = rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(20, 120))
+        language = rng.choice(LANGUAGES) if kind == "code" else None
+        yield ("doc", i), kind, " ".join(words), f"{kind}_{i}", language
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scratchpad and chat search index")
+    parser.add_argument("--docs", type=int, default=100000, help="documents to index")
+    parser.add_argument("--max-query-ms", type=float, default=50.0, help="fail if any query is slower")
+    args = parser.parse_args()
+
+    index = SearchIndex()
+    start = time.perf_counter()
+    for key, kind, text, title, language in make_documents(args.docs):
+        index.add(key, kind, text, title, language)
+    build_seconds = time.perf_counter() - start
+    print(f"indexed {len(index):,} docs in {build_seconds:.2f}s "
+          f"({build_seconds / len(index) * 1e6:.1f} µs per doc, {len(index.postings):,} terms)")
+
+    queries = [
+        ("common term", "term0", None, None),
+        ("two common terms", "term0 term1", None, None),
+        ("rare term", "term15000", None, None),
+        ("common + rare", "term0 term9000", None, None),
+        ("code in python", "term0", {"code"}, "python"),
+        ("messages only", "term2 term3", {"message"}, None),
+        ("no match", "nothing_here", None, None),
+    ]
+
+    failed = False
+    print(f"{'query':20} {'ms':>8} {'results':>8}")
+    for name, query, kinds, language in queries:
+        start = time.perf_counter()
+        results = index.search(query, kinds=kinds, language=language)
+        ms = (time.perf_counter() - start) * 1000
+        flag = ""
+        if ms > args.max_query_ms:
+            failed = True
+            flag = "  SLOW"
+        print(f"{name:20} {ms:8.2f} {len(results):8d}{flag}")
+
+    # Incremental updates: replace and remove documents in an existing index
+    start = time.perf_counter()
+    for key, kind, text, title, language in make_documents(1000, seed=1):
+        index.add(key, kind, text, title, language)
+        index.remove(key)
+    print(f"1,000 update + remove pairs in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    if failed:
+        print(f"FAIL: at least one query exceeded {args.max_query_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
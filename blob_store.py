@@ -0,0 +1,241 @@
+# Content-addressed blob store on local disk for chart images and uploaded
+# files. Session state keeps only the SHA-256 of each blob; the bytes are read
+# through mmap when they are actually shown or sent. One store is shared by all
+# sessions in the process, with a per-session and a global quota. Blobs a
+# session pins, such as uploads not sent yet, are never given up to a quota;
+# a put that only fits by dropping them fails instead.
+import atexit
+import base64
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+# Raised by put when the blob does not fit without dropping pinned blobs
+class BlobStoreFull(Exception):
+    pass
+
+
+# A new directory only this user can read, removed when the process exits
+def private_directory(prefix):
+    root = tempfile.mkdtemp(prefix=prefix)
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
+class BlobStore:
+    def __init__(self, root, quota_bytes, session_quota_bytes):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.session_quota_bytes = session_quota_bytes
+        self._lock = threading.Lock()
+        # blob hash -> size, least recently used first
+        self._blobs = OrderedDict()
+        # session id -> OrderedDict of the blobs it references, least recently used first
+        self._sessions = {}
+        # blob hash -> number of sessions referencing it
+        self._refcounts = {}
+        # session id -> blobs it has pinned, and blob hash -> number of pins
+        self._pins = {}
+        self._pincounts = {}
+        self.total_bytes = 0
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        self._scan()
+
+    # Pick up blobs left by an earlier run, oldest first
+    def _scan(self):
+        found = []
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(".tmp"):
+                    os.remove(os.path.join(directory, name))
+                    continue
+                stat = os.stat(os.path.join(directory, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, blob_hash, size in sorted(found):
+            self._blobs[blob_hash] = size
+            self.total_bytes += size
+
+    def _path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    # Store bytes for a session and return their hash. A pinned blob stays
+    # until the session releases it. Raises BlobStoreFull, leaving the store as
+    # it was, if the quotas can only be met by dropping pinned blobs.
+    def put(self, data, session_id, pin=False):
+        blob_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            created = blob_hash not in self._blobs
+            referenced = blob_hash in self._sessions.get(session_id, {})
+            pinned = blob_hash in self._pins.get(session_id, ())
+            if created:
+                path = self._path(blob_hash)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename, so readers never see a partial blob
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._blobs[blob_hash] = len(data)
+                self.total_bytes += len(data)
+            self._blobs.move_to_end(blob_hash)
+            self._reference(session_id, blob_hash)
+            if pin:
+                self._pin(session_id, blob_hash)
+            if not (self._enforce_session_quota(session_id, blob_hash) and self._enforce_quota(blob_hash)):
+                if pin and not pinned:
+                    self._unpin(session_id, blob_hash)
+                if not referenced:
+                    self._unreference(session_id, blob_hash)
+                if created and blob_hash not in self._refcounts:
+                    self._delete(blob_hash)
+                raise BlobStoreFull(f"No room for {len(data):,} bytes without dropping files still in use")
+        return blob_hash
+
+    def _reference(self, session_id, blob_hash):
+        refs = self._sessions.setdefault(session_id, OrderedDict())
+        if blob_hash not in refs:
+            refs[blob_hash] = self._blobs[blob_hash]
+            self._refcounts[blob_hash] = self._refcounts.get(blob_hash, 0) + 1
+        refs.move_to_end(blob_hash)
+
+    def _unreference(self, session_id, blob_hash):
+        refs = self._sessions.get(session_id)
+        if refs is None or refs.pop(blob_hash, None) is None:
+            return
+        self._refcounts[blob_hash] -= 1
+        if not self._refcounts[blob_hash]:
+            del self._refcounts[blob_hash]
+
+    def _pin(self, session_id, blob_hash):
+        pins = self._pins.setdefault(session_id, set())
+        if blob_hash not in pins:
+            pins.add(blob_hash)
+            self._pincounts[blob_hash] = self._pincounts.get(blob_hash, 0) + 1
+
+    def _unpin(self, session_id, blob_hash):
+        pins = self._pins.get(session_id)
+        if pins is None or blob_hash not in pins:
+            return
+        pins.discard(blob_hash)
+        if not pins:
+            del self._pins[session_id]
+        self._pincounts[blob_hash] -= 1
+        if not self._pincounts[blob_hash]:
+            del self._pincounts[blob_hash]
+
+    # A session over its quota gives up its least recently used unpinned blobs,
+    # other than keep. They stay on disk, but become the first to go under
+    # global pressure. Returns whether the session fits, counting a single blob
+    # larger than the quota as fitting.
+    def _enforce_session_quota(self, session_id, keep=None):
+        refs = self._sessions[session_id]
+        pins = self._pins.get(session_id, ())
+        for blob_hash in [h for h in refs if h != keep and h not in pins]:
+            if sum(refs.values()) <= self.session_quota_bytes:
+                break
+            self._unreference(session_id, blob_hash)
+        return len(refs) <= 1 or sum(refs.values()) <= self.session_quota_bytes
+
+    # Delete least recently used blobs other than keep until the store fits its
+    # quota, starting with blobs no session references. Pinned blobs are never
+    # deleted. Returns whether the store fits.
+    def _enforce_quota(self, keep=None):
+        for referenced in (False, True):
+            for blob_hash in [h for h in self._blobs if (h in self._refcounts) == referenced
+                              and h != keep and h not in self._pincounts]:
+                if self.total_bytes <= self.quota_bytes:
+                    return True
+                self._delete(blob_hash)
+        return self.total_bytes <= self.quota_bytes
+
+    def _delete(self, blob_hash):
+        self.total_bytes -= self._blobs.pop(blob_hash)
+        for session_id in list(self._sessions):
+            self._unreference(session_id, blob_hash)
+        try:
+            os.remove(self._path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, blob_hash):
+        return blob_hash in self._blobs
+
+    # Mark a blob as used by a session, e.g. one restored from storage
+    def touch(self, blob_hash, session_id):
+        with self._lock:
+            if blob_hash not in self._blobs:
+                return False
+            self._blobs.move_to_end(blob_hash)
+            self._reference(session_id, blob_hash)
+            self._enforce_session_quota(session_id, blob_hash)
+            return True
+
+    # Keep a blob the session already stored until it releases or unpins it
+    def pin(self, blob_hash, session_id):
+        with self._lock:
+            if blob_hash not in self._blobs:
+                return False
+            self._reference(session_id, blob_hash)
+            self._pin(session_id, blob_hash)
+            return True
+
+    # Let pinned blobs go under quota pressure again, still referenced
+    def unpin(self, session_id, blob_hashes):
+        with self._lock:
+            for blob_hash in blob_hashes:
+                self._unpin(session_id, blob_hash)
+
+    # Run fn over a read-only mmap of the blob; None if it has been evicted
+    def _with_mmap(self, blob_hash, fn):
+        with self._lock:
+            if blob_hash not in self._blobs:
+                return None
+            self._blobs.move_to_end(blob_hash)
+        try:
+            with open(self._path(blob_hash), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return fn(b"")
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return fn(mapped)
+        except FileNotFoundError:
+            return None
+
+    # With verify, None as well if the bytes on disk no longer match the hash
+    def read(self, blob_hash, verify=False):
+        data = self._with_mmap(blob_hash, bytes)
+        if verify and data is not None and hashlib.sha256(data).hexdigest() != blob_hash:
+            return None
+        return data
+
+    # Base64 text straight from the mapped file, without a full bytes copy first
+    def read_base64(self, blob_hash):
+        return self._with_mmap(blob_hash, lambda mapped: base64.b64encode(mapped).decode("utf-8"))
+
+    # Drop a session's references and pins for blobs it no longer uses
+    def release(self, session_id, blob_hashes):
+        with self._lock:
+            for blob_hash in blob_hashes:
+                self._unpin(session_id, blob_hash)
+                self._unreference(session_id, blob_hash)
+
+    # Drop everything a session references, when it has ended, or everything
+    # but its pinned blobs, when it has gone idle
+    def release_session(self, session_id, keep_pinned=False):
+        with self._lock:
+            pins = self._pins.get(session_id, set())
+            for blob_hash in [h for h in self._sessions.get(session_id, ()) if not (keep_pinned and h in pins)]:
+                self._unpin(session_id, blob_hash)
+                self._unreference(session_id, blob_hash)
+            if not self._sessions.get(session_id, True):
+                del self._sessions[session_id]
+
+    def session_bytes(self, session_id):
+        return sum(self._sessions.get(session_id, {}).values())
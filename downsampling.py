@@ -0,0 +1,139 @@
+# Vectorized downsampling that runs in front of create_chart, so very large
+# frames are reduced to roughly as many points as a chart can show before
+# matplotlib ever sees them.
+import numpy as np
+import pandas as pd
+
+# Target number of plotted points/rows per chart type
+MAX_LINE_POINTS = 4000
+MAX_SCATTER_POINTS = 5000
+MAX_BARS = 200
+MAX_PIE_SLICES = 12
+# Every category keeps at least this many points in a stratified scatter sample
+MIN_POINTS_PER_CATEGORY = 20
+# Fixed seed so the same data always yields the same sample (and chart cache key)
+SAMPLE_SEED = 0
+
+
+# Same column selection as draw_chart in app.py
+def numeric_columns(data):
+    return data.select_dtypes(include=['number']).columns
+
+def categorical_columns(data):
+    return data.select_dtypes(include=['object', 'category']).columns
+
+
+# Row positions of the first, min and max value of each bucket, for every series.
+# Keeps peaks and troughs that uniform sampling would lose.
+def minmax_bucket_indices(values, buckets):
+    n = values.shape[0]
+    bucket_size = -(-n // buckets)
+    buckets = -(-n // bucket_size)
+    padded = np.full((buckets * bucket_size, values.shape[1]), np.nan)
+    padded[:n] = values
+
+    starts = np.arange(buckets) * bucket_size
+    selected = [starts]
+    for col in range(values.shape[1]):
+        grid = padded[:, col].reshape(buckets, bucket_size)
+        missing = np.isnan(grid)
+        selected.append(starts + np.where(missing, np.inf, grid).argmin(axis=1))
+        selected.append(starts + np.where(missing, -np.inf, grid).argmax(axis=1))
+
+    indices = np.unique(np.concatenate(selected))
+    return indices[indices < n]
+
+def downsample_line(data, max_points=MAX_LINE_POINTS):
+    series = [c for c in numeric_columns(data) if c != 'date']
+    if len(data) <= max_points or not series:
+        return data, "none"
+    # Each bucket contributes up to 1 + 2 * len(series) rows
+    buckets = max(1, max_points // (1 + 2 * len(series)))
+    values = data[series].to_numpy(dtype=float)
+    return data.iloc[minmax_bucket_indices(values, buckets)], "min/max bucketing"
+
+# Random sample that keeps every category represented, roughly in proportion.
+# Rows with a missing category are dropped.
+def downsample_scatter(data, max_points=MAX_SCATTER_POINTS):
+    n = len(data)
+    if n <= max_points:
+        return data, "none"
+
+    rng = np.random.default_rng(SAMPLE_SEED)
+    categorical_cols = categorical_columns(data)
+    if len(categorical_cols) == 0:
+        indices = np.sort(rng.choice(n, size=max_points, replace=False))
+        return data.iloc[indices], "uniform sample"
+
+    codes, _ = pd.factorize(data[categorical_cols[0]])
+    counts = np.bincount(codes[codes >= 0])
+    quotas = np.maximum(counts * (max_points / n), MIN_POINTS_PER_CATEGORY)
+
+    # Keep each row with its category's rate; one O(n) pass, no sorting or grouping
+    rates = np.append(np.minimum(quotas / np.maximum(counts, 1), 1.0), 0.0)
+    keep = rng.random(n) < rates[codes]
+    return data.iloc[np.flatnonzero(keep)], "stratified sample"
+
+def aggregate_bar(data, max_bars=MAX_BARS):
+    numeric_cols = numeric_columns(data)
+    if len(numeric_cols) == 0:
+        return data, "none"
+    categorical_cols = categorical_columns(data)
+
+    # Grouped bars only need the per-category means that draw_chart plots
+    if len(categorical_cols) > 0:
+        category_col, value_col = categorical_cols[0], numeric_cols[0]
+        grouped = data.groupby(category_col, sort=True, observed=True)[value_col].mean().reset_index()
+        if len(grouped) == len(data):
+            return data, "none"
+        return grouped, "per-category means"
+
+    if len(data) <= max_bars:
+        return data, "none"
+    value_col = numeric_cols[0]
+    buckets = np.arange(len(data)) * max_bars // len(data)
+    means = data[value_col].groupby(buckets).mean().reset_index(drop=True)
+    return pd.DataFrame({value_col: means.astype(float)}), "bucket means"
+
+# Category counts with the long tail folded into "Other"
+def aggregate_pie(data, max_slices=MAX_PIE_SLICES):
+    categorical_cols = categorical_columns(data)
+    if len(categorical_cols) == 0:
+        return data, "none"
+    category_col = categorical_cols[0]
+    counts = data[category_col].value_counts()
+    counts = counts[counts > 0]
+    if len(counts) > max_slices:
+        other = counts.iloc[max_slices - 1:].sum()
+        counts = pd.concat([counts.iloc[:max_slices - 1], pd.Series({"Other": other})])
+    # The category column may itself be called "count"
+    count_col = "count_" if category_col == "count" else "count"
+    aggregated = pd.DataFrame({
+        category_col: pd.Series(counts.index, dtype=object),
+        count_col: counts.to_numpy(dtype="int64")
+    })
+    # Tells draw_chart the slices are already counted
+    aggregated.attrs["count_column"] = count_col
+    return aggregated, "category counts"
+
+
+# Reduce a frame for the given chart type. Returns the frame to plot and a
+# summary of original vs rendered rows.
+def downsample_for_chart(data, chart_type):
+    if chart_type == "Line Chart":
+        reduced, method = downsample_line(data)
+    elif chart_type == "Scatter Plot":
+        reduced, method = downsample_scatter(data)
+    elif chart_type == "Bar Chart":
+        reduced, method = aggregate_bar(data)
+    elif chart_type == "Pie Chart":
+        reduced, method = aggregate_pie(data)
+    else:
+        # Heatmaps plot a correlation matrix, which is already small
+        reduced, method = data, "none"
+
+    return reduced, {
+        "original_rows": len(data),
+        "rendered_rows": len(reduced),
+        "method": method
+    }
@@ -0,0 +1,208 @@
+# Background extraction for attachments that cannot be sent as plain text.
+# PDFs go to Claude as native document blocks when they fit the API limits,
+# otherwise as page-wise text; XLSX workbooks are converted to CSV per sheet;
+# images are downscaled and re-encoded. Work runs on a thread pool and results
+# are cached by content hash, so the UI only ever polls for a status.
+import functools
+import io
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Claude accepts PDF document blocks up to 100 pages and 32 MB per request
+PDF_DOCUMENT_MAX_PAGES = 100
+PDF_DOCUMENT_MAX_BYTES = 24 * 1024 * 1024
+# Caps for text that is inlined into the prompt
+PDF_TEXT_MAX_CHARS = 400_000
+XLSX_MAX_ROWS = 1000
+XLSX_MAX_SHEETS = 20
+
+# Claude downsizes images beyond this long edge or pixel count anyway, so
+# larger images only cost upload time
+IMAGE_MAX_EDGE = 1568
+IMAGE_MAX_PIXELS = 1_150_000
+IMAGE_QUALITY = 85
+
+PDF_TYPES = {"application/pdf"}
+XLSX_TYPES = {"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+
+
+def needs_extraction(file_type, name=""):
+    name = name.lower()
+    return (file_type in PDF_TYPES or file_type in XLSX_TYPES or file_type.startswith("image/")
+            or name.endswith((".pdf", ".xlsx")))
+
+def is_pdf(file_type, name=""):
+    return file_type in PDF_TYPES or name.lower().endswith(".pdf")
+
+
+# Page count, plus the text of every page when the PDF is too large to send as a
+# document. progress(done, total, unit) is called as pages are read.
+def extract_pdf(data, progress=None):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        # Without pypdf the file can still go as a document if it is small enough
+        if len(data) <= PDF_DOCUMENT_MAX_BYTES:
+            return {"document": True, "pages": None, "summary": "sent as PDF document"}
+        raise RuntimeError("Install pypdf to extract text from large PDFs")
+
+    reader = PdfReader(io.BytesIO(data))
+    pages = len(reader.pages)
+    if pages <= PDF_DOCUMENT_MAX_PAGES and len(data) <= PDF_DOCUMENT_MAX_BYTES:
+        return {"document": True, "pages": pages, "summary": f"{pages} pages, sent as PDF document"}
+
+    parts = []
+    total = 0
+    truncated = False
+    for number, page in enumerate(reader.pages, start=1):
+        page_text = f"--- Page {number} ---\n{(page.extract_text() or '').strip()}\n"
+        if total + len(page_text) > PDF_TEXT_MAX_CHARS:
+            truncated = True
+            parts.append(f"[Text truncated after page {number - 1} of {pages}]")
+            break
+        parts.append(page_text)
+        total += len(page_text)
+        if progress is not None:
+            progress(number, pages, "pages")
+    summary = f"{pages} pages, sent as text" + (" (truncated)" if truncated else "")
+    return {"document": False, "pages": pages, "text": "\n".join(parts), "summary": summary}
+
+# Every sheet as CSV, capped at XLSX_MAX_ROWS rows each. Sheets are read one at
+# a time, calling progress(done, total, unit) after each.
+def extract_xlsx(data, progress=None):
+    import pandas as pd
+
+    workbook = pd.ExcelFile(io.BytesIO(data))
+    sheets = workbook.sheet_names
+    parts = []
+    total_rows = 0
+    for index, sheet_name in enumerate(sheets):
+        if index == XLSX_MAX_SHEETS:
+            parts.append(f"[{len(sheets) - XLSX_MAX_SHEETS} more sheets not included]")
+            break
+        frame = workbook.parse(sheet_name, nrows=XLSX_MAX_ROWS + 1)
+        note = ""
+        if len(frame) > XLSX_MAX_ROWS:
+            frame = frame.head(XLSX_MAX_ROWS)
+            note = f" (first {XLSX_MAX_ROWS} rows)"
+        total_rows += len(frame)
+        parts.append(f"Sheet: {sheet_name}{note}\n{frame.to_csv(index=False)}")
+        if progress is not None:
+            progress(index + 1, min(len(sheets), XLSX_MAX_SHEETS), "sheets")
+    summary = f"{len(sheets)} sheet(s), {total_rows:,} rows as CSV"
+    return {"document": False, "text": "\n".join(parts), "summary": summary}
+
+def image_scale(width, height):
+    return min(1.0, IMAGE_MAX_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+
+# Downscale to what the model can use and re-encode without metadata: JPEG for
+# opaque images, WebP when there is transparency. Animated images, and small
+# ones that would only grow, are sent as they are.
+def preprocess_image(data):
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if getattr(image, "is_animated", False):
+        return {"document": False, "summary": f"{width}×{height} animated, sent as is"}
+
+    # Let JPEG decoding skip detail that is about to be thrown away
+    scale = image_scale(width, height)
+    image.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+    image = ImageOps.exif_transpose(image)
+    scale = image_scale(*image.size)
+    resized = scale < 1 or image.size != (width, height)
+    if scale < 1:
+        image = image.resize((max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))), Image.LANCZOS)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    output = io.BytesIO()
+    if has_alpha:
+        image.convert("RGBA").save(output, format="WEBP", quality=IMAGE_QUALITY)
+        media_type, label = "image/webp", "WebP"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=IMAGE_QUALITY, optimize=True)
+        media_type, label = "image/jpeg", "JPEG"
+
+    # A small image that re-encodes larger is better sent as uploaded
+    if not resized and output.tell() >= len(data):
+        return {"document": False, "summary": f"{width}×{height}, sent as uploaded"}
+
+    return {
+        "document": False,
+        "data": output.getvalue(),
+        "media_type": media_type,
+        "original_bytes": len(data),
+        "sent_bytes": output.tell(),
+        "summary": f"{width}×{height} → {image.size[0]}×{image.size[1]} {label}"
+    }
+
+def extract(file_type, name, data, progress=None):
+    if is_pdf(file_type, name):
+        return extract_pdf(data, progress)
+    if file_type.startswith("image/"):
+        return preprocess_image(data)
+    return extract_xlsx(data, progress)
+
+# Extraction result with its status; failures are reported, not raised
+def run_extraction(file_type, name, read_bytes, progress=None):
+    try:
+        data = read_bytes()
+        if data is None:
+            raise RuntimeError("File is no longer available")
+        result = extract(file_type, name, data, progress)
+        result["status"] = "done"
+    except Exception as e:
+        result = {"status": "failed", "summary": f"extraction failed: {str(e)}"}
+    return result
+
+
+# Thread pool plus a content-hash keyed LRU of results, shared by all sessions
+class Extractor:
+    def __init__(self, max_workers, max_entries):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="extract")
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._pending = {}
+        # content hash -> (done, total, unit) last reported by a running extraction
+        self._progress = {}
+
+    # Start extracting unless the result is cached or already in progress.
+    # read_bytes is called on the worker thread.
+    def submit(self, content_hash, file_type, name, read_bytes):
+        with self._lock:
+            if content_hash in self._results or content_hash in self._pending:
+                return
+            self._pending[content_hash] = self._executor.submit(self._run, content_hash, file_type, name, read_bytes)
+
+    def _run(self, content_hash, file_type, name, read_bytes):
+        result = run_extraction(file_type, name, read_bytes, functools.partial(self._report, content_hash))
+        with self._lock:
+            self._pending.pop(content_hash, None)
+            self._progress.pop(content_hash, None)
+            self._results[content_hash] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def _report(self, content_hash, done, total, unit):
+        with self._lock:
+            if content_hash in self._pending:
+                self._progress[content_hash] = (done, total, unit)
+
+    # Cached result, {"status": "pending"} with any (done, total, unit) progress
+    # while running, or None if never submitted
+    def result(self, content_hash):
+        with self._lock:
+            if content_hash in self._results:
+                self._results.move_to_end(content_hash)
+                return self._results[content_hash]
+            if content_hash in self._pending:
+                progress = self._progress.get(content_hash)
+                if progress is None:
+                    return {"status": "pending", "summary": "extracting…", "progress": None}
+                done, total, unit = progress
+                return {"status": "pending", "summary": f"extracting… {done}/{total} {unit}", "progress": progress}
+        return None
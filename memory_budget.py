@@ -0,0 +1,128 @@
+# Memory budgets for hosting many sessions in one process. Sessions report
+# their approximate state size after every rerun; a session over its own
+# budget spills DataFrames to the blob store and drops caches, and when the
+# process as a whole is over budget the largest idle sessions are asked to
+# free their state.
+import pickle
+import threading
+import time
+import weakref
+
+
+# A DataFrame moved out of session memory into the blob store. Shape and
+# footprint stay available without reading it back.
+class SpilledFrame:
+    def __init__(self, blob_hash, rows, columns, memory_bytes):
+        self.blob_hash = blob_hash
+        self.rows = rows
+        self.columns = columns
+        self.memory_bytes = memory_bytes
+
+
+# The blob is pinned, so the blob store's quotas never turn a spill into data
+# loss; the session releases it when the frame is no longer needed
+def spill_frame(blobs, session_id, data, memory_bytes=None):
+    if memory_bytes is None:
+        memory_bytes = int(data.memory_usage(deep=True).sum())
+    blob_hash = blobs.put(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), session_id, pin=True)
+    return SpilledFrame(blob_hash, len(data), len(data.columns), memory_bytes)
+
+# The frame itself: read back from the blob store if it was spilled, None if
+# the blob has been evicted since. The bytes are checked against their hash
+# before they are unpickled, so a file changed on disk is never loaded.
+def load_frame(blobs, frame):
+    if not isinstance(frame, SpilledFrame):
+        return frame
+    data = blobs.read(frame.blob_hash, verify=True)
+    return None if data is None else pickle.loads(data)
+
+# (rows, columns) of a frame or a spilled frame
+def frame_shape(frame):
+    if isinstance(frame, SpilledFrame):
+        return frame.rows, frame.columns
+    return len(frame), len(frame.columns)
+
+
+# Kept in a session's own state. The registry only holds a weak reference to
+# the handle, so it goes away with the session. Evicting a session only sets a
+# flag here; the session frees its own state from its own script thread.
+class SessionHandle:
+    def __init__(self):
+        self.evict_requested = False
+
+
+# Live sessions with their last reported size and activity. on_end(session_id)
+# is called once a session has gone or moved to another session id.
+class SessionRegistry:
+    def __init__(self, on_end=None):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self.on_end = on_end
+
+    # Called at the start of every run, so a session in the middle of a long
+    # turn is never idle. A session that is back in use keeps its state.
+    def begin_run(self, session_id, handle):
+        with self._lock:
+            # A browser session that switched to another stored session id
+            for stale_id in [s for s, entry in self._sessions.items() if s != session_id and entry["handle"]() is handle]:
+                self._end(stale_id)
+            entry = self._sessions.setdefault(session_id, {"memory_bytes": 0})
+            entry.update(handle=weakref.ref(handle), last_active=time.time(), running=True, freed=False)
+            handle.evict_requested = False
+
+    def end_run(self, session_id, memory_bytes):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.update(memory_bytes=memory_bytes, last_active=time.time(), running=False)
+
+    # Size of an idle session once it has freed its state. It is not asked
+    # again until it has been used.
+    def report_freed(self, session_id, memory_bytes):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.update(memory_bytes=memory_bytes, freed=True)
+
+    def _end(self, session_id):
+        del self._sessions[session_id]
+        if self.on_end is not None:
+            self.on_end(session_id)
+
+    def _prune(self):
+        for session_id in [s for s, entry in self._sessions.items() if entry["handle"]() is None]:
+            self._end(session_id)
+
+    def total_bytes(self):
+        with self._lock:
+            self._prune()
+            return sum(entry["memory_bytes"] for entry in self._sessions.values())
+
+    def __len__(self):
+        with self._lock:
+            self._prune()
+            return len(self._sessions)
+
+    # Ask sessions idle for at least idle_seconds, largest first, to free their
+    # state until the total is within budget. Sessions with a run in progress
+    # are left alone, and those already asked count as freed. Returns the ids
+    # of the sessions asked.
+    def evict_idle(self, budget_bytes, idle_seconds, exclude=None):
+        evicted = []
+        with self._lock:
+            handles = {session_id: entry["handle"]() for session_id, entry in self._sessions.items()}
+            entries = {session_id: self._sessions[session_id] for session_id, handle in handles.items()
+                       if handle is not None and not handle.evict_requested}
+            total = sum(entry["memory_bytes"] for entry in entries.values())
+            cutoff = time.time() - idle_seconds
+            candidates = sorted(
+                (entry["memory_bytes"], session_id) for session_id, entry in entries.items()
+                if session_id != exclude and not entry["running"] and not entry["freed"]
+                and entry["last_active"] <= cutoff and entry["memory_bytes"] > 0
+            )
+            while total > budget_bytes and candidates:
+                memory_bytes, session_id = candidates.pop()
+                handles[session_id].evict_requested = True
+                total -= memory_bytes
+                evicted.append(session_id)
+        return evicted
@@ -0,0 +1,268 @@
+# Process-wide instrumentation: API latency, time to first token, token usage,
+# rerun time by page section and session memory. Metrics are kept as Prometheus
+# counters and histograms, can be served for scraping on CLAUDE_UI_METRICS_PORT,
+# and every turn and rerun is also kept as an event that can be written as JSONL.
+import bisect
+import importlib
+import json
+import sys
+import threading
+import time
+import types
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+RERUN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MEMORY_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(0, 12))
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "claude_ui_api_requests_total": ("counter", "Claude requests by model, mode and outcome", None),
+    "claude_ui_api_latency_seconds": ("histogram", "Wall time of a Claude request", LATENCY_BUCKETS),
+    "claude_ui_ttft_seconds": ("histogram", "Time to the first streamed token", LATENCY_BUCKETS),
+    "claude_ui_api_retries_total": ("counter", "Claude requests retried by the scheduler, by response status", None),
+    "claude_ui_tokens_total": ("counter", "Tokens by model and kind (input, output, cache_read, cache_write)", None),
+    "claude_ui_rerun_seconds": ("histogram", "Script rerun wall time by page section", RERUN_BUCKETS),
+    "claude_ui_session_memory_bytes": ("histogram", "Approximate session state size, sampled per rerun", MEMORY_BUCKETS),
+    "claude_ui_scratchpad_items_total": ("counter", "Items added to scratchpads by type", None),
+}
+
+# Modules app.py loads on first use rather than at startup
+LAZY_MODULES = ["anthropic", "pandas", "matplotlib", "seaborn"]
+
+# Events kept in memory for the diagnostics panel and JSONL download
+RECENT_EVENTS = 1000
+# Sessions not seen for this long drop out of the active session gauges
+SESSION_IDLE_SECONDS = 3600
+
+
+# Seconds each lazily imported module took the first time it was imported
+IMPORT_TIMES = {}
+
+
+# Import a module on first use, recording how long that first import took
+def timed_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+# Wall time of one script run, split into the sections it passes through
+class RerunTimer:
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self.sections = {}
+
+    # Charge the time since the previous mark to a section
+    def mark(self, section):
+        now = time.perf_counter()
+        self.sections[section] = self.sections.get(section, 0.0) + now - self._last
+        self._last = now
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+# Approximate memory held by an object graph. Objects whose ids are in seen are
+# skipped, which is how shared resources are left out of a session's total.
+def approx_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    # Only look for pandas objects once something has imported pandas
+    pd = sys.modules.get("pandas")
+    if pd is not None and isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if pd is not None and isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, seen) + approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(approx_size(v, seen) for v in obj)
+    elif not isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+        if hasattr(obj, "__dict__"):
+            size += approx_size(vars(obj), seen)
+        # Attributes kept in __slots__ rather than the instance dict
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__", ())
+            for name in [slots] if isinstance(slots, str) else slots:
+                if name not in ("__dict__", "__weakref__") and hasattr(obj, name):
+                    size += approx_size(getattr(obj, name), seen)
+    return size
+
+
+class Metrics:
+    def __init__(self, jsonl_path=None):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        # session id -> (memory bytes, last seen)
+        self._sessions = {}
+        self.recent = deque(maxlen=RECENT_EVENTS)
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+        self.server = None
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def event(self, kind, **fields):
+        record = {"ts": round(time.time(), 3), "event": kind}
+        record.update(fields)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self.recent.append(record)
+            if self._jsonl is not None:
+                self._jsonl.write(line + "\n")
+                self._jsonl.flush()
+        return record
+
+    # One Claude request. usage is a usage_summary dict or None.
+    def record_turn(self, session_id, model, mode, latency, ttft=None, usage=None, cache_hit=False, error=None):
+        outcome = "error" if error else ("cache_hit" if cache_hit else "ok")
+        self.inc("claude_ui_api_requests_total", {"model": model, "mode": mode, "outcome": outcome})
+        if not cache_hit and not error:
+            self.observe("claude_ui_api_latency_seconds", latency, {"model": model, "mode": mode})
+            if ttft is not None:
+                self.observe("claude_ui_ttft_seconds", ttft, {"model": model})
+            if usage:
+                for kind, field in (("input", "input_tokens"), ("output", "output_tokens"),
+                                    ("cache_read", "cache_read_input_tokens"),
+                                    ("cache_write", "cache_creation_input_tokens")):
+                    self.inc("claude_ui_tokens_total", {"model": model, "kind": kind}, usage[field])
+        return self.event("turn", session=session_id, model=model, mode=mode, outcome=outcome,
+                          latency=round(latency, 4), ttft=None if ttft is None else round(ttft, 4),
+                          usage=usage, error=error)
+
+    def record_rerun(self, session_id, sections, total, memory_bytes):
+        for section, seconds in sections.items():
+            self.observe("claude_ui_rerun_seconds", seconds, {"section": section})
+        self.observe("claude_ui_rerun_seconds", total, {"section": "total"})
+        self.observe("claude_ui_session_memory_bytes", memory_bytes)
+        with self._lock:
+            self._sessions[session_id] = (memory_bytes, time.time())
+        return self.event("rerun", session=session_id, total=round(total, 4),
+                          sections={k: round(v, 4) for k, v in sections.items()}, memory_bytes=memory_bytes)
+
+    # Memory of sessions seen within SESSION_IDLE_SECONDS
+    def active_sessions(self):
+        cutoff = time.time() - SESSION_IDLE_SECONDS
+        with self._lock:
+            for session_id in [s for s, (_, seen) in self._sessions.items() if seen < cutoff]:
+                del self._sessions[session_id]
+            return [memory for memory, _ in self._sessions.values()]
+
+    # Counter total for a metric, optionally only where the given labels match
+    def total(self, name, **labels):
+        with self._lock:
+            return sum(value for (metric, key), value in self._counters.items()
+                       if metric == name and all(dict(key).get(k) == v for k, v in labels.items()))
+
+    def render_prometheus(self):
+        sessions = self.active_sessions()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            snapshot = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+        lines = []
+        for name, (kind, help_text, _) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for (metric, labels), counts, total, count, buckets in snapshot:
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        lines += [
+            "# HELP claude_ui_import_seconds Time the first import of a lazily loaded module took",
+            "# TYPE claude_ui_import_seconds gauge",
+        ]
+        lines += [f'claude_ui_import_seconds{{module="{name}"}} {seconds}' for name, seconds in sorted(IMPORT_TIMES.items())]
+        lines += [
+            "# HELP claude_ui_active_sessions Sessions seen in the last hour",
+            "# TYPE claude_ui_active_sessions gauge",
+            f"claude_ui_active_sessions {len(sessions)}",
+            "# HELP claude_ui_active_session_memory_bytes Approximate state size of active sessions",
+            "# TYPE claude_ui_active_session_memory_bytes gauge",
+            f'claude_ui_active_session_memory_bytes{{stat="total"}} {sum(sessions)}',
+            f'claude_ui_active_session_memory_bytes{{stat="max"}} {max(sessions, default=0)}',
+        ]
+        return "\n".join(lines) + "\n"
+
+    def recent_jsonl(self, session_id=None):
+        with self._lock:
+            records = list(self.recent)
+        return "".join(json.dumps(r, default=str) + "\n" for r in records
+                       if session_id is None or r.get("session") == session_id)
+
+    # Serve render_prometheus() at /metrics on a background thread
+    def serve(self, host, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        return self.server
@@ -0,0 +1,198 @@
+# Local stand-in for the Anthropic API, for running the app and the batch
+# runner offline. Replies echo the prompt; streaming, token counting and the
+# Message Batches endpoints are supported.
+#
+#   python mock_server.py [--port 8765] [--latency 0.2] [--batch-seconds 5]
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:8765 python batch.py prompts.jsonl -o results.jsonl
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(value):
+    return max(1, len(json.dumps(value)) // CHARS_PER_TOKEN)
+
+def last_user_text(messages):
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            return content
+        return " ".join(block.get("text", "") for block in content if block.get("type") == "text")
+    return ""
+
+def mock_message(params):
+    text = f"Mock reply to: {last_user_text(params.get('messages', []))[:500]}"
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model", "mock"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": count_tokens(params.get("messages", [])) + count_tokens(params.get("system", "")),
+            "output_tokens": max(1, len(text) // CHARS_PER_TOKEN),
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0
+        }
+    }
+
+
+class MockState:
+    def __init__(self, latency, batch_seconds):
+        self.latency = latency
+        self.batch_seconds = batch_seconds
+        self.lock = threading.Lock()
+        self.batches = {}
+
+    def create_batch(self, requests):
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        now = time.time()
+        with self.lock:
+            self.batches[batch_id] = {"created": now, "requests": requests}
+        return self.batch_info(batch_id)
+
+    def batch_info(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        ended = time.time() - batch["created"] >= self.batch_seconds
+        count = len(batch["requests"])
+        created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(batch["created"]))
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0
+            },
+            "created_at": created,
+            "expires_at": created,
+            "ended_at": created if ended else None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": f"/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def batch_results(self, batch_id):
+        with self.lock:
+            requests = self.batches[batch_id]["requests"]
+        return [
+            {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": mock_message(request["params"])}}
+            for request in requests
+        ]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        params = self._read_json()
+        if path == "/v1/messages":
+            time.sleep(self.state.latency)
+            if params.get("stream"):
+                self._stream(mock_message(params))
+            else:
+                self._send(200, mock_message(params))
+        elif path == "/v1/messages/count_tokens":
+            self._send(200, {"input_tokens": count_tokens(params.get("messages", []))})
+        elif path == "/v1/messages/batches":
+            self._send(200, self.state.create_batch(params.get("requests", [])))
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) < 4:
+            return self._not_found()
+        info = self.state.batch_info(parts[3])
+        if info is None:
+            return self._not_found()
+        if len(parts) == 4:
+            return self._send(200, info)
+        if parts[4] == "results" and info["processing_status"] == "ended":
+            lines = "".join(json.dumps(entry) + "\n" for entry in self.state.batch_results(parts[3]))
+            return self._send(200, lines.encode("utf-8"), "application/x-jsonl")
+        self._not_found()
+
+    # Server-sent events in the order the Messages streaming API uses
+    def _stream(self, message):
+        text = message["content"][0]["text"]
+        start = dict(message, content=[], stop_reason=None, usage=dict(message["usage"], output_tokens=0))
+        events = [
+            ("message_start", {"type": "message_start", "message": start}),
+            ("content_block_start", {"type": "content_block_start", "index": 0,
+                                     "content_block": {"type": "text", "text": ""}}),
+        ]
+        for i in range(0, len(text), 16):
+            events.append(("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                   "delta": {"type": "text_delta", "text": text[i:i + 16]}}))
+        events += [
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {"type": "message_delta",
+                               "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                               "usage": {"output_tokens": message["usage"]["output_tokens"]}}),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+        body = "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events)
+        self._send(200, body.encode("utf-8"), "text/event-stream")
+
+
+def make_server(host="127.0.0.1", port=8765, latency=0.0, batch_seconds=0.0):
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(latency, batch_seconds)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the Anthropic API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to every message request")
+    parser.add_argument("--batch-seconds", type=float, default=5.0, help="seconds before a batch reports ended")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.batch_seconds)
+    print(f"Mock Anthropic API on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
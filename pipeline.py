@@ -0,0 +1,231 @@
+# The message pipeline shared by the Streamlit app and the batch runner:
+# building user messages with attachments, token estimates, prompt caching and
+# request parameters. Nothing here depends on Streamlit.
+import base64
+import json
+
+# Rough token estimates
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 1600
+# PDF documents cost roughly one token per this many bytes (text plus page images)
+PDF_BYTES_PER_TOKEN = 25
+
+# Prompt caching: at most four cache breakpoints per request, and prefixes
+# shorter than the model minimum are not cached
+PROMPT_CACHE_MAX_BREAKPOINTS = 4
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_LARGE_BLOCK_TOKENS = 2048
+
+TEXT_FILE_TYPES = {'text/plain', 'text/csv'}
+
+
+def is_text_type(file_type):
+    return file_type in TEXT_FILE_TYPES or 'json' in file_type
+
+# Decoded text for text, CSV and JSON files; None for anything else
+def decode_text(file_type, file_bytes):
+    if file_bytes is None or not is_text_type(file_type):
+        return None
+    try:
+        return file_bytes.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+# Build a user message from text and attachments. Each attachment is a dict with
+# name, type, size, extraction (a result from extraction.py or None) and
+# base64/text callables, so payloads are only read for the blocks that use them.
+def build_user_message(message_text, attachments=None):
+    if not attachments:
+        return {"role": "user", "content": message_text}
+
+    message_content = [{"type": "text", "text": message_text}]
+
+    for attachment in attachments:
+        text_content = attachment["text"]()
+        extraction = attachment["extraction"]
+        extraction_done = extraction is not None and extraction["status"] == "done"
+        document_data = attachment["base64"]() if extraction_done and extraction["document"] else None
+
+        # For images, add as image type: the resized copy once it is ready, otherwise as uploaded
+        image_data, media_type = None, attachment['type']
+        if attachment['type'].startswith('image/'):
+            if extraction_done and extraction.get("data") is not None:
+                image_data = base64.b64encode(extraction["data"]).decode('utf-8')
+                media_type = extraction["media_type"]
+            else:
+                image_data = attachment["base64"]()
+        if image_data is not None:
+            message_content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": media_type,
+                    "data": image_data
+                }
+            })
+        # PDFs within the API limits go as native documents
+        elif document_data is not None:
+            message_content.append({
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": document_data
+                }
+            })
+        # Larger PDFs and spreadsheets go as their extracted text
+        elif extraction_done and extraction.get("text"):
+            message_content.append({
+                "type": "text",
+                "text": f"\n\nFile: {attachment['name']} ({extraction['summary']})\n\n{extraction['text']}"
+            })
+        # For text files, include content as text
+        elif text_content:
+            message_content.append({
+                "type": "text",
+                "text": f"\n\nFile: {attachment['name']}\n\n{text_content}"
+            })
+        # For other files that could not be directly processed, notify in the message
+        else:
+            status = f", {extraction['summary']}" if extraction else ""
+            message_content.append({
+                "type": "text",
+                "text": f"\n\nFile attached: {attachment['name']} (size: {attachment['size']} bytes, type: {attachment['type']}{status})"
+            })
+
+    return {"role": "user", "content": message_content}
+
+# Rough token estimate for message content (string or list of content blocks)
+def estimate_tokens(content):
+    if isinstance(content, str):
+        return -(-len(content) // CHARS_PER_TOKEN)
+    tokens = 0
+    for block in content:
+        if block.get("type") == "text":
+            tokens += -(-len(block["text"]) // CHARS_PER_TOKEN)
+        elif block.get("type") == "image":
+            tokens += IMAGE_TOKEN_ESTIMATE
+        elif block.get("type") == "document":
+            tokens += len(block["source"]["data"]) * 3 // 4 // PDF_BYTES_PER_TOKEN
+        else:
+            tokens += estimate_tokens(json.dumps(block))
+    return tokens
+
+# Rough input token count of a request built by request_params
+def estimate_request_tokens(params):
+    tokens = estimate_tokens(params["system"]) if params.get("system") else 0
+    return tokens + sum(estimate_tokens(message["content"]) for message in params["messages"])
+
+# Keep the newest message and as many before it as fit the budget, after the
+# first pinned messages and reserved_tokens (the system prompt). counts are the
+# messages' token counts. The kept messages alternate roles: the tail follows on
+# from the pinned messages, and when it is down to the newest message alone,
+# pinned messages with that same role are given up. Returns the messages kept
+# and the tokens they use.
+def trim_history(messages, counts, budget, pinned=0, reserved_tokens=0):
+    pinned = min(pinned, len(messages) - 1)
+    used = reserved_tokens + sum(counts[:pinned])
+
+    # Walk back from the newest message while the budget allows
+    start = len(messages) - 1
+    used += counts[start]
+    while start - 1 >= pinned and used + counts[start - 1] <= budget:
+        start -= 1
+        used += counts[start]
+
+    # The kept tail must open with a user turn or follow on from the pinned turns
+    expected_role = "user" if pinned == 0 or messages[pinned - 1]["role"] == "assistant" else "assistant"
+    while start < len(messages) - 1 and messages[start]["role"] != expected_role:
+        used -= counts[start]
+        start += 1
+    while pinned > 0 and messages[pinned - 1]["role"] == messages[start]["role"]:
+        pinned -= 1
+        used -= counts[pinned]
+
+    return messages[:pinned] + messages[start:], used
+
+# Copy of a message whose last content block carries a cache breakpoint
+def with_cache_breakpoint(message, block_index=-1):
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = list(content)
+    content[block_index] = dict(content[block_index], cache_control={"type": "ephemeral"})
+    return {"role": message["role"], "content": content}
+
+# Place prompt cache breakpoints on the system prompt, the conversation prefix
+# and large attachments that are sent again. Only the first stable_prefix
+# messages (all by default) are sent the same way next turn, so breakpoints go
+# no further than that. Returns new system/messages values; inputs are not
+# modified.
+def apply_prompt_caching(system_prompt, messages, stable_prefix=None):
+    breakpoints = PROMPT_CACHE_MAX_BREAKPOINTS
+    system = system_prompt
+    if system_prompt and estimate_tokens(system_prompt) >= PROMPT_CACHE_MIN_TOKENS:
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        breakpoints -= 1
+
+    messages = list(messages)
+    stable = len(messages) if stable_prefix is None else min(stable_prefix, len(messages))
+    if not stable:
+        return system, messages
+    prefix_tokens = estimate_tokens(system_prompt or "")
+    prefix_ends = []
+    for i, msg in enumerate(messages[:stable]):
+        prefix_tokens += estimate_tokens(msg["content"])
+        if prefix_tokens >= PROMPT_CACHE_MIN_TOKENS:
+            prefix_ends.append(i)
+
+    # The end of the stable prefix writes the cache for the next turn; the
+    # previous user turn reads what the last request wrote
+    last = stable - 1
+    previous_user = next((i for i in range(last - 1, -1, -1) if messages[i]["role"] == "user"), None)
+    for i in (last, previous_user):
+        if i is not None and i in prefix_ends and breakpoints > 0:
+            messages[i] = with_cache_breakpoint(messages[i])
+            breakpoints -= 1
+
+    # Any breakpoints left go on the last large document, image or text block
+    # of resent messages with attachments, newest first
+    for i in reversed(prefix_ends):
+        if breakpoints == 0:
+            break
+        content = messages[i]["content"]
+        if isinstance(content, str):
+            continue
+        large_blocks = [j for j, block in enumerate(content)
+                        if block.get("type") in ("image", "document")
+                        or estimate_tokens([block]) >= PROMPT_CACHE_LARGE_BLOCK_TOKENS]
+        if large_blocks and "cache_control" not in content[large_blocks[-1]]:
+            messages[i] = with_cache_breakpoint(messages[i], large_blocks[-1])
+            breakpoints -= 1
+
+    return system, messages
+
+# Keyword arguments for messages.create/stream, or the params of a batch request
+def request_params(messages, model, system_prompt, temperature, max_tokens, prompt_caching=True, stable_prefix=None):
+    if prompt_caching:
+        system_prompt, messages = apply_prompt_caching(system_prompt, messages, stable_prefix)
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "system": system_prompt,
+        "messages": messages
+    }
+
+# Token usage of a response as a plain dict, including prompt cache activity
+def usage_summary(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0
+    }
+
+# Text of a response, joined across its text blocks
+def response_text(response):
+    return "".join(block.text for block in response.content if block.type == "text")
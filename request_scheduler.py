@@ -0,0 +1,195 @@
+# Process-wide scheduler in front of the Claude API for sessions that share an
+# organisation's rate limits. Requests wait in a queue that takes turns between
+# sessions, are let through under token-bucket limits on requests and input
+# tokens per minute, and are retried with jittered exponential backoff on rate
+# limit, overload and server errors, honouring any retry-after header.
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Status codes worth retrying: rate limited, server errors, overloaded
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+# How often a waiting request re-checks its position
+QUEUE_POLL_SECONDS = 0.5
+
+
+# Refills continuously at per_minute / 60 per second, up to one minute's worth
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until amount is available. A request larger than the bucket only
+    # has to wait for a full one.
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    # The level may go negative, e.g. when a request used more than estimated
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+
+# Seconds the server asked us to wait, from retry-after-ms or retry-after
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            value = headers.get(name)
+            if value is not None:
+                return max(float(value) * scale, 0.0)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+# One queued request
+class Ticket:
+    def __init__(self, session_id, tokens):
+        self.session_id = session_id
+        self.tokens = tokens
+
+
+class RequestScheduler:
+    # requests_per_minute and tokens_per_minute of 0 mean no limit
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_retries=4,
+                 base_delay=1.0, max_delay=60.0):
+        self._cond = threading.Condition()
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # session id -> its waiting tickets; the session at the front goes next
+        self._queues = OrderedDict()
+        # Nobody is let through before this, set when the API pushes back
+        self._paused_until = 0.0
+
+    # Tickets in the order they will be let through: the first ticket of each
+    # session in turn, then the second, and so on
+    def _order(self):
+        queues = list(self._queues.values())
+        order = []
+        for i in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[i] for q in queues if i < len(q))
+        return order
+
+    def _remove(self, ticket):
+        tickets = self._queues[ticket.session_id]
+        tickets.remove(ticket)
+        if tickets:
+            # This session has had its turn
+            self._queues.move_to_end(ticket.session_id)
+        else:
+            del self._queues[ticket.session_id]
+        self._cond.notify_all()
+
+    # Let the ticket through if it is first in line and the limits allow.
+    # Returns None when it was let through, else its position and wait.
+    def _try_acquire(self, ticket):
+        now = time.monotonic()
+        position = self._order().index(ticket)
+        if position:
+            return position, None
+        wait = self._paused_until - now
+        if self._requests is not None:
+            wait = max(wait, self._requests.wait_time(1, now))
+        if self._tokens is not None:
+            wait = max(wait, self._tokens.wait_time(ticket.tokens, now))
+        if wait > 0:
+            return position, wait
+        if self._requests is not None:
+            self._requests.take(1, now)
+        if self._tokens is not None:
+            self._tokens.take(ticket.tokens, now)
+        self._remove(ticket)
+        return None
+
+    # Wait for a turn to send a request of about this many input tokens.
+    # on_wait(position, seconds) is called from this thread whenever either
+    # changes; position is the number of requests ahead, seconds the time
+    # until a limit allows the next one (None while others are ahead).
+    # Returns the seconds spent waiting.
+    def acquire(self, session_id, tokens, on_wait=None):
+        start = time.monotonic()
+        ticket = Ticket(session_id, tokens)
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        last_reported = None
+        try:
+            while True:
+                with self._cond:
+                    state = self._try_acquire(ticket)
+                    if state is None:
+                        return time.monotonic() - start
+                position, wait = state
+                report = (position, None if wait is None else round(wait))
+                if on_wait is not None and report != last_reported:
+                    on_wait(position, wait)
+                    last_reported = report
+                with self._cond:
+                    self._cond.wait(QUEUE_POLL_SECONDS if wait is None else min(wait, QUEUE_POLL_SECONDS))
+        except BaseException:
+            with self._cond:
+                if ticket in self._queues.get(session_id, ()):
+                    self._remove(ticket)
+            raise
+
+    # Correct the token bucket once a request's real input size is known
+    def settle(self, estimated_tokens, actual_tokens):
+        if self._tokens is None or actual_tokens is None:
+            return
+        with self._cond:
+            self._tokens.take(actual_tokens - estimated_tokens, time.monotonic())
+
+    # Hold back every session for at least this long
+    def pause(self, seconds):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    # Seconds to wait before retry number attempt (from 1), or None if the
+    # error is not worth retrying
+    def retry_delay(self, error, attempt):
+        if getattr(error, "status_code", None) not in RETRY_STATUS_CODES or attempt > self.max_retries:
+            return None
+        retry_after = retry_after_seconds(error)
+        # Full jitter spreads out sessions that failed together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return delay if retry_after is None else max(retry_after, delay)
+
+    # Call fn() in turn, retrying failures worth retrying. can_retry() can veto
+    # a retry, e.g. once part of a stream has been shown. on_retry(attempt,
+    # delay, error) is called before each retry.
+    def run(self, session_id, tokens, fn, on_wait=None, on_retry=None, can_retry=None):
+        attempt = 0
+        while True:
+            self.acquire(session_id, tokens, on_wait)
+            try:
+                return fn()
+            except Exception as e:
+                attempt += 1
+                delay = self.retry_delay(e, attempt)
+                if delay is None or (can_retry is not None and not can_retry()):
+                    raise
+                if on_retry is not None:
+                    on_retry(attempt, delay, e)
+                if getattr(e, "status_code", None) in (429, 529):
+                    # The limits are shared, so every session backs off
+                    self.pause(delay)
+                else:
+                    time.sleep(delay)
+
+    def queued(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
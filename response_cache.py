@@ -0,0 +1,134 @@
+# Opt-in on-disk cache of Claude responses, keyed by a canonical hash of the
+# request. Only meant for deterministic requests (temperature 0), where
+# sending the same request again would only repeat the same answer. Entries
+# expire after a TTL and the least recently used are evicted over the size cap.
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+# Replies that ended on their own; one cut off at max_tokens or by a refusal is
+# not worth repeating
+CACHEABLE_STOP_REASONS = {"end_turn", "stop_sequence"}
+
+# Request with prompt cache breakpoints removed, so toggling prompt caching
+# does not change the key
+def strip_cache_control(value):
+    if isinstance(value, dict):
+        return {k: strip_cache_control(v) for k, v in value.items() if k != "cache_control"}
+    if isinstance(value, list):
+        return [strip_cache_control(v) for v in value]
+    return value
+
+# Who a request is sent as: a hash of the API key and the endpoint, so one
+# organisation's cached replies are never served to another
+def tenant_key(api_key, base_url=None):
+    return hashlib.sha256(f"{base_url or ''}\n{api_key}".encode("utf-8")).hexdigest()
+
+def request_key(params, tenant):
+    canonical = json.dumps({"tenant": tenant, "request": strip_cache_control(params)},
+                           sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Stand-in for an API Message, with the fields the app reads
+def cached_message(entry):
+    return SimpleNamespace(
+        id=entry.get("id"),
+        model=entry["model"],
+        stop_reason=entry.get("stop_reason"),
+        content=[SimpleNamespace(type="text", text=entry["text"])],
+        usage=SimpleNamespace(**entry["usage"]) if entry.get("usage") else None,
+        cached=True
+    )
+
+
+class ResponseCache:
+    def __init__(self, root, max_bytes, ttl_seconds):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # key -> file size, least recently used first
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif name.endswith(".json"):
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    # Cached entry for a request key, or None on a miss or once it has expired
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self._remove(key)
+                return None
+            if time.time() - entry["created"] > self.ttl_seconds:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            # The file's mtime carries recency across restarts
+            os.utime(self._path(key))
+            return entry
+
+    # Store a complete reply; anything else is ignored
+    def put(self, key, response):
+        if getattr(response, "stop_reason", None) not in CACHEABLE_STOP_REASONS:
+            return
+        entry = {
+            "created": time.time(),
+            "id": getattr(response, "id", None),
+            "model": response.model,
+            "stop_reason": getattr(response, "stop_reason", None),
+            "text": "".join(block.text for block in response.content if block.type == "text"),
+            "usage": {
+                "input_tokens": response.usage.input_tokens,
+                "output_tokens": response.usage.output_tokens,
+                "cache_read_input_tokens": getattr(response.usage, "cache_read_input_tokens", None) or 0,
+                "cache_creation_input_tokens": getattr(response.usage, "cache_creation_input_tokens", None) or 0
+            } if getattr(response, "usage", None) else None
+        }
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self.total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
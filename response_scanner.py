@@ -0,0 +1,130 @@
+# Single-pass scanner that pulls code blocks, markdown tables and the full note
+# out of Claude's replies. It works line by line, so it can be fed streamed
+# chunks and its cost is linear in the size of the reply.
+import re
+
+# Opening/closing fence, e.g. ```python or ```
+FENCE_PATTERN = re.compile(r'```([\w\+\#\-\.]*)\s*$')
+# Markdown table separator row, e.g. |---|:--:|
+TABLE_SEPARATOR_PATTERN = re.compile(r'\|[-:| ]+\|')
+
+LANGUAGE_ALIASES = {
+    "py": "python",
+    "python3": "python",
+    "js": "javascript",
+    "jsx": "javascript",
+    "ts": "typescript",
+}
+
+# Default to text if language is empty, otherwise clean up language name
+def normalize_language(lang):
+    language = lang.strip().lower() if lang.strip() else "text"
+    return LANGUAGE_ALIASES.get(language, language)
+
+def is_table_row(line):
+    stripped = line.strip()
+    return stripped.startswith("|") and stripped.count("|") >= 2
+
+
+class ResponseScanner:
+    def __init__(self):
+        self.artifacts = []
+        self._partial = []
+        self._text = []
+        self._code_language = None
+        self._code_lines = None
+        self._table_lines = None
+        self._table_candidate = None
+        self._counts = {}
+        self._closed = False
+
+    # Feed the next chunk of the reply; returns artifacts completed by this chunk
+    def feed(self, chunk):
+        start = len(self.artifacts)
+        self._text.append(chunk)
+        lines = chunk.split("\n")
+        if len(lines) == 1:
+            self._partial.append(chunk)
+            return self.artifacts[start:]
+
+        self._partial.append(lines[0])
+        self._scan_line("".join(self._partial))
+        for line in lines[1:-1]:
+            self._scan_line(line)
+        self._partial = [lines[-1]]
+        return self.artifacts[start:]
+
+    # Flush the final line and emit the note; returns artifacts completed here
+    def close(self):
+        start = len(self.artifacts)
+        if self._closed:
+            return []
+        self._closed = True
+
+        if self._partial:
+            self._scan_line("".join(self._partial))
+            self._partial = []
+        # Code in an unterminated fence is not saved as a snippet
+        self._end_table()
+
+        text = "".join(self._text)
+        if text:
+            self._emit("text", text)
+        return self.artifacts[start:]
+
+    def _emit(self, artifact_type, content):
+        index = self._counts.get(artifact_type, 0)
+        self._counts[artifact_type] = index + 1
+        self.artifacts.append({"type": artifact_type, "index": index, "content": content})
+
+    def _scan_line(self, line):
+        stripped = line.strip()
+
+        if self._code_lines is not None:
+            if stripped.startswith("```"):
+                self._emit("code", {
+                    "language": self._code_language,
+                    "code": "\n".join(self._code_lines).strip()
+                })
+                self._code_lines = None
+            else:
+                self._code_lines.append(line)
+            return
+
+        if stripped.startswith("```"):
+            self._end_table()
+            match = FENCE_PATTERN.match(stripped)
+            self._code_language = normalize_language(match.group(1) if match else "")
+            self._code_lines = []
+            return
+
+        if self._table_lines is not None:
+            if is_table_row(line):
+                self._table_lines.append(line)
+                return
+            self._end_table()
+
+        if self._table_candidate is not None:
+            header = self._table_candidate
+            self._table_candidate = None
+            if TABLE_SEPARATOR_PATTERN.fullmatch(stripped):
+                self._table_lines = [header, line]
+                return
+
+        if is_table_row(line):
+            self._table_candidate = line
+
+    def _end_table(self):
+        # A table needs a header, a separator and at least one row
+        if self._table_lines is not None and len(self._table_lines) > 2:
+            self._emit("table", "\n".join(self._table_lines).strip())
+        self._table_lines = None
+        self._table_candidate = None
+
+
+# Scan a complete reply in one call
+def scan_response(text):
+    scanner = ResponseScanner()
+    scanner.feed(text)
+    scanner.close()
+    return scanner.artifacts
@@ -0,0 +1,168 @@
+# In-process inverted index over scratchpad items and chat messages. It is
+# updated one document at a time as items and messages change, and answers
+# ranked (BM25) queries without scanning every document.
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+PREVIEW_CHARS = 240
+INITIAL_CAPACITY = 1024
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+# First PREVIEW_CHARS characters with whitespace collapsed
+def make_preview(text):
+    preview = " ".join(text[:PREVIEW_CHARS * 2].split())
+    if len(preview) > PREVIEW_CHARS:
+        preview = preview[:PREVIEW_CHARS].rstrip() + "…"
+    return preview
+
+
+# Every document gets an integer slot. Postings map slots to term counts, and
+# per-slot lengths, kinds and languages live in numpy arrays so a query can
+# score and filter all matching documents at once.
+class SearchIndex:
+    def __init__(self):
+        # term -> {slot: term frequency}
+        self.postings = {}
+        # doc key -> slot, and slot -> metadata plus the terms needed to remove it
+        self.slots = {}
+        self.docs = {}
+        self.free_slots = []
+        self.next_slot = 0
+        self.total_length = 0
+        self.kind_codes = {}
+        self.language_codes = {}
+        self.lengths = np.zeros(INITIAL_CAPACITY)
+        self.kinds = np.full(INITIAL_CAPACITY, -1, dtype=np.int32)
+        self.languages = np.full(INITIAL_CAPACITY, -1, dtype=np.int32)
+
+    def _allocate_slot(self):
+        if self.free_slots:
+            return self.free_slots.pop()
+        slot = self.next_slot
+        self.next_slot += 1
+        if slot >= len(self.lengths):
+            extra = len(self.lengths)
+            self.lengths = np.concatenate([self.lengths, np.zeros(extra)])
+            self.kinds = np.concatenate([self.kinds, np.full(extra, -1, dtype=np.int32)])
+            self.languages = np.concatenate([self.languages, np.full(extra, -1, dtype=np.int32)])
+        return slot
+
+    # Index a document, replacing any earlier version with the same key
+    def add(self, key, kind, text, title="", language=None):
+        self.remove(key)
+        terms = Counter(tokenize(f"{title}\n{text}"))
+        length = sum(terms.values())
+        slot = self._allocate_slot()
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[slot] = count
+
+        self.slots[key] = slot
+        self.docs[slot] = {
+            "key": key,
+            "kind": kind,
+            "title": title,
+            "language": language,
+            "preview": make_preview(text),
+            "terms": tuple(terms)
+        }
+        self.lengths[slot] = length
+        self.kinds[slot] = self.kind_codes.setdefault(kind, len(self.kind_codes))
+        self.languages[slot] = self.language_codes.setdefault(language, len(self.language_codes)) if language else -1
+        self.total_length += length
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        doc = self.docs.pop(slot)
+        for term in doc["terms"]:
+            posting = self.postings[term]
+            del posting[slot]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.lengths[slot]
+        self.lengths[slot] = 0
+        self.kinds[slot] = -1
+        self.languages[slot] = -1
+        self.free_slots.append(slot)
+
+    # Remove every document of the given kinds
+    def clear(self, kinds):
+        codes = [self.kind_codes[kind] for kind in kinds if kind in self.kind_codes]
+        for slot in np.flatnonzero(np.isin(self.kinds[:self.next_slot], codes)):
+            self.remove(self.docs[int(slot)]["key"])
+
+    def languages_in_use(self):
+        return sorted({doc["language"] for doc in self.docs.values() if doc["language"]})
+
+    # Documents containing every query term, best BM25 score first. kinds and
+    # language narrow the results; a language filter only matches docs that have one.
+    def search(self, query, kinds=None, language=None, limit=20):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.docs:
+            return []
+        postings = [self.postings.get(term) for term in terms]
+        if not all(postings):
+            return []
+
+        # Start from the rarest term's postings so the work follows the most
+        # selective term rather than the size of the index
+        postings.sort(key=len)
+        rarest = postings[0]
+        slots = np.fromiter(rarest.keys(), dtype=np.int64, count=len(rarest))
+        counts = [np.fromiter(rarest.values(), dtype=float, count=len(rarest))]
+
+        keep = np.ones(len(slots), dtype=bool)
+        if kinds is not None:
+            codes = [self.kind_codes[kind] for kind in kinds if kind in self.kind_codes]
+            keep &= np.isin(self.kinds[slots], codes)
+        if language is not None:
+            keep &= self.languages[slots] == self.language_codes.get(language, -2)
+        slots, counts[0] = slots[keep], counts[0][keep]
+
+        for posting in postings[1:]:
+            other = np.fromiter((posting.get(slot, 0) for slot in slots.tolist()), dtype=float, count=len(slots))
+            present = other > 0
+            slots = slots[present]
+            counts = [c[present] for c in counts] + [other[present]]
+        if len(slots) == 0:
+            return []
+
+        doc_count = len(self.docs)
+        average_length = self.total_length / doc_count or 1
+        norm = K1 * (1 - B + B * self.lengths[slots] / average_length)
+        scores = np.zeros(len(slots))
+        for posting, tf in zip(postings, counts):
+            idf = np.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            scores += idf * tf * (K1 + 1) / (tf + norm)
+
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        results = []
+        for i in top:
+            doc = self.docs[int(slots[i])]
+            results.append({
+                "key": doc["key"],
+                "score": float(scores[i]),
+                "kind": doc["kind"],
+                "title": doc["title"],
+                "language": doc["language"],
+                "preview": doc["preview"]
+            })
+        return results
+
+    def __len__(self):
+        return len(self.docs)
@@ -0,0 +1,262 @@
+# Storage backends for chat sessions. The app writes every change through
+# one of these as it happens, so a session can be resumed by id after a
+# browser refresh or a restart. Uploaded files and chart data are kept in the
+# blob store; only their metadata and blob hashes are stored here.
+import json
+import sqlite3
+import threading
+import time
+
+# Scratchpad content larger than this is left on disk until it is first used
+LAZY_CONTENT_BYTES = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    file_ids TEXT,
+    PRIMARY KEY (session_id, id)
+);
+CREATE TABLE IF NOT EXISTS scratchpad (
+    session_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (session_id, id)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    session_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (session_id, file_id)
+);
+CREATE TABLE IF NOT EXISTS frames (
+    session_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    blob_hash TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    columns INTEGER NOT NULL,
+    memory_bytes INTEGER NOT NULL,
+    source TEXT,
+    PRIMARY KEY (session_id, name)
+);
+"""
+
+
+# Keeps nothing; used when persistence is turned off
+class MemoryStore:
+    persistent = False
+
+    def session_exists(self, session_id):
+        return False
+
+    def ensure_session(self, session_id):
+        pass
+
+    def save_message(self, session_id, message):
+        pass
+
+    def clear_messages(self, session_id):
+        pass
+
+    def load_messages(self, session_id):
+        return []
+
+    def save_scratchpad_item(self, session_id, item):
+        pass
+
+    def delete_scratchpad_item(self, session_id, item_id):
+        pass
+
+    def clear_scratchpad(self, session_id):
+        pass
+
+    def load_scratchpad_items(self, session_id):
+        return []
+
+    def load_scratchpad_content(self, session_id, item_id):
+        return None
+
+    def save_upload(self, session_id, file_id, info):
+        pass
+
+    def delete_uploads(self, session_id, file_ids):
+        pass
+
+    def load_uploads(self, session_id):
+        return {}
+
+    def save_frame(self, session_id, name, frame):
+        pass
+
+    def delete_frame(self, session_id, name):
+        pass
+
+    def load_frames(self, session_id):
+        return {}
+
+
+# SQLite in WAL mode, so page loads can read while another session writes.
+# One connection is shared by all sessions in the process; writes are serialized.
+class SQLiteStore:
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    # Run (sql, params) statements in one transaction
+    def _write(self, *statements):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Statement that records activity on a session, creating it if needed
+    def _touch(self, session_id):
+        now = time.time()
+        return (
+            "INSERT INTO sessions (id, created, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET updated = excluded.updated",
+            (session_id, now, now)
+        )
+
+    def session_exists(self, session_id):
+        return bool(self._read("SELECT 1 FROM sessions WHERE id = ?", (session_id,)))
+
+    def ensure_session(self, session_id):
+        self._write(self._touch(session_id))
+
+    def save_message(self, session_id, message):
+        self._write(self._touch(session_id), (
+            "INSERT OR REPLACE INTO messages (session_id, id, role, content, file_ids) VALUES (?, ?, ?, ?, ?)",
+            (session_id, message["id"], message["role"], message["content"],
+             json.dumps(message["file_ids"]) if message.get("file_ids") else None)
+        ))
+
+    def clear_messages(self, session_id):
+        self._write(("DELETE FROM messages WHERE session_id = ?", (session_id,)))
+
+    def load_messages(self, session_id):
+        rows = self._read(
+            "SELECT id, role, content, file_ids FROM messages WHERE session_id = ? ORDER BY id",
+            (session_id,)
+        )
+        messages = []
+        for message_id, role, content, file_ids in rows:
+            message = {"id": message_id, "role": role, "content": content}
+            if file_ids:
+                message["file_ids"] = json.loads(file_ids)
+            messages.append(message)
+        return messages
+
+    def save_scratchpad_item(self, session_id, item):
+        self._write(self._touch(session_id), (
+            "INSERT OR REPLACE INTO scratchpad (session_id, id, name, type, content, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (session_id, item.id, item.name, item.type, json.dumps(item.content), item.created)
+        ))
+
+    def delete_scratchpad_item(self, session_id, item_id):
+        self._write(("DELETE FROM scratchpad WHERE session_id = ? AND id = ?", (session_id, item_id)))
+
+    def clear_scratchpad(self, session_id):
+        self._write(("DELETE FROM scratchpad WHERE session_id = ?", (session_id,)))
+
+    # Item rows in id order. Content above LAZY_CONTENT_BYTES comes back as
+    # None and is fetched later with load_scratchpad_content.
+    def load_scratchpad_items(self, session_id):
+        rows = self._read(
+            "SELECT id, name, type, created, CASE WHEN length(content) <= ? THEN content END "
+            "FROM scratchpad WHERE session_id = ? ORDER BY id",
+            (LAZY_CONTENT_BYTES, session_id)
+        )
+        return [
+            {
+                "id": item_id,
+                "name": name,
+                "type": item_type,
+                "created": created,
+                "content": json.loads(content) if content is not None else None
+            }
+            for item_id, name, item_type, created, content in rows
+        ]
+
+    def load_scratchpad_content(self, session_id, item_id):
+        rows = self._read(
+            "SELECT content FROM scratchpad WHERE session_id = ? AND id = ?",
+            (session_id, item_id)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    # Uploaded file metadata by file id (the blob hash): name, type and size
+    def save_upload(self, session_id, file_id, info):
+        self._write(self._touch(session_id), (
+            "INSERT OR REPLACE INTO uploads (session_id, file_id, name, type, size) VALUES (?, ?, ?, ?, ?)",
+            (session_id, file_id, info["name"], info["type"], info["size"])
+        ))
+
+    def delete_uploads(self, session_id, file_ids):
+        if file_ids:
+            self._write(*[("DELETE FROM uploads WHERE session_id = ? AND file_id = ?", (session_id, file_id))
+                          for file_id in file_ids])
+
+    def load_uploads(self, session_id):
+        rows = self._read("SELECT file_id, name, type, size FROM uploads WHERE session_id = ?", (session_id,))
+        return {file_id: {"name": name, "type": file_type, "size": size} for file_id, name, file_type, size in rows}
+
+    # A DataFrame in the blob store under a name: blob_hash, rows, columns,
+    # memory_bytes and a JSON-serializable source
+    def save_frame(self, session_id, name, frame):
+        self._write(self._touch(session_id), (
+            "INSERT OR REPLACE INTO frames (session_id, name, blob_hash, rows, columns, memory_bytes, source) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, name, frame["blob_hash"], frame["rows"], frame["columns"], frame["memory_bytes"],
+             json.dumps(frame.get("source")))
+        ))
+
+    def delete_frame(self, session_id, name):
+        self._write(("DELETE FROM frames WHERE session_id = ? AND name = ?", (session_id, name)))
+
+    def load_frames(self, session_id):
+        rows = self._read(
+            "SELECT name, blob_hash, rows, columns, memory_bytes, source FROM frames WHERE session_id = ?",
+            (session_id,)
+        )
+        return {
+            name: {"blob_hash": blob_hash, "rows": row_count, "columns": columns,
+                   "memory_bytes": memory_bytes, "source": json.loads(source) if source else None}
+            for name, blob_hash, row_count, columns, memory_bytes, source in rows
+        }
+
+
+# Build the backend named by the storage setting ("memory" or "sqlite")
+def create_store(backend, sqlite_path):
+    if backend == "sqlite":
+        return SQLiteStore(sqlite_path)
+    if backend != "memory":
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return MemoryStore()
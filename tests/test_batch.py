@@ -0,0 +1,32 @@
+# Batch runner custom_ids, one per request within the API's pattern, and
+# resuming by input line
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from batch import CUSTOM_ID_PATTERN, completed_lines, custom_id_for, error_result
+
+
+def test_repeated_and_colliding_ids_get_distinct_custom_ids():
+    used = set()
+    custom_ids = [custom_id_for(prompt_id, line, used) for line, prompt_id in
+                  enumerate(["q1", "q1", "bad id!", "req-3", "q1-2"], start=1)]
+    assert custom_ids == ["q1", "q1-2", "req-3", "req-3-2", "q1-2-2"]
+
+
+def test_suffixed_ids_stay_within_the_pattern():
+    used = set()
+    long_id = "x" * 64
+    custom_ids = [custom_id_for(long_id, line, used) for line in range(1, 12)]
+    assert len(set(custom_ids)) == 11
+    assert all(CUSTOM_ID_PATTERN.match(custom_id) for custom_id in custom_ids)
+
+
+def test_resume_goes_by_input_line_when_ids_repeat(tmp_path):
+    output = tmp_path / "results.jsonl"
+    results = [error_result("q1", 1, "overloaded"), error_result("q1", 2, "overloaded"),
+               {"id": "q1", "line": 1, "status": "succeeded"}, error_result("q1", 2, "overloaded again")]
+    output.write_text("".join(json.dumps(result) + "\n" for result in results) + '{"id": "q1", "li')
+    assert completed_lines(str(output)) == {1}
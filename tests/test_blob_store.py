@@ -0,0 +1,66 @@
+# Blob store quotas: which blobs go under pressure and which never do
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from blob_store import BlobStore, BlobStoreFull
+
+
+def blob(char, size=1000):
+    return char.encode() * size
+
+
+def test_global_quota_drops_unreferenced_then_referenced(tmp_path):
+    store = BlobStore(str(tmp_path), 3000, 3000)
+    first = store.put(blob("a"), "s1")
+    second = store.put(blob("b"), "s1")
+    store.release("s1", [second])
+    store.put(blob("c"), "s1")
+    store.put(blob("d"), "s1")
+    assert second not in store
+    assert first in store
+    store.put(blob("e"), "s1")
+    assert first not in store
+
+
+def test_pinned_blobs_survive_and_the_new_put_fails(tmp_path):
+    store = BlobStore(str(tmp_path), 2000, 2000)
+    pinned = [store.put(blob(c), "s1", pin=True) for c in "ab"]
+    with pytest.raises(BlobStoreFull):
+        store.put(blob("c"), "s2")
+    assert all(h in store for h in pinned)
+    assert store.total_bytes == 2000
+    assert store.session_bytes("s2") == 0
+    # Once unpinned they can make room again
+    store.unpin("s1", pinned)
+    store.put(blob("c"), "s2")
+    assert pinned[0] not in store
+
+
+def test_session_quota_keeps_pinned_blobs(tmp_path):
+    store = BlobStore(str(tmp_path), 10000, 2000)
+    pinned = store.put(blob("a"), "s1", pin=True)
+    store.put(blob("b"), "s1")
+    store.put(blob("c"), "s1", pin=True)
+    assert store.session_bytes("s1") == 2000
+    with pytest.raises(BlobStoreFull):
+        store.put(blob("d"), "s1", pin=True)
+    assert store.session_bytes("s1") == 2000
+    assert pinned in store
+
+
+def test_release_session(tmp_path):
+    store = BlobStore(str(tmp_path), 10000, 10000)
+    pinned = store.put(blob("a"), "s1", pin=True)
+    store.put(blob("b"), "s1")
+    store.release_session("s1", keep_pinned=True)
+    assert store.session_bytes("s1") == 1000
+    store.release_session("s1")
+    assert store.session_bytes("s1") == 0
+    # Unreferenced blobs are the first to go
+    store.quota_bytes = 1000
+    store.put(blob("c"), "s2")
+    assert pinned not in store
@@ -0,0 +1,94 @@
+# Downsampling in front of create_chart: extremes survive min/max bucketing,
+# samples keep every category and aggregates match what draw_chart plots
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pandas as pd
+
+from downsampling import (aggregate_bar, aggregate_pie, downsample_for_chart,
+                          downsample_line, downsample_scatter, minmax_bucket_indices)
+
+
+def test_minmax_bucketing_keeps_extremes_of_every_series():
+    rng = np.random.default_rng(1)
+    n = 100000
+    data = pd.DataFrame({"a": rng.normal(size=n), "b": rng.normal(size=n)})
+    data.loc[12345, "a"] = 50.0
+    data.loc[67890, "a"] = -50.0
+    data.loc[99999, "b"] = 40.0
+
+    reduced, method = downsample_line(data, max_points=500)
+
+    assert method == "min/max bucketing"
+    assert len(reduced) <= 500
+    for col in ("a", "b"):
+        assert reduced[col].max() == data[col].max()
+        assert reduced[col].min() == data[col].min()
+    assert {12345, 67890, 99999} <= set(reduced.index)
+    assert reduced.index.is_monotonic_increasing
+
+
+def test_minmax_bucketing_ignores_missing_values():
+    values = np.array([[np.nan], [3.0], [np.nan], [-2.0], [1.0], [np.nan], [np.nan]])
+
+    indices = minmax_bucket_indices(values, 2)
+
+    assert {1, 3} <= set(indices)
+    assert indices.max() < len(values)
+
+
+def test_small_frames_are_left_alone():
+    data = pd.DataFrame({"x": range(10)})
+
+    reduced, summary = downsample_for_chart(data, "Line Chart")
+
+    assert reduced is data
+    assert summary == {"original_rows": 10, "rendered_rows": 10, "method": "none"}
+
+
+def test_stratified_scatter_keeps_rare_categories():
+    n = 50000
+    labels = np.array(["common"] * (n - 30) + ["rare"] * 30, dtype=object)
+    data = pd.DataFrame({"x": np.arange(n, dtype=float), "label": labels})
+
+    reduced, method = downsample_scatter(data, max_points=1000)
+
+    assert method == "stratified sample"
+    assert (reduced["label"] == "rare").sum() >= 20
+    assert len(reduced) < 2000
+    # Same data, same sample
+    again, _ = downsample_scatter(data, max_points=1000)
+    assert again.index.equals(reduced.index)
+
+
+def test_bar_means_per_category():
+    data = pd.DataFrame({"group": ["b", "a", "b", "a"], "value": [1.0, 2.0, 3.0, 4.0]})
+
+    reduced, method = aggregate_bar(data)
+
+    assert method == "per-category means"
+    assert reduced.to_dict("list") == {"group": ["a", "b"], "value": [3.0, 2.0]}
+
+
+def test_pie_folds_tail_into_other():
+    data = pd.DataFrame({"fruit": ["apple"] * 5 + ["pear"] * 3 + ["fig", "kiwi", "lime"]})
+
+    reduced, method = aggregate_pie(data, max_slices=3)
+
+    assert method == "category counts"
+    assert reduced.to_dict("list") == {"fruit": ["apple", "pear", "Other"], "count": [5, 3, 3]}
+    assert reduced.attrs["count_column"] == "count"
+
+
+def test_pie_with_category_column_named_count():
+    data = pd.DataFrame({"count": ["one", "two", "two", "three", "three", "three"]})
+
+    reduced, _ = aggregate_pie(data)
+
+    count_column = reduced.attrs["count_column"]
+    assert count_column != "count"
+    counts = reduced.set_index("count")[count_column]
+    assert counts.to_dict() == {"three": 3, "two": 2, "one": 1}
@@ -0,0 +1,53 @@
+# Progress reported while attachments are extracted
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extraction
+from extraction import Extractor, extract_xlsx
+
+XLSX_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def workbook(sheets):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("openpyxl")
+    data = io.BytesIO()
+    with pd.ExcelWriter(data) as writer:
+        for i in range(sheets):
+            pd.DataFrame({"a": range(3)}).to_excel(writer, sheet_name=f"S{i}", index=False)
+    return data.getvalue()
+
+
+def test_xlsx_reports_each_sheet():
+    reported = []
+    result = extract_xlsx(workbook(3), lambda *progress: reported.append(progress))
+    assert reported == [(1, 3, "sheets"), (2, 3, "sheets"), (3, 3, "sheets")]
+    assert result["summary"] == "3 sheet(s), 9 rows as CSV"
+
+
+def test_pending_result_carries_progress(monkeypatch):
+    reported, release = threading.Event(), threading.Event()
+
+    def slow_extract(file_type, name, data, progress=None):
+        progress(2, 5, "pages")
+        reported.set()
+        release.wait(5)
+        return {"document": False, "summary": "done"}
+
+    monkeypatch.setattr(extraction, "extract", slow_extract)
+    extractor = Extractor(1, 4)
+    extractor.submit("hash", "application/pdf", "a.pdf", lambda: b"%PDF")
+    assert reported.wait(5)
+    pending = extractor.result("hash")
+    assert pending["status"] == "pending"
+    assert pending["progress"] == (2, 5, "pages")
+    assert pending["summary"] == "extracting… 2/5 pages"
+    release.set()
+    extractor._executor.shutdown(wait=True)
+    assert extractor.result("hash")["status"] == "done"
@@ -0,0 +1,78 @@
+# Session memory accounting: what approx_size sees, and what a session
+# reports against its budget
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from blob_store import BlobStore, BlobStoreFull
+from memory_budget import load_frame, spill_frame
+from metrics import approx_size
+
+MB = 1024 * 1024
+
+
+class Slotted:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class SlottedChild(Slotted):
+    __slots__ = "extra"
+
+    def __init__(self, value, extra):
+        super().__init__(value)
+        self.extra = extra
+
+
+def test_approx_size_walks_slots():
+    assert approx_size(Slotted("x" * MB)) > MB
+    assert approx_size(SlottedChild("x" * MB, "y" * MB)) > 2 * MB
+
+
+def test_unset_slots_are_skipped():
+    item = Slotted.__new__(Slotted)
+    assert approx_size(item) < 1024
+
+
+def test_large_scratchpad_item_counts_toward_session_memory(monkeypatch, tmp_path):
+    monkeypatch.setenv("CLAUDE_UI_SESSION_MEMORY_MB", "1")
+    monkeypatch.setenv("CLAUDE_UI_BLOB_DIR", str(tmp_path / "blobs"))
+    # Shared resources are made again with this test's settings
+    st.cache_resource.clear()
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.run()
+    # Repeated words, so the search index stays small and the item itself is what counts
+    at.session_state.scratchpad.add("big_note", "text", "word " * (MB // 2), datetime.now().isoformat())
+    # Measure now rather than reuse the last sample
+    del at.session_state["memory_sample"]
+    at.run()
+    assert not at.exception
+    assert at.session_state.last_rerun["memory_bytes"] > MB
+    assert (tmp_path / "blobs").is_dir()
+
+
+def test_spilled_frames_outlast_blob_quota_pressure(tmp_path):
+    data = pd.DataFrame({"value": range(10000)})
+    store = BlobStore(str(tmp_path), 100 * 1024, 100 * 1024)
+    frame = spill_frame(store, "s1", data)
+    with pytest.raises(BlobStoreFull):
+        store.put(b"x" * (100 * 1024), "s2")
+    assert load_frame(store, frame).equals(data)
+
+
+def test_spilled_frame_changed_on_disk_is_not_loaded(tmp_path):
+    store = BlobStore(str(tmp_path), 10 * MB, 10 * MB)
+    frame = spill_frame(store, "s1", pd.DataFrame({"value": range(100)}))
+    with open(store._path(frame.blob_hash), "wb") as f:
+        f.write(b"not the pickle that was written")
+    assert load_frame(store, frame) is None
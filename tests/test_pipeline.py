@@ -0,0 +1,81 @@
+# History trimming to a token budget and prompt cache breakpoints
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pipeline import CHARS_PER_TOKEN, PROMPT_CACHE_MIN_TOKENS, apply_prompt_caching, trim_history
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def assert_alternates(messages):
+    assert messages[0]["role"] == "user"
+    for previous, current in zip(messages, messages[1:]):
+        assert previous["role"] != current["role"]
+
+
+def test_odd_pin_count_under_a_tight_budget():
+    messages = conversation(5)
+    fitted, used = trim_history(messages, [10] * len(messages), 15, pinned=3)
+    assert_alternates(fitted)
+    assert fitted[-1] is messages[-1]
+    assert fitted[:2] == messages[:2]
+    assert used == 30
+
+
+@pytest.mark.parametrize("pinned", range(0, 8))
+@pytest.mark.parametrize("budget", [0, 10, 25, 45, 70, 1000])
+def test_trimmed_history_always_alternates(pinned, budget):
+    messages = conversation(5)
+    counts = [10] * len(messages)
+    fitted, used = trim_history(messages, counts, budget, pinned)
+    assert_alternates(fitted)
+    assert fitted[-1] is messages[-1]
+    assert used == 10 * len(fitted)
+
+
+
+def cached(messages):
+    return [i for i, msg in enumerate(messages)
+            if isinstance(msg["content"], list) and any("cache_control" in block for block in msg["content"])]
+
+
+def test_breakpoints_stay_within_the_stable_prefix():
+    system = "x" * (PROMPT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN)
+    messages = conversation(5)
+    attachment = {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "..."}}
+    messages[-1] = {"role": "user", "content": [{"type": "text", "text": "latest question"}, attachment]}
+
+    # Untrimmed: everything up to the newest message, whose attachment is sent once
+    system_blocks, fitted = apply_prompt_caching(system, messages, len(messages) - 1)
+    assert "cache_control" in system_blocks[0]
+    assert cached(fitted) == [8, 9]
+    assert "cache_control" not in fitted[-1]["content"][1]
+
+    # Trimmed: only the pinned messages
+    _, fitted = apply_prompt_caching(system, messages, 2)
+    assert cached(fitted) == [0, 1]
+    _, fitted = apply_prompt_caching(system, messages, 0)
+    assert cached(fitted) == []
+
+
+def test_resent_pinned_attachments_get_a_breakpoint():
+    document = {"type": "document", "source": {"type": "base64", "media_type": "application/pdf",
+                                               "data": "x" * (PROMPT_CACHE_MIN_TOKENS * 100)}}
+    notes = {"type": "text", "text": "\n\nFile: notes.txt\n\nshort"}
+    messages = conversation(5)
+    messages[0] = {"role": "user", "content": [{"type": "text", "text": "question 0"}, document, notes]}
+
+    _, fitted = apply_prompt_caching("Be brief.", messages, 2)
+    assert cached(fitted) == [0, 1]
+    assert [j for j, block in enumerate(fitted[0]["content"]) if "cache_control" in block] == [1, 2]
@@ -0,0 +1,176 @@
+# Request scheduler: taking turns between sessions, shared back-off on rate
+# limits and honouring retry-after headers
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+import request_scheduler
+from request_scheduler import RequestScheduler, Ticket, TokenBucket, retry_after_seconds
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = FakeResponse(headers or {})
+
+
+# _try_acquire expects the caller to hold the lock, as acquire does
+def try_acquire(scheduler, ticket):
+    with scheduler._cond:
+        return scheduler._try_acquire(ticket)
+
+
+def enqueue(scheduler, session_id, count):
+    tickets = [Ticket(session_id, 1) for _ in range(count)]
+    scheduler._queues.setdefault(session_id, deque()).extend(tickets)
+    return tickets
+
+
+def test_sessions_take_turns():
+    scheduler = RequestScheduler()
+    a = enqueue(scheduler, "a", 3)
+    b = enqueue(scheduler, "b", 1)
+    c = enqueue(scheduler, "c", 2)
+
+    assert scheduler._order() == [a[0], b[0], c[0], a[1], c[1], a[2]]
+
+    # The session let through goes to the back of the line
+    assert try_acquire(scheduler, a[0]) is None
+    assert scheduler._order() == [b[0], c[0], a[1], c[1], a[2]]
+    assert try_acquire(scheduler, b[0]) is None
+    assert scheduler._order() == [c[0], a[1], c[1], a[2]]
+    assert scheduler.queued() == 4
+
+
+def test_only_the_first_in_line_is_let_through():
+    scheduler = RequestScheduler()
+    a = enqueue(scheduler, "a", 1)
+    b = enqueue(scheduler, "b", 1)
+
+    assert try_acquire(scheduler, b[0]) == (1, None)
+    assert try_acquire(scheduler, a[0]) is None
+    assert try_acquire(scheduler, b[0]) is None
+    assert scheduler.queued() == 0
+
+
+def test_acquire_reports_wait_for_request_limit():
+    scheduler = RequestScheduler(requests_per_minute=60)
+    scheduler._requests.level = 0.0
+    a = enqueue(scheduler, "a", 1)
+
+    position, wait = try_acquire(scheduler, a[0])
+    assert position == 0
+    assert 0 < wait <= 1.0
+
+
+def test_token_bucket_refills_and_caps_large_requests():
+    bucket = TokenBucket(600)
+    bucket.take(600, bucket.updated)
+    now = bucket.updated
+
+    assert bucket.wait_time(10, now) == pytest.approx(1.0)
+    assert bucket.wait_time(10, now + 1.0) == 0.0
+    # Larger than the bucket: only a full bucket is waited for
+    bucket.level = 0.0
+    assert bucket.wait_time(10000, now + 1.0) == pytest.approx(60.0)
+
+
+def test_retry_after_headers():
+    assert retry_after_seconds(FakeError(429, {"retry-after-ms": "1500"})) == pytest.approx(1.5)
+    assert retry_after_seconds(FakeError(429, {"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(FakeError(429, {"retry-after-ms": "250", "retry-after": "9"})) == pytest.approx(0.25)
+    assert retry_after_seconds(FakeError(429, {"retry-after": "soon"})) is None
+    assert retry_after_seconds(FakeError(429)) is None
+    assert retry_after_seconds(ValueError("no response")) is None
+
+
+def test_retry_delay(monkeypatch):
+    scheduler = RequestScheduler(max_retries=2, base_delay=1.0, max_delay=60.0)
+    monkeypatch.setattr(request_scheduler.random, "uniform", lambda low, high: high)
+
+    assert scheduler.retry_delay(FakeError(500), 1) == 1.0
+    assert scheduler.retry_delay(FakeError(503), 2) == 2.0
+    assert scheduler.retry_delay(FakeError(503), 3) is None
+    assert scheduler.retry_delay(FakeError(400), 1) is None
+    assert scheduler.retry_delay(ValueError("bad"), 1) is None
+    # The server's retry-after is a floor on the jittered backoff
+    assert scheduler.retry_delay(FakeError(429, {"retry-after": "30"}), 1) == 30.0
+    assert scheduler.retry_delay(FakeError(529, {"retry-after-ms": "100"}), 2) == 2.0
+
+
+@pytest.mark.parametrize("status_code", [429, 529])
+def test_rate_limit_pauses_every_session(monkeypatch, status_code):
+    scheduler = RequestScheduler(base_delay=0.0)
+    sleeps = []
+    monkeypatch.setattr(request_scheduler.time, "sleep", sleeps.append)
+    calls = []
+    paused = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise FakeError(status_code, {"retry-after-ms": "200"})
+        return "ok"
+
+    def on_retry(attempt, delay, error):
+        paused.append(delay)
+
+    start = time.monotonic()
+    assert scheduler.run("a", 1, fn, on_retry=on_retry) == "ok"
+
+    assert paused == [pytest.approx(0.2)]
+    # Shared back-off goes through the queue, not a private sleep
+    assert sleeps == []
+    assert scheduler._paused_until >= start + 0.2
+    assert calls[1] >= calls[0] + 0.2
+    # Other sessions are held back too
+    b = enqueue(scheduler, "b", 1)
+    scheduler.pause(60)
+    position, wait = try_acquire(scheduler, b[0])
+    assert position == 0 and wait > 59
+
+
+def test_server_error_sleeps_only_this_session(monkeypatch):
+    scheduler = RequestScheduler(base_delay=0.5)
+    monkeypatch.setattr(request_scheduler.random, "uniform", lambda low, high: high)
+    sleeps = []
+    monkeypatch.setattr(request_scheduler.time, "sleep", sleeps.append)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise FakeError(500)
+        return "ok"
+
+    assert scheduler.run("a", 1, fn) == "ok"
+    assert sleeps == [0.5, 1.0]
+    assert scheduler._paused_until == 0.0
+
+
+def test_no_retry_when_vetoed_or_not_retryable():
+    scheduler = RequestScheduler(base_delay=0.0)
+
+    def overloaded():
+        raise FakeError(529)
+
+    with pytest.raises(FakeError):
+        scheduler.run("a", 1, overloaded, can_retry=lambda: False)
+
+    def bad_request():
+        raise FakeError(400)
+
+    with pytest.raises(FakeError):
+        scheduler.run("a", 1, bad_request)
+    assert scheduler.queued() == 0
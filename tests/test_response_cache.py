@@ -0,0 +1,41 @@
+# Response cache keys, what makes two requests the same, and which replies
+# are stored
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from response_cache import ResponseCache, request_key, tenant_key
+
+PARAMS = {"model": "claude-3-haiku-20240307", "max_tokens": 100, "temperature": 0,
+          "system": "Be brief.", "messages": [{"role": "user", "content": "Hello"}]}
+
+
+def test_key_ignores_prompt_cache_breakpoints():
+    with_breakpoint = dict(PARAMS, messages=[{"role": "user", "content": [
+        {"type": "text", "text": "Hello", "cache_control": {"type": "ephemeral"}}]}])
+    without_breakpoint = dict(PARAMS, messages=[{"role": "user", "content": [{"type": "text", "text": "Hello"}]}])
+    tenant = tenant_key("sk-one")
+    assert request_key(with_breakpoint, tenant) == request_key(without_breakpoint, tenant)
+
+
+def test_key_depends_on_api_key_and_endpoint():
+    keys = {
+        request_key(PARAMS, tenant_key("sk-one")),
+        request_key(PARAMS, tenant_key("sk-two")),
+        request_key(PARAMS, tenant_key("sk-one", "http://127.0.0.1:8765")),
+    }
+    assert len(keys) == 3
+
+
+def reply(stop_reason):
+    return SimpleNamespace(id="msg_1", model="claude-3-haiku-20240307", stop_reason=stop_reason, usage=None,
+                           content=[SimpleNamespace(type="text", text="Hi")])
+
+
+def test_only_complete_replies_are_stored(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 * 1024, 3600)
+    for key, stop_reason in [("a", "end_turn"), ("b", "stop_sequence"), ("c", "max_tokens"), ("d", None)]:
+        cache.put(key, reply(stop_reason))
+    assert [key for key in "abcd" if cache.get(key) is not None] == ["a", "b"]
@@ -0,0 +1,64 @@
+# Response scanner: the same artifacts however the reply is split into chunks
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from response_scanner import ResponseScanner, scan_response
+
+REPLY = (
+    "Here you go:\n"
+    "```py\n"
+    "def add(a, b):\n"
+    "    return a + b\n"
+    "```\n"
+    "\n"
+    "| name | score |\n"
+    "|------|:-----:|\n"
+    "| ada  | 3     |\n"
+    "| bob  | 5     |\n"
+    "\n"
+    "Done."
+)
+
+
+def scan_in_chunks(text, size):
+    scanner = ResponseScanner()
+    artifacts = []
+    for start in range(0, len(text), size):
+        artifacts.extend(scanner.feed(text[start:start + size]))
+    artifacts.extend(scanner.close())
+    return artifacts
+
+
+def test_code_table_and_note():
+    artifacts = scan_response(REPLY)
+    assert [a["type"] for a in artifacts] == ["code", "table", "text"]
+    assert artifacts[0]["content"] == {"language": "python", "code": "def add(a, b):\n    return a + b"}
+    assert artifacts[1]["content"].splitlines()[-1] == "| bob  | 5     |"
+    assert artifacts[2]["content"] == REPLY
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64])
+def test_fences_split_across_chunks(size):
+    assert scan_in_chunks(REPLY, size) == scan_response(REPLY)
+
+
+def test_artifacts_are_returned_as_soon_as_they_close():
+    scanner = ResponseScanner()
+    assert scanner.feed("```js\nlet a = 1;\n``") == []
+    assert [a["content"] for a in scanner.feed("`\nmore")] == [{"language": "javascript", "code": "let a = 1;"}]
+
+
+def test_unterminated_fence_and_headerless_table_are_not_saved():
+    artifacts = scan_response("| a | b |\n| 1 | 2 |\n```python\nprint(1)")
+    assert [a["type"] for a in artifacts] == ["text"]
+
+
+def test_close_is_idempotent():
+    scanner = ResponseScanner()
+    scanner.feed("note")
+    assert len(scanner.close()) == 1
+    assert scanner.close() == []
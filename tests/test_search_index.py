@@ -0,0 +1,77 @@
+# Search index: BM25 ranking, filters and keeping the index in step with deletes
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import search_index
+from search_index import SearchIndex
+
+
+def keys(results):
+    return [result["key"] for result in results]
+
+
+def test_more_occurrences_and_shorter_documents_rank_first():
+    index = SearchIndex()
+    index.add("once", "note", "zebra " + "filler " * 20)
+    index.add("twice", "note", "zebra zebra " + "filler " * 20)
+    index.add("short", "note", "zebra zebra")
+    index.add("none", "note", "filler " * 5)
+    assert keys(index.search("zebra")) == ["short", "twice", "once"]
+
+
+def test_rarer_terms_weigh_more():
+    index = SearchIndex()
+    index.add("common", "note", "apple apple banana")
+    index.add("rare", "note", "apple banana banana")
+    for i in range(5):
+        index.add(f"filler{i}", "note", "apple banana cherry")
+        index.add(f"apples{i}", "note", "apple")
+    # Every document with both terms matches; banana is rarer than apple
+    assert keys(index.search("apple banana"))[0] == "rare"
+
+
+def test_all_terms_must_match():
+    index = SearchIndex()
+    index.add("a", "note", "red green")
+    index.add("b", "note", "red blue")
+    assert keys(index.search("red blue")) == ["b"]
+    assert index.search("red purple") == []
+    assert index.search("   ") == []
+
+
+def test_kind_and_language_filters():
+    index = SearchIndex()
+    index.add(("pad", 1), "code", "def sort(items)", "sorter", "python")
+    index.add(("pad", 2), "code", "function sort(items)", "sorter", "javascript")
+    index.add(("msg", 1), "message", "how do I sort items")
+    assert set(keys(index.search("sort", kinds=["code"]))) == {("pad", 1), ("pad", 2)}
+    assert keys(index.search("sort", language="python")) == [("pad", 1)]
+    assert index.search("sort", language="rust") == []
+    assert index.languages_in_use() == ["javascript", "python"]
+
+
+def test_deletes_and_replacements_leave_no_trace():
+    index = SearchIndex()
+    index.add("a", "note", "alpha beta")
+    index.add("b", "message", "alpha gamma")
+    index.remove("a")
+    assert keys(index.search("alpha")) == ["b"]
+    assert "beta" not in index.postings
+    # Re-adding under a key replaces the old text and reuses the freed slot
+    index.add("b", "message", "delta")
+    assert index.search("gamma") == []
+    assert keys(index.search("delta")) == ["b"]
+    assert index.total_length == 1
+    index.clear(["message"])
+    assert len(index) == 0 and index.postings == {}
+
+
+def test_grows_past_initial_capacity(monkeypatch):
+    monkeypatch.setattr(search_index, "INITIAL_CAPACITY", 4)
+    index = SearchIndex()
+    for i in range(10):
+        index.add(i, "note", f"word doc{i}")
+    assert keys(index.search("doc9")) == [9]
+    assert len(index.search("word", limit=3)) == 3
@@ -0,0 +1,93 @@
+# SQLite session storage: what a resumed session gets back
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import LAZY_CONTENT_BYTES, MemoryStore, SQLiteStore
+
+
+def scratchpad_item(item_id, content, item_type="code"):
+    return SimpleNamespace(id=item_id, name=f"item {item_id}", type=item_type,
+                           content=content, created="2024-01-01 12:00:00")
+
+
+def test_messages_and_scratchpad_survive_reopening(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteStore(path)
+    assert not store.session_exists("s1")
+    store.save_message("s1", {"id": 2, "role": "assistant", "content": "hi"})
+    store.save_message("s1", {"id": 1, "role": "user", "content": "hello", "file_ids": ["hash-a"]})
+    store.save_message("s2", {"id": 1, "role": "user", "content": "other session"})
+    store.save_scratchpad_item("s1", scratchpad_item(1, "print(1)"))
+    store.save_scratchpad_item("s1", scratchpad_item(2, [{"a": 1}], item_type="table"))
+    store.save_scratchpad_item("s1", scratchpad_item(3, "gone"))
+    store.delete_scratchpad_item("s1", 3)
+
+    reopened = SQLiteStore(path)
+    assert reopened.session_exists("s1")
+    assert reopened.load_messages("s1") == [
+        {"id": 1, "role": "user", "content": "hello", "file_ids": ["hash-a"]},
+        {"id": 2, "role": "assistant", "content": "hi"}
+    ]
+    items = reopened.load_scratchpad_items("s1")
+    assert [(item["id"], item["type"], item["content"]) for item in items] == [
+        (1, "code", "print(1)"), (2, "table", [{"a": 1}])
+    ]
+    assert items[0]["name"] == "item 1"
+    assert items[0]["created"] == "2024-01-01 12:00:00"
+
+    reopened.clear_messages("s1")
+    reopened.clear_scratchpad("s1")
+    assert reopened.load_messages("s1") == []
+    assert reopened.load_scratchpad_items("s1") == []
+    # Clearing keeps the session itself, and other sessions
+    assert reopened.session_exists("s1")
+    assert len(reopened.load_messages("s2")) == 1
+
+
+def test_large_scratchpad_content_is_loaded_lazily(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteStore(path)
+    large = "x" * (LAZY_CONTENT_BYTES + 1)
+    store.save_scratchpad_item("s1", scratchpad_item(1, "small"))
+    store.save_scratchpad_item("s1", scratchpad_item(2, large))
+
+    reopened = SQLiteStore(path)
+    items = reopened.load_scratchpad_items("s1")
+    assert items[0]["content"] == "small"
+    assert items[1]["content"] is None
+    assert items[1]["name"] == "item 2"
+    assert reopened.load_scratchpad_content("s1", 2) == large
+    assert reopened.load_scratchpad_content("s1", 99) is None
+
+
+def test_memory_store_keeps_nothing():
+    store = MemoryStore()
+    store.save_message("s1", {"id": 1, "role": "user", "content": "hello"})
+    store.save_scratchpad_item("s1", scratchpad_item(1, "print(1)"))
+
+    assert not store.session_exists("s1")
+    assert store.load_messages("s1") == []
+    assert store.load_scratchpad_items("s1") == []
+
+
+def test_uploads_and_frames_survive_reopening(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteStore(path)
+    store.save_upload("s1", "hash-a", {"name": "a.txt", "type": "text/plain", "size": 10})
+    store.save_upload("s1", "hash-b", {"name": "b.png", "type": "image/png", "size": 20})
+    store.delete_uploads("s1", ["hash-b"])
+    frame = {"blob_hash": "hash-c", "rows": 30, "columns": 4, "memory_bytes": 1000,
+             "source": ("csv-hash", ("a", "b"), True)}
+    store.save_frame("s1", "chart_data", frame)
+    store.save_frame("s1", "source:fp", dict(frame, source=None))
+    store.delete_frame("s1", "source:fp")
+
+    reopened = SQLiteStore(path)
+    assert reopened.session_exists("s1")
+    assert reopened.load_uploads("s1") == {"hash-a": {"name": "a.txt", "type": "text/plain", "size": 10}}
+    # The source comes back as JSON lists
+    assert reopened.load_frames("s1") == {"chart_data": dict(frame, source=["csv-hash", ["a", "b"], True])}
+    assert reopened.load_frames("s2") == {}